@@ -0,0 +1,750 @@
+'''
+A python client of the collector, for services sending events to it the
+way the sdk does: the events, their properties and the requests are those
+Alooma.m builds, so that app.py - and the collector - can't tell them
+apart.
+
+An event gets, as in track:properties:customEvent:, the automatic
+properties, token, time, distinct_id, session_id, an increasing
+message_index, $duration when timed, the super properties and its own
+properties. It is serialized once, as it is tracked, with sending_time left
+as a placeholder that is filled in when its batch is sent, as an
+ip=1&data=<percent-escaped base64 of the json array> form body to
+<server>/track/.
+
+Where Alooma.m differs:
+- The queue is an append-only log on disk (DiskQueue), rather than the
+  whole queue archived to a file every time the app goes to the
+  background: a tracked event costs a single write, and an event that was
+  tracked survives a crash.
+- Batches are sized by payload bytes rather than 50 events at a time:
+  BatchSizer makes them as large as can be sent in about target_latency
+  seconds, from the throughput of recent sends.
+- Up to max_connections batches are sent at once, each sender keeping its
+  keep-alive connection, rather than one synchronous request at a time.
+- A batch that fails at the network level, or is answered with 429 or
+  503, is retried after a backoff, or its Retry-After; Alooma.m keeps it
+  queued until the next flush. A batch too large for the server is split.
+  Any other response acknowledges it, as in Alooma.m.
+'''
+import base64
+import collections
+import datetime
+import gzip
+import http.client
+import json
+import logging
+import os
+import platform
+import struct
+import threading
+import time
+import urllib.parse
+import uuid
+
+import segment_log
+
+
+# the version of Alooma.m whose wire format is mirrored
+LIB_VERSION = '0.1.4'
+SENDING_TIME_PLACEHOLDER = '<SendingTimePlaceHolder>'
+SENDING_TIME_KEY = 'sending_time'
+# the placeholder as serialized in an event, replaced when it is sent
+_SENDING_TIME_FIELD = json.dumps(
+    {SENDING_TIME_KEY: SENDING_TIME_PLACEHOLDER},
+    separators=(',', ':'))[1:-1].encode()
+ENDPOINT = '/track/'
+FORM_HEADERS = {
+    'Content-Type': 'application/x-www-form-urlencoded',
+    'Accept-Encoding': 'gzip',
+}
+# the flush interval of Alooma sharedInstanceWithToken:
+FLUSH_INTERVAL = 60
+# Alooma.m keeps 500 events; a service has more memory and disk to spare
+MAX_QUEUE_EVENTS = 100000
+MAX_CONNECTIONS = 4
+REQUEST_TIMEOUT = 30
+RETRY_STATUSES = (429, 502, 503, 504)
+MIN_BACKOFF = 0.5
+MAX_BACKOFF = 30
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+STATE_FILENAME = 'state.json'
+
+logger = logging.getLogger(__name__)
+
+
+def automatic_properties(app_version=None, app_release=None):
+    '''
+    the properties collectAutomaticProperties sends, for the host the
+    client runs on
+    '''
+    properties = {
+        'mp_lib': 'python',
+        '$lib_version': LIB_VERSION,
+        '$os': platform.system(),
+        '$os_version': platform.release(),
+        '$model': platform.machine(),
+        # legacy
+        'mp_device_model': platform.machine(),
+    }
+    if app_version is not None:
+        properties['$app_version'] = app_version
+    if app_release is not None:
+        properties['$app_release'] = app_release
+    return properties
+
+
+def format_date(date):
+    '''as the dateFormatter of Alooma.m, in UTC with milliseconds'''
+    date = date.astimezone(datetime.timezone.utc)
+    return '%s.%03dZ' % (date.strftime(DATE_FORMAT),
+                         date.microsecond // 1000)
+
+
+def json_serializable(value):
+    '''
+    coerces a property value as JSONSerializableObjectForObject: does:
+    dates are formatted, keys made strings, anything else but json types
+    replaced by its description
+    '''
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [json_serializable(v) for v in value]
+    if isinstance(value, dict):
+        return {k if isinstance(k, str) else str(k): json_serializable(v)
+                for k, v in value.items()}
+    if isinstance(value, datetime.datetime):
+        return format_date(value)
+    logger.debug('property values should be valid json types. got: %s',
+                 type(value).__name__)
+    return str(value)
+
+
+def _coerce(value):
+    if isinstance(value, datetime.datetime):
+        return format_date(value)
+    return json_serializable(value)
+
+
+def serialize_event(event):
+    try:
+        # json coerces whatever it can't serialize with _coerce, rather than
+        # every value being walked through json_serializable first
+        data = json.dumps(event, separators=(',', ':'), ensure_ascii=False,
+                          default=_coerce)
+    except TypeError:
+        # keys json can't make strings of
+        data = json.dumps(json_serializable(event), separators=(',', ':'),
+                          ensure_ascii=False)
+    return data.encode()
+
+
+def encode_batch(events, sending_time):
+    '''
+    the form body of a batch of serialized events, stamped with
+    sending_time, as encodeAPIData: builds it
+    '''
+    stamp = b'"%s":%d' % (SENDING_TIME_KEY.encode(), sending_time)
+    data = b'[%s]' % b','.join(e.replace(_SENDING_TIME_FIELD, stamp)
+                               for e in events)
+    return 'ip=1&data=%s' % urllib.parse.quote(
+        base64.b64encode(data).decode(), safe='')
+
+
+class DiskQueue:
+    '''
+    The events not acknowledged yet, as a log in directory.
+
+    Events are numbered by a sequence number, and appended, each as a
+    record of segment_log's format, to segment files named after the first
+    sequence number they hold. Acknowledging appends the sequence number up
+    to which every event was sent to the acks file; segments holding only
+    acknowledged events are then removed. Opening reads the events after the
+    last acknowledged one back, and cuts off a record torn by a crash.
+    '''
+    SEGMENT_NAME_TPL = '%020d.queue'
+    ACKS_FILENAME = 'acks'
+    ACK = struct.Struct('<Q')
+    SEGMENT_SIZE = 16 * 1024 * 1024
+    # the acks file is rewritten with its last record once this large
+    MAX_ACKS_SIZE = 64 * 1024
+
+    def __init__(self, directory, segment_size=SEGMENT_SIZE):
+        self.directory = directory
+        self.segment_size = segment_size
+        # the first sequence numbers of the segments, oldest first
+        self.segments = []
+        self.fd = None
+        self.size = 0
+        self.acks_fd = None
+        self.acks_size = 0
+        self.acked = 0
+        self.next_seq = 1
+
+    def open(self):
+        '''returns the (sequence number, event) of the events not acked'''
+        os.makedirs(self.directory, exist_ok=True)
+        acks_path = os.path.join(self.directory, self.ACKS_FILENAME)
+        if os.path.exists(acks_path):
+            with open(acks_path, 'rb') as f:
+                buf = f.read()
+            for _, _, payload in segment_log.iter_records(buf):
+                self.acked = self.ACK.unpack(payload)[0]
+        self.next_seq = self.acked + 1
+        pending = []
+        self.segments = sorted(
+            int(name.split('.')[0]) for name in os.listdir(self.directory)
+            if name.endswith('.queue'))
+        for base in self.segments:
+            path = self._segment_path(base)
+            with open(path, 'rb') as f:
+                buf = f.read()
+            records = segment_log.iter_records(buf)
+            seq = base
+            while True:
+                try:
+                    _, _, payload = next(records)
+                except StopIteration as stop:
+                    end = stop.value
+                    break
+                if seq > self.acked:
+                    pending.append((seq, payload))
+                seq += 1
+            if end < len(buf):
+                logger.warning('cutting off %d bytes torn from %s',
+                               len(buf) - end, path)
+                os.truncate(path, end)
+            self.next_seq = max(self.next_seq, seq)
+        self._write_acks(self.acked, rewrite=True)
+        self._remove_acked_segments()
+        self._start_segment()
+        return pending
+
+    def append(self, events):
+        '''appends serialized events, with a single write, and numbers them'''
+        first = self.next_seq
+        buf = b''.join(segment_log.encode_record(e) for e in events)
+        if self.size >= self.segment_size:
+            self._start_segment(first)
+        os.write(self.fd, buf)
+        self.size += len(buf)
+        self.next_seq += len(events)
+        return first
+
+    def ack(self, seq):
+        '''marks every event up to seq as sent'''
+        if seq <= self.acked:
+            return
+        self.acked = seq
+        self._write_acks(seq, rewrite=self.acks_size >= self.MAX_ACKS_SIZE)
+        self._remove_acked_segments()
+
+    def close(self):
+        for fd in (self.fd, self.acks_fd):
+            if fd is not None:
+                os.fsync(fd)
+                os.close(fd)
+        self.fd = self.acks_fd = None
+
+    def _segment_path(self, base):
+        return os.path.join(self.directory, self.SEGMENT_NAME_TPL % base)
+
+    def _start_segment(self, base=None):
+        base = self.next_seq if base is None else base
+        if self.fd is not None:
+            os.close(self.fd)
+        self.fd = os.open(self._segment_path(base),
+                          os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.size = os.fstat(self.fd).st_size
+        if not self.segments or self.segments[-1] != base:
+            self.segments.append(base)
+
+    def _remove_acked_segments(self):
+        # the newest segment is kept, as events are appended to it
+        while len(self.segments) > 1 and self.segments[1] - 1 <= self.acked:
+            os.remove(self._segment_path(self.segments.pop(0)))
+
+    def _write_acks(self, seq, rewrite=False):
+        record = segment_log.encode_record(self.ACK.pack(seq))
+        path = os.path.join(self.directory, self.ACKS_FILENAME)
+        if rewrite:
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(record)
+            os.replace(tmp_path, path)
+            if self.acks_fd is not None:
+                os.close(self.acks_fd)
+            self.acks_fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+            self.acks_size = len(record)
+            return
+        os.write(self.acks_fd, record)
+        self.acks_size += len(record)
+
+
+class BatchSizer:
+    '''
+    sizes batches, in bytes of serialized events, so that sending one takes
+    about target_latency seconds: from the throughput of recent sends, an
+    average weighted by smoothing. a send failing halves the size
+    '''
+    INITIAL_BYTES = 32 * 1024
+    MIN_BYTES = 1024
+    MAX_BYTES = 4 * 1024 * 1024
+    TARGET_LATENCY = 0.5
+    SMOOTHING = 0.3
+    # how much larger a batch may be than the previous target
+    MAX_GROWTH = 2
+
+    def __init__(self, target_latency=TARGET_LATENCY,
+                 initial_bytes=INITIAL_BYTES, min_bytes=MIN_BYTES,
+                 max_bytes=MAX_BYTES):
+        self.target_latency = target_latency
+        self.min_bytes = min_bytes
+        self.max_bytes = max_bytes
+        self.target_bytes = initial_bytes
+        self.throughput = None
+
+    def sent(self, num_bytes, latency):
+        throughput = num_bytes / max(latency, 1e-6)
+        if self.throughput is None:
+            self.throughput = throughput
+        else:
+            self.throughput += self.SMOOTHING * (throughput - self.throughput)
+        self.target_bytes = int(max(self.min_bytes, min(
+            self.max_bytes, self.target_bytes * self.MAX_GROWTH,
+            self.throughput * self.target_latency)))
+
+    def failed(self):
+        self.target_bytes = max(self.min_bytes, self.target_bytes // 2)
+
+
+class Alooma:
+    '''
+    Tracks events for token, and sends them to server_url in the background.
+
+    With queue_dir, events and the super properties, distinct_id and timed
+    events are kept on disk, so that a restarted client sends what was
+    tracked before. A directory must only be used by one client at a time.
+    Every client starts a new session_id, as Alooma.m does.
+
+    Events are sent every flush_interval seconds, or as soon as a batch is
+    full. flush() sends everything tracked so far, and close() flushes and
+    stops the client.
+    '''
+
+    def __init__(self, token, server_url, queue_dir=None,
+                 flush_interval=FLUSH_INTERVAL,
+                 max_queue_events=MAX_QUEUE_EVENTS,
+                 max_connections=MAX_CONNECTIONS, batch_sizer=None,
+                 request_timeout=REQUEST_TIMEOUT, app_version=None,
+                 app_release=None):
+        if not token:
+            logger.warning('empty api token')
+        self.token = token or ''
+        url = urllib.parse.urlsplit(server_url)
+        self.connection_class = http.client.HTTPSConnection \
+            if url.scheme == 'https' else http.client.HTTPConnection
+        self.netloc = url.netloc
+        self.path = url.path.rstrip('/') + ENDPOINT
+        self.flush_interval = flush_interval
+        self.max_queue_events = max_queue_events
+        self.max_connections = max_connections
+        self.sizer = batch_sizer or BatchSizer()
+        self.request_timeout = request_timeout
+        self.automatic_properties = automatic_properties(
+            app_version, app_release)
+        self.session_id = str(uuid.uuid4()).upper()
+        self.message_index = 0
+        self.distinct_id = str(uuid.uuid4()).upper()
+        self.super_properties = {}
+        self.timed_events = {}
+
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        # (sequence number, serialized event) not being sent, in order
+        self.unsent = collections.deque()
+        self.unsent_bytes = 0
+        # the first -> last sequence numbers of ranges of events that are
+        # done with - sent, or dropped - but not acknowledged yet, as an
+        # earlier event still is being sent
+        self.done = {}
+        self.acked = 0
+        self.next_seq = 1
+        # events up to this one must be sent without waiting for a full
+        # batch
+        self.flush_seq = 0
+        self.next_flush = time.monotonic() + flush_interval
+        self.retry_at = 0
+        self.backoff = 0
+        self.closing = False
+
+        self.tracked = 0
+        self.sent = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.batches = 0
+        self.retries = 0
+        self.connections = 0
+
+        self.queue = None
+        self.state_path = None
+        if queue_dir is not None:
+            self.state_path = os.path.join(queue_dir, STATE_FILENAME)
+            self.queue = DiskQueue(queue_dir)
+            pending = self.queue.open()
+            self.acked = self.queue.acked
+            self.next_seq = self.queue.next_seq
+            for seq, data in pending:
+                self.unsent.append((seq, data))
+                self.unsent_bytes += len(data)
+            if pending and pending[0][0] > self.acked + 1:
+                self._mark_done(self.acked + 1, pending[0][0] - 1)
+            self._load_state()
+        self.threads = [
+            threading.Thread(target=self._send_loop, name='alooma-sender-%d'
+                             % i, daemon=True)
+            for i in range(max_connections)]
+        for thread in self.threads:
+            thread.start()
+
+    # tracking
+
+    def track(self, event=None, properties=None, custom_event=None):
+        '''
+        queues an event, as track:properties:customEvent: does. event is
+        its type, and custom_event a dict of top level keys to send with it
+        '''
+        if not event:
+            logger.error('track called with empty event parameter. not '
+                         'using an event')
+        properties = dict(properties) if properties else None
+        now = time.time()
+        with self.lock:
+            p = dict(self.automatic_properties)
+            p['token'] = self.token
+            p['time'] = round(now)
+            started = self.timed_events.pop(event, None)
+            if started is not None:
+                p['$duration'] = round(now - started, 3)
+                self._save_state()
+            p['distinct_id'] = self.distinct_id
+            p['session_id'] = self.session_id
+            self.message_index += 1
+            p['message_index'] = self.message_index
+            p.update(self.super_properties)
+            if properties:
+                p.update(properties)
+            # always stamped when sent, as in flushQueue:endpoint:
+            p[SENDING_TIME_KEY] = SENDING_TIME_PLACEHOLDER
+            e = {'properties': p}
+            if event:
+                e['event'] = event
+            if custom_event:
+                e = dict(custom_event, **e)
+            data = serialize_event(e)
+            if self.queue is not None:
+                seq = self.queue.append([data])
+            else:
+                seq = self.next_seq
+            self.next_seq = seq + 1
+            self.unsent.append((seq, data))
+            self.unsent_bytes += len(data)
+            self.tracked += 1
+            while len(self.unsent) > self.max_queue_events:
+                dropped_seq, dropped = self.unsent.popleft()
+                self.unsent_bytes -= len(dropped)
+                self.dropped += 1
+                self._mark_done(dropped_seq, dropped_seq)
+            if self.unsent_bytes >= self.sizer.target_bytes:
+                self.condition.notify()
+
+    def identify(self, distinct_id):
+        if not distinct_id:
+            logger.debug('cannot identify blank distinct id')
+            return
+        with self.lock:
+            self.distinct_id = distinct_id
+            self._save_state()
+
+    def create_alias(self, alias, distinct_id):
+        if not alias or not distinct_id:
+            logger.error('create alias called with an empty alias or '
+                         'distinct id')
+            return
+        self.track('$create_alias',
+                   {'distinct_id': distinct_id, 'alias': alias})
+
+    def register_super_properties(self, properties):
+        with self.lock:
+            self.super_properties.update(properties)
+            self._save_state()
+
+    def register_super_properties_once(self, properties, default_value=None):
+        '''registers the properties not registered yet, or default_value'''
+        with self.lock:
+            for key, value in properties.items():
+                current = self.super_properties.get(key)
+                if current is None or current == default_value:
+                    self.super_properties[key] = value
+            self._save_state()
+
+    def unregister_super_property(self, name):
+        with self.lock:
+            self.super_properties.pop(name, None)
+            self._save_state()
+
+    def clear_super_properties(self):
+        with self.lock:
+            self.super_properties = {}
+            self._save_state()
+
+    def current_super_properties(self):
+        with self.lock:
+            return dict(self.super_properties)
+
+    def time_event(self, event):
+        '''starts timing event: its next track gets a $duration'''
+        if not event:
+            logger.error('cannot time an empty event')
+            return
+        with self.lock:
+            self.timed_events[event] = time.time()
+            self._save_state()
+
+    def clear_timed_events(self):
+        with self.lock:
+            self.timed_events = {}
+            self._save_state()
+
+    def reset(self):
+        '''
+        forgets the distinct_id, super properties and timed events, and the
+        events not sent yet
+        '''
+        with self.lock:
+            self.distinct_id = str(uuid.uuid4()).upper()
+            self.super_properties = {}
+            self.timed_events = {}
+            while self.unsent:
+                seq, data = self.unsent.popleft()
+                self.unsent_bytes -= len(data)
+                self._mark_done(seq, seq)
+            self._save_state()
+
+    # sending
+
+    def flush(self, timeout=None):
+        '''
+        sends every event tracked so far, and returns whether they were all
+        sent within timeout seconds
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            seq = self.next_seq - 1
+            self.flush_seq = max(self.flush_seq, seq)
+            self.condition.notify_all()
+            while self.acked < seq:
+                remaining = None if deadline is None else \
+                    deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            return True
+
+    def close(self, timeout=None):
+        '''
+        flushes, then stops sending. what could not be sent is kept in
+        queue_dir, if there is one, for the next client using it
+        '''
+        if self.closing:
+            return self.acked == self.next_seq - 1
+        flushed = self.flush(timeout)
+        with self.condition:
+            self.closing = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+        if self.queue is not None:
+            with self.lock:
+                self.queue.close()
+        return flushed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'tracked': self.tracked,
+                'sent': self.sent,
+                'dropped': self.dropped,
+                'rejected': self.rejected,
+                'queued': len(self.unsent),
+                'batches': self.batches,
+                'retries': self.retries,
+                'connections': self.connections,
+                'batch_bytes': self.sizer.target_bytes,
+            }
+
+    def _take_batch(self):
+        '''
+        waits for a batch to send - a full one, or any events that are due -
+        and returns its (sequence number, event) items, or None when closing
+        '''
+        with self.condition:
+            while True:
+                if self.closing:
+                    return None
+                now = time.monotonic()
+                if now >= self.next_flush:
+                    self.flush_seq = max(self.flush_seq, self.next_seq - 1)
+                    self.next_flush = now + self.flush_interval
+                ready = self.unsent and (
+                    self.unsent_bytes >= self.sizer.target_bytes or
+                    self.unsent[0][0] <= self.flush_seq)
+                if ready and now >= self.retry_at:
+                    break
+                wakeup = self.next_flush
+                if ready:
+                    wakeup = min(wakeup, self.retry_at)
+                self.condition.wait(max(0, wakeup - now))
+            batch = []
+            num_bytes = 0
+            while self.unsent and (
+                    not batch or num_bytes + len(self.unsent[0][1]) <=
+                    self.sizer.target_bytes):
+                item = self.unsent.popleft()
+                batch.append(item)
+                num_bytes += len(item[1])
+            self.unsent_bytes -= num_bytes
+            return batch
+
+    def _send_loop(self):
+        conn = None
+        try:
+            while True:
+                batch = self._take_batch()
+                if batch is None:
+                    return
+                if conn is None:
+                    conn = self.connection_class(
+                        self.netloc, timeout=self.request_timeout)
+                    with self.lock:
+                        self.connections += 1
+                body = encode_batch([data for _, data in batch],
+                                    round(time.time())).encode()
+                start = time.perf_counter()
+                try:
+                    conn.request('POST', self.path, body, FORM_HEADERS)
+                    response = conn.getresponse()
+                    response_body = response.read()
+                    if response.getheader('Content-Encoding') == 'gzip':
+                        response_body = gzip.decompress(response_body)
+                except (OSError, EOFError, http.client.HTTPException) as e:
+                    # a truncated gzip body raises EOFError
+                    logger.warning('network failure: %s', e)
+                    conn.close()
+                    conn = None
+                    self._retry(batch)
+                    continue
+                if response.status in RETRY_STATUSES:
+                    self._retry(batch, response.getheader('Retry-After'))
+                    continue
+                if response.status == 413 and len(batch) > 1:
+                    # sent again in smaller batches
+                    self._retry(batch, '0')
+                    continue
+                self._sent(batch, len(body), time.perf_counter() - start,
+                           response.status, response_body)
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def _sent(self, batch, num_bytes, latency, status, body):
+        rejected = 0
+        if status != 200:
+            logger.error('%s responded with %d, dropping %d events',
+                         self.path, status, len(batch))
+            rejected = len(batch)
+        elif body.startswith(b'{'):
+            # app.py lists the events it rejected
+            try:
+                rejected = len(json.loads(body).get('rejected', ()))
+            except (ValueError, AttributeError):
+                pass
+            if rejected:
+                logger.error('%s api rejected %d items', self.path, rejected)
+        with self.condition:
+            self.sizer.sent(num_bytes, latency)
+            self.backoff = 0
+            self.batches += 1
+            self.sent += len(batch) - rejected
+            self.rejected += rejected
+            for seq, _ in batch:
+                self._mark_done(seq, seq)
+            self.condition.notify_all()
+
+    def _retry(self, batch, retry_after=None):
+        with self.condition:
+            self.retries += 1
+            self.sizer.failed()
+            self.backoff = min(MAX_BACKOFF, max(MIN_BACKOFF, self.backoff * 2))
+            delay = self.backoff
+            if retry_after and retry_after.isdigit():
+                delay = int(retry_after)
+            self.retry_at = time.monotonic() + delay
+            if self.unsent and self.unsent[0][0] < batch[-1][0]:
+                self.unsent = collections.deque(
+                    sorted(self.unsent + collections.deque(batch)))
+            else:
+                self.unsent.extendleft(reversed(batch))
+            self.unsent_bytes += sum(len(data) for _, data in batch)
+            self.condition.notify_all()
+
+    def _mark_done(self, first, last):
+        '''
+        marks events as done with, and acknowledges every event up to the
+        first one that still is queued or being sent. the lock must be held
+        '''
+        self.done[first] = last
+        acked = self.acked
+        while acked + 1 in self.done:
+            acked = self.done.pop(acked + 1)
+        if acked != self.acked:
+            self.acked = acked
+            if self.queue is not None:
+                self.queue.ack(acked)
+            self.condition.notify_all()
+
+    def _load_state(self):
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            logger.error('unable to read %s, starting fresh', self.state_path)
+            return
+        self.distinct_id = state.get('distinct_id') or self.distinct_id
+        self.super_properties = state.get('super_properties', {})
+        self.timed_events = state.get('timed_events', {})
+
+    def _save_state(self):
+        '''
+        writes the distinct_id, super properties and timed events, as
+        archiveProperties does. the lock must be held
+        '''
+        if self.state_path is None:
+            return
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'distinct_id': self.distinct_id,
+                'super_properties': json_serializable(self.super_properties),
+                'timed_events': self.timed_events,
+            }, f)
+        os.replace(tmp_path, self.state_path)
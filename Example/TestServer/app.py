@@ -1,12 +1,44 @@
 import flask
-import json
 import argparse
 import base64
-import sqlite3
+import calendar
+import collections
+import contextlib
+import datetime
+import functools
+import heapq
+import io
+import itertools
+import logging
+import os
+import signal
 import sys
+import threading
+import time
+import zlib
+
+import werkzeug.exceptions
+import werkzeug.wsgi
+
+import codec
+import db_pool
+import dedup
+import extraction
+import hot_cache
+import metrics
+import notifier
+import partitioning
+import prefork
+import rollups
+import segment_log
+import storage
+import validation
+import write_behind
 
 
 TEST_DB = 'example_app_test_db.db'
+TEST_LOG_DIRECTORY = 'example_app_test_log'
+STORAGE_BACKENDS = ('sqlite', 'log')
 TEST_DB_SCHEMA = '''\
 create table if not exists events (
   _id integer primary key autoincrement,
@@ -14,24 +46,214 @@ create table if not exists events (
   token varchar,
   data blob
 );'''
-INSERT_EVENT_QUERY = 'insert into events (token, data) ' \
-                     'values (\'{token}\', \'{data}\');'
-GET_EVENTS_QUERY = 'select _id, date_created, token, data from events;'
-GET_EVENTS_BY_TOKEN_QUERY_TPL = 'select _id, date_created, token, data ' \
-                                'from events where token=\'{token}\''
+# schema changes applied on top of TEST_DB_SCHEMA, in order. the number of
+# migrations already applied to a database is kept in its user_version
+MIGRATIONS = [
+    # covers the token lookups of get, count and delete by token. sqlite
+    # appends the rowid (_id) to every index entry, so this also serves
+    # keyset pagination within a token without sorting
+    'create index if not exists events_token_idx on events (token);',
+    'create index if not exists events_date_created_idx '
+    'on events (date_created);',
+]
+MIGRATION_TPL = 'begin; {migration} pragma user_version={version}; commit;'
+USER_VERSION_PRAGMA = 'pragma user_version;'
+# the queries of the events table, or of one of its partitions
+GET_EVENTS_QUERY_TPL = 'select _id, date_created, token, data from {table} ' \
+                       'where {where} order by _id limit ?;'
+BEGIN_IMMEDIATE = 'begin immediate;'
 COMMIT = 'commit;'
-COUNT_EVENTS_QUERY = 'select count(1) from events;'
-COUNT_EVENTS_BY_TOKEN_QUERY_TPL = 'select count(1) from events ' \
-                                  'where token=\'{token}\''
-DELETE_EVENTS_QUERY = 'delete from events;'
-DELETE_EVENTS_BY_TOKEN_QUERY_TPL = 'delete from events where token=\'{token}\''
+DELETE_ALL_EVENTS_QUERY_TPL = 'delete from {table};'
+DELETE_EVENTS_QUERY_TPL = 'delete from {table} where {where};'
+COUNT_ALL_EVENTS_QUERY_TPL = 'select count(*) from {table};'
+COUNT_EVENTS_QUERY_TPL = 'select count(*) from {table} where {where};'
+LAST_INSERT_ROWID_QUERY = 'select last_insert_rowid();'
+INSERTED_EVENTS_QUERY_TPL = 'select _id, date_created from {table} ' \
+                            'where _id between ? and ? order by _id;'
+PREVIOUS_EVENT_QUERY_TPL = 'select max(_id) from {table} ' \
+                           'where token=? and _id<?;'
+EVENTS_TABLE = partitioning.EVENTS_TABLE
+PARTITION_MODES = ('none', ) + tuple(partitioning.WIDTHS)
+JOURNAL_MODE_PRAGMA_TPL = 'pragma journal_mode={journal_mode};'
+
+JOURNAL_MODES = ('delete', 'truncate', 'persist', 'memory', 'wal', 'off')
+SYNCHRONOUS_MODES = ('off', 'normal', 'full', 'extra')
+FETCH_SIZE = 500
+NDJSON_MIMETYPE = 'application/x-ndjson'
+EVENT_JSON_TPL = '{{"_id": {0}, "timestamp": {1}, "token": {2}, "data": {3}}}'
+TIMESTAMP_FORMAT = storage.TIMESTAMP_FORMAT
+MAX_DECOMPRESSED_BODY_SIZE = 64 * 1024 * 1024
+# seconds, for /events/<token>/wait and /events/<token>/stream
+WAIT_TIMEOUT = 30
+STREAM_TIMEOUT = 300
+MAX_WAIT_TIMEOUT = 3600
+# waiters check for events committed by other processes this often
+WAIT_POLL_INTERVAL = 0.5
+# an idle stream sends a comment this often, to keep proxies from closing it
+STREAM_KEEP_ALIVE_INTERVAL = 15
+# counting the stored events reads every shard and partition; /metrics does
+# it at most this often
+EVENTS_TABLE_ROWS_MAX_AGE = 10
+SSE_MIMETYPE = 'text/event-stream'
+# zlib wbits: 16 + MAX_WBITS expects a gzip header, MAX_WBITS a zlib header
+# and -MAX_WBITS a raw deflate stream, which some clients send as deflate
+CONTENT_ENCODING_WBITS = {
+    'gzip': [16 + zlib.MAX_WBITS],
+    'x-gzip': [16 + zlib.MAX_WBITS],
+    'deflate': [zlib.MAX_WBITS, -zlib.MAX_WBITS],
+}
 
 
 app = flask.Flask('alooma-iossdk-test-server')
+app.config.update(
+    STORAGE='sqlite',
+    DATABASE=TEST_DB,
+    JOURNAL_MODE='wal',
+    SYNCHRONOUS='normal',
+    POOL_SIZE=db_pool.POOL_MAX_SIZE,
+    STATEMENT_CACHE_SIZE=db_pool.STATEMENT_CACHE_SIZE,
+    WRITE_BEHIND=False,
+    WRITE_BEHIND_QUEUE_SIZE=write_behind.QUEUE_MAX_BATCHES,
+    KEEP_RAW_EVENTS=False,
+    EXTRACTED_COLUMNS=extraction.DEFAULT_COLUMNS,
+    SHARDS=1,
+    LOG_DIRECTORY=TEST_LOG_DIRECTORY,
+    LOG_SEGMENT_SIZE=segment_log.SEGMENT_SIZE,
+    LOG_SYNC='interval',
+    PARTITION='none',
+    RETENTION=0,
+    RETENTION_INTERVAL=partitioning.RETENTION_INTERVAL,
+    HOT_CACHE_BYTES=0,
+    ROLLUPS=False,
+    ROLLUP_BUCKET=rollups.BUCKET,
+    ROLLUP_MAX_AGE=rollups.MAX_AGE,
+    STRICT_SCHEMA=False,
+    DEDUP=False,
+    DEDUP_MAX_KEYS=dedup.MAX_KEYS,
+    DEDUP_MAX_AGE=dedup.MAX_AGE,
+    # set by open_read_only()
+    READ_ONLY=False,
+    # with debug logging, log every n-th received event (0: none)
+    EVENT_LOG_EVERY=1,
+)
+# the storage.EventStore of this process, see get_store()
+store = None
+# one connection pool, and write-behind queue, per shard
+pools = []
+writers = []
+# with HOT_CACHE_BYTES, per shard: held from inserting events to adding them
+# to the hot cache once committed, and those additions until then
+cache_locks = []
+cache_pending = {}
+# set in prefork workers, to let /kill stop the whole server
+master_pid = None
+# name -> extraction.ExtractedColumn, and the insert query filling them
+extracted_columns = {}
+# table -> the query inserting rows with the extracted columns into it
+insert_queries = {}
+# the Partitions of every shard, with PARTITION
+partitions = []
+# drops expired partitions, with RETENTION
+retention = None
+event_log_counter = itertools.count()
+# what received events are validated against, see init_db()
+schema = validation.Schema()
+# the recent events of each token, with HOT_CACHE_BYTES
+event_cache = None
+# counts of events per token, type and minute, with ROLLUPS
+event_rollups = None
+# drops events received before, with DEDUP
+deduplicator = None
+# woken up on every commit, for the requests waiting for events
+event_notifier = notifier.EventNotifier()
+
+# the metrics of this process, served by /metrics
+registry = metrics.Registry()
+requests_total = registry.register(metrics.Counter(
+    'http_requests_total', 'requests handled, by route, method and status',
+    ('route', 'method', 'status')))
+request_duration = registry.register(metrics.Histogram(
+    'http_request_duration_seconds',
+    'time to handle a request, by route. streamed responses are timed '
+    'until they start streaming', ('route', )))
+phase_duration = registry.register(metrics.Histogram(
+    'track_phase_duration_seconds',
+    'time spent per batch in each phase of receiving events: decompress, '
+    'form, base64, json, validate, dedup, extract, insert, commit or '
+    'enqueue, rollup', ('phase', )))
+events_received = registry.register(metrics.Counter(
+    'events_received_total', 'events received by /track/ and /v2/track/'))
+hot_cache_requests = registry.register(metrics.Counter(
+    'hot_cache_requests_total',
+    'reads of a token\'s events the hot cache could serve, by whether it '
+    'held them', ('result', )))
+events_rejected = registry.register(metrics.Counter(
+    'events_rejected_total',
+    'events failing validation, by the first property at fault',
+    ('property', )))
+events_duplicate = registry.register(metrics.Counter(
+    'events_duplicate_total',
+    'events dropped as duplicates of events received before'))
+event_rate = metrics.RateMeter()
+
+
+class DecompressRequestMiddleware:
+    '''
+    inflates request bodies sent with a gzip or deflate Content-Encoding
+    before flask gets to parse them, so that every route - including the
+    form based /track/ - accepts compressed bodies
+    '''
+
+    def __init__(self, wsgi_app, max_size=MAX_DECOMPRESSED_BODY_SIZE):
+        self.wsgi_app = wsgi_app
+        self.max_size = max_size
+
+    def __call__(self, environ, start_response):
+        encoding = environ.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+        if encoding in ('', 'identity'):
+            return self.wsgi_app(environ, start_response)
+        if encoding not in CONTENT_ENCODING_WBITS:
+            error = werkzeug.exceptions.UnsupportedMediaType(
+                'unsupported Content-Encoding: %s' % encoding)
+            return error(environ, start_response)
+        body = werkzeug.wsgi.get_input_stream(environ).read()
+        try:
+            with phase_duration.time('decompress'):
+                data = self.decompress(body, CONTENT_ENCODING_WBITS[encoding])
+        except werkzeug.exceptions.HTTPException as error:
+            return error(environ, start_response)
+        environ['wsgi.input'] = io.BytesIO(data)
+        environ['CONTENT_LENGTH'] = str(len(data))
+        del environ['HTTP_CONTENT_ENCODING']
+        return self.wsgi_app(environ, start_response)
+
+    def decompress(self, body, wbits_options):
+        for wbits in wbits_options:
+            decompressor = zlib.decompressobj(wbits)
+            try:
+                data = decompressor.decompress(body, self.max_size + 1)
+            except zlib.error:
+                continue
+            if len(data) > self.max_size:
+                raise werkzeug.exceptions.RequestEntityTooLarge()
+            if not decompressor.eof:
+                raise werkzeug.exceptions.BadRequest('truncated body')
+            return data
+        raise werkzeug.exceptions.BadRequest('could not decompress body')
+
+
+app.wsgi_app = DecompressRequestMiddleware(app.wsgi_app)
 
 
 @app.route('/kill', methods=['POST'])
 def kill_app():
+    # don't lose batches that were acknowledged but not yet stored
+    get_store().flush()
+    if master_pid is not None:
+        # the master forwards this to every worker, which drains its own
+        # write-behind queues on the way out
+        os.kill(master_pid, signal.SIGTERM)
+        return 'Shutting down...\n'
     func = flask.request.environ.get('werkzeug.server.shutdown')
     if func is None:
         raise RuntimeError('Not running with the Werkzeug Server')
@@ -41,19 +263,97 @@ def kill_app():
 
 @app.route('/track/', methods=['POST'])
 def track_event():
-    decoded_data = base64.decodebytes(flask.request.form['data'].encode())
-    received_events = json.loads(decoded_data)
+    '''
+    the format sent by the sdk: an ip=1&data=<base64 json> form
+    '''
+    with phase_duration.time('form'):
+        data = flask.request.form['data']
+    with phase_duration.time('base64'):
+        decoded_data = base64.decodebytes(data.encode())
+    with phase_duration.time('json'):
+        received_events = codec.decode_events(
+            decoded_data, app.config['KEEP_RAW_EVENTS'])
+    return ingest(received_events)
+
+
+@app.route('/v2/track/', methods=['POST'])
+def track_event_v2():
+    '''
+    the json array of events as the raw body, without the base64 and form
+    encoding. as with /track/, the body may be gzip or deflate compressed.
+    '''
+    data = flask.request.get_data()
+    try:
+        with phase_duration.time('json'):
+            received_events = codec.decode_events(
+                data, app.config['KEEP_RAW_EVENTS'])
+    except ValueError:
+        flask.abort(400, 'body must be a json array of events')
+    return ingest(received_events)
+
+
+def ingest(received_events):
+    '''
+    stores the valid events of a decoded batch, given as a list of (event,
+    serialized event), all at once. responds with 0 - or, when some events
+    were rejected or with ?verbose=1, with a json status listing the index,
+    property and error of every rejected event. either way the valid events
+    are stored, so that a client has no reason to send them again
+    '''
+    rejected = []
     if len(received_events) > 0:
-        cursor = get_db().cursor()
-        for idx, e in enumerate(received_events):
-            data = json.dumps(e)
+        events_received.inc(amount=len(received_events))
+        event_rate.mark(len(received_events))
+        with phase_duration.time('validate'):
+            errors = schema.validate([e for e, _ in received_events])
+        # logging every event costs about as much as storing it, so it is
+        # only done at debug level, and for every n-th event
+        log_every = app.config['EVENT_LOG_EVERY']
+        log_events = log_every > 0 and app.logger.isEnabledFor(logging.DEBUG)
+        batch = []
+        for idx, ((e, data), error) in enumerate(
+                zip(received_events, errors)):
+            if error is not None:
+                rejected.append(
+                    {'index': idx, 'property': error[0], 'error': error[1]})
+                continue
             token = e['properties']['token']
-            event_type = e.get('event', '<<nil>>')
-            app.logger.info('event idx=%d type=%s token=%s',
-                            idx, event_type, token)
-            cursor.execute(INSERT_EVENT_QUERY.format(token=token, data=data))
-        cursor.execute(COMMIT)
+            if log_events and next(event_log_counter) % log_every == 0:
+                app.logger.debug('event idx=%d type=%s token=%s', idx,
+                                 e.get('event', '<<nil>>'), token)
+            batch.append((token, data, e))
+        for name, count in collections.Counter(
+                r['property'] for r in rejected).items():
+            events_rejected.inc(name, amount=count)
+        num_valid = len(batch)
+        keys = ()
+        if deduplicator is not None:
+            with phase_duration.time('dedup'):
+                batch, keys = deduplicator.filter(batch)
+            if len(batch) < num_valid:
+                events_duplicate.inc(amount=num_valid - len(batch))
+        # if the batch isn't stored, it may be retried, and must not be
+        # taken for a duplicate then
+        try:
+            appended = not batch or get_store().append(batch)
+        except Exception:
+            if keys:
+                deduplicator.forget(keys)
+            raise
+        if not appended:
+            if keys:
+                deduplicator.forget(keys)
+            return 'write-behind queue is full', 503, {'Retry-After': '1'}
+        if batch and event_rollups is not None:
+            with phase_duration.time('rollup'):
+                event_rollups.add(batch)
 
+    if rejected or flask.request.args.get('verbose') == '1':
+        return flask.jsonify({
+            'status': 0 if rejected else 1,
+            'accepted': len(received_events) - len(rejected),
+            'rejected': rejected,
+        })
     return "0", 200
 
 
@@ -74,37 +374,300 @@ def events_by_token(token):
 
 
 def get_events(token=None):
-    cursor = get_db().cursor()
-    if token:
-        query = GET_EVENTS_BY_TOKEN_QUERY_TPL.format(token=token)
+    '''
+    streams the events, in _id order, either as a single json object:
+    {"events": [...]}, or as newline delimited json (one event per line)
+    when asked for with ?format=ndjson or an application/x-ndjson Accept
+    header.
+    pages are selected with ?after=<_id> (keyset pagination: only events
+    with a greater _id are returned) and ?limit=<n>; the cursor for the
+    next page is the _id of the last event returned.
+    ?since= and ?until= restrict the events by the time they were received,
+    and the extracted columns filter them too (see events_filter).
+    events of a token are read from its shard only; otherwise every shard
+    is read, and the shards' events are merged by _id.
+    '''
+    after = flask.request.args.get('after', 0, type=int)
+    limit = flask.request.args.get('limit', -1, type=int)
+    if limit < -1 or limit == 0:
+        flask.abort(400, 'limit must be a positive integer')
+    event_filter = events_filter(token)
+    chunks = None
+    if event_cache is not None and is_token_only(event_filter):
+        cached = event_cache.get(token, after, limit)
+        hot_cache_requests.inc('miss' if cached is None else 'hit')
+        if cached is not None:
+            app.logger.info('GET EVENTS token=%s: %d cached events', token,
+                            len(cached))
+            chunks = [cached]
+    if chunks is None:
+        chunks = iter_formatted_events(
+            get_store().select(event_filter, after, limit), token)
+
+    ndjson = flask.request.args.get('format') == 'ndjson' or \
+        flask.request.accept_mimetypes.best == NDJSON_MIMETYPE
+    if ndjson:
+        generate = generate_ndjson(chunks)
+        mimetype = NDJSON_MIMETYPE
     else:
-        query = GET_EVENTS_QUERY
-    all_events = cursor.execute(query).fetchall()
-    app.logger.info('GET EVENTS: %s', all_events)
-    result = {
-        'events': [
-            {
-                '_id': r[0],
-                'timestamp': r[1],
-                'token': r[2],
-                'data': json.loads(r[3])
-            } for r in all_events
-        ]
-    }
-    return flask.jsonify(result)
+        generate = generate_json(chunks)
+        mimetype = 'application/json'
+    # keep the request context, and with it the db connection, until the
+    # whole response was generated
+    return flask.Response(
+        flask.stream_with_context(generate), mimetype=mimetype)
+
+
+def select_events(event_filter, after, limit, connect):
+    '''
+    returns an iterator over the (_id, date_created, token, data) rows
+    matching event_filter whose _id is greater than after, in _id order.
+    connect(shard) returns the connection to read a shard with
+    '''
+    conditions, params = event_filter.sql()
+    where = ' and '.join(conditions + ['_id>?'])
+    shard_rows = []
+    for shard in event_shards(event_filter.token):
+        db = connect(shard)
+        shard_rows.append(iter_table_rows(
+            db, shard, shard_tables(db, shard, event_filter), where,
+            params + [local_id(after, shard)], limit))
+    if len(shard_rows) == 1:
+        return shard_rows[0]
+    rows = heapq.merge(*shard_rows, key=lambda r: r[0])
+    if limit > 0:
+        rows = itertools.islice(rows, limit)
+    return rows
+
+
+def iter_table_rows(db, shard, tables, where, params, limit):
+    '''
+    yields the rows of a shard's tables matching where, one table after the
+    other - their _ids increase from one table to the next - up to limit
+    rows (-1: all)
+    '''
+    for table in tables:
+        cursor = db.cursor()
+        cursor.execute(GET_EVENTS_QUERY_TPL.format(table=table, where=where),
+                       params + [limit])
+        for row in iter_shard_rows(cursor, shard):
+            yield row
+            if limit > 0:
+                limit -= 1
+                if limit == 0:
+                    return
+
+
+def count_events_after(event_filter, after, connect):
+    conditions, params = event_filter.sql()
+    where = ' and '.join(conditions + ['_id>?'])
+    num_events = 0
+    for shard in event_shards(event_filter.token):
+        db = connect(shard)
+        for table in shard_tables(db, shard, event_filter):
+            num_events += db.execute(
+                COUNT_EVENTS_QUERY_TPL.format(table=table, where=where),
+                params + [local_id(after, shard)]).fetchone()[0]
+    return num_events
+
+
+def event_shards(token):
+    return [shard_of(token)] if token else range(len(get_pools()))
+
+
+def shard_tables(db, shard, event_filter=None):
+    '''
+    the tables holding a shard's events, in _id order: the events table,
+    then with PARTITION its partitions - only those which may hold events
+    received in event_filter's time range
+    '''
+    if not partitions:
+        return [EVENTS_TABLE]
+    if event_filter is None:
+        return partitions[shard].tables(db)
+    return partitions[shard].tables(
+        db, event_filter.since, event_filter.until)
+
+
+@contextlib.contextmanager
+def pooled_connections():
+    '''
+    yields a connect(shard) function for reads outside of get_db(), whose
+    connections go back to the pool on exit - so that requests waiting for
+    events don't hold a connection while they wait
+    '''
+    acquired = {}
+
+    def connect(shard):
+        if shard not in acquired:
+            acquired[shard] = get_pools()[shard].acquire()
+        return acquired[shard]
+    try:
+        yield connect
+    finally:
+        for shard, db in acquired.items():
+            get_pools()[shard].release(db)
+
+
+@app.route('/events/<token>/wait', methods=['GET'])
+def wait_for_events(token):
+    '''
+    long polls for the events of a token: blocks until at least ?count=
+    (default 1) events match, or until ?timeout= seconds passed (default
+    WAIT_TIMEOUT), then responds as GET /events/<token> with the same
+    arguments would - with fewer events than asked for on timeout.
+    '''
+    count = flask.request.args.get('count', 1, type=int)
+    if count < 1:
+        flask.abort(400, 'count must be a positive integer')
+    deadline = time.monotonic() + wait_timeout_arg(WAIT_TIMEOUT)
+    after = flask.request.args.get('after', 0, type=int)
+    event_filter = events_filter(token)
+    event_store = get_store()
+    while True:
+        version = event_notifier.version
+        with event_store.connections() as connect:
+            found = event_store.count(event_filter, after, connect)
+        remaining = deadline - time.monotonic()
+        if found >= count or remaining <= 0:
+            break
+        event_notifier.wait(version, min(remaining, WAIT_POLL_INTERVAL))
+    return get_events(token)
+
+
+@app.route('/events/<token>/stream', methods=['GET'])
+def stream_events(token):
+    '''
+    pushes the events of a token as server-sent events, one per message,
+    with the event's _id as the message id: first the events already
+    received (after ?after= or the Last-Event-ID header, when resuming),
+    then every event as soon as it's committed. the stream ends after
+    ?count= events, if given, or after ?timeout= seconds (default
+    STREAM_TIMEOUT). accepts the filters of GET /events/<token>.
+    '''
+    count = flask.request.args.get('count', -1, type=int)
+    if count < -1 or count == 0:
+        flask.abort(400, 'count must be a positive integer')
+    deadline = time.monotonic() + wait_timeout_arg(STREAM_TIMEOUT)
+    after = max(flask.request.args.get('after', 0, type=int),
+                flask.request.headers.get('Last-Event-ID', 0, type=int))
+    return flask.Response(
+        generate_sse(events_filter(token), after, count, deadline),
+        mimetype=SSE_MIMETYPE, headers={'Cache-Control': 'no-cache'})
+
+
+def generate_sse(event_filter, after, count, deadline):
+    event_store = get_store()
+    sent = 0
+    last_message = time.monotonic()
+    while True:
+        version = event_notifier.version
+        limit = FETCH_SIZE if count < 0 else min(FETCH_SIZE, count - sent)
+        with event_store.connections() as connect:
+            rows = list(event_store.select(
+                event_filter, after, limit, connect))
+        if rows:
+            yield ''.join('id: %d\ndata: %s\n\n' % (r[0], format_event(r))
+                          for r in rows)
+            after = rows[-1][0]
+            sent += len(rows)
+            last_message = time.monotonic()
+            if sent == count:
+                return
+            # there may be more waiting already
+            continue
+        now = time.monotonic()
+        if now >= deadline:
+            return
+        if now - last_message >= STREAM_KEEP_ALIVE_INTERVAL:
+            yield ': keep-alive\n\n'
+            last_message = now
+        event_notifier.wait(version, min(deadline - now, WAIT_POLL_INTERVAL))
+
+
+def wait_timeout_arg(default):
+    try:
+        timeout = float(flask.request.args.get('timeout', default))
+    except ValueError:
+        flask.abort(400, 'timeout must be a number of seconds')
+    if not 0 <= timeout <= MAX_WAIT_TIMEOUT:
+        flask.abort(400, 'timeout must be between 0 and %d seconds' %
+                    MAX_WAIT_TIMEOUT)
+    return timeout
+
+
+def iter_shard_rows(cursor, shard):
+    '''yields the cursor's rows, with their _id made global'''
+    num_shards = len(get_pools())
+    rows = cursor.fetchmany(FETCH_SIZE)
+    while rows:
+        for r in rows:
+            yield (r[0] * num_shards + shard, ) + r[1:]
+        rows = cursor.fetchmany(FETCH_SIZE)
+
+
+def local_id(global_id, shard):
+    '''
+    the greatest _id of the shard's table whose global _id is <= global_id.
+    global _ids are local _id * number of shards + shard, which keeps them
+    unique across shards, and equal to the local ones with a single shard
+    '''
+    return (global_id - shard) // len(get_pools())
+
+
+def iter_formatted_events(rows, token):
+    '''
+    yields lists of up to FETCH_SIZE events, formatted as json strings.
+    the data column already holds the event as json, so it is embedded
+    as-is rather than being parsed and serialized again
+    '''
+    num_events = 0
+    rows = iter(rows)
+    chunk = list(itertools.islice(rows, FETCH_SIZE))
+    while chunk:
+        num_events += len(chunk)
+        yield [format_event(r) for r in chunk]
+        chunk = list(itertools.islice(rows, FETCH_SIZE))
+    app.logger.info('GET EVENTS token=%s: %d events', token, num_events)
+
+
+def format_event(row):
+    return EVENT_JSON_TPL.format(
+        row[0], codec.dumps(row[1]), codec.dumps(row[2]), row[3])
+
+
+def generate_json(chunks):
+    '''the events of chunks, lists of formatted events, as a json object'''
+    yield '{"events": ['
+    separator = ''
+    for events in chunks:
+        if events:
+            yield separator + ', '.join(events)
+            separator = ', '
+    yield ']}\n'
+
+
+def generate_ndjson(chunks):
+    for events in chunks:
+        if events:
+            yield '\n'.join(events) + '\n'
+
+
+def is_token_only(event_filter):
+    '''whether event_filter selects all the events of a token'''
+    return event_filter.token and not (
+        event_filter.since or event_filter.until or event_filter.conditions)
 
 
 def delete_events(token=None):
-    cursor = get_db().cursor()
-    if token:
-        count_query = COUNT_EVENTS_BY_TOKEN_QUERY_TPL.format(token=token)
-        delete_query = DELETE_EVENTS_BY_TOKEN_QUERY_TPL.format(token=token)
-    else:
-        count_query = COUNT_EVENTS_QUERY
-        delete_query = DELETE_EVENTS_QUERY
-    num_events = int(cursor.execute(count_query).fetchall()[0][0])
-    cursor.execute(delete_query)
-    cursor.execute(COMMIT)
+    event_filter = events_filter(token)
+    num_events = get_store().delete(event_filter)
+    if event_rollups is not None:
+        if event_filter.since or event_filter.until or \
+                event_filter.conditions:
+            event_rollups.rebuild(get_store(), token)
+        else:
+            event_rollups.forget(token)
     return flask.jsonify({
         'success': True,
         'token': token,
@@ -112,32 +675,795 @@ def delete_events(token=None):
     })
 
 
-def get_db():
-    db = getattr(flask.g, '_database', None)
+def events_filter(token=None):
+    '''
+    returns the storage.EventFilter selecting the events of the given token,
+    received between the ?since= and ?until= arguments (inclusive). both
+    accept a unix timestamp or an iso formatted utc time.
+    every extracted column can be filtered on by its name, e.g.
+    ?event=<type>, and numeric ones by a range too, e.g. ?min_time=<t>.
+    with sqlite these only read the indexed columns, never the stored json;
+    the log parses the json of the events it filters on them.
+    '''
+    conditions = []
+    for name, column in extracted_columns.items():
+        for arg, operator in (
+                (name, '='), ('min_' + name, '>='), ('max_' + name, '<=')):
+            value = flask.request.args.get(arg)
+            if value is None:
+                continue
+            if operator != '=' and column.type == 'text':
+                flask.abort(400, '%s is not a numeric column' % name)
+            try:
+                value = column.parse_arg(value)
+            except ValueError:
+                flask.abort(400, '%s must be a%s %s' % (
+                    arg, 'n' if column.type == 'integer' else '',
+                    column.type))
+            conditions.append((column, operator, value))
+    return storage.EventFilter(token, parse_time_arg('since'),
+                               parse_time_arg('until'), conditions)
+
+
+def parse_time_arg(name):
+    value = flask.request.args.get(name)
+    if not value:
+        return None
+    try:
+        if value.isdigit():
+            t = datetime.datetime.fromtimestamp(
+                int(value), datetime.timezone.utc)
+        else:
+            t = datetime.datetime.fromisoformat(value)
+            if t.tzinfo is not None:
+                t = t.astimezone(datetime.timezone.utc)
+    except (ValueError, OverflowError):
+        flask.abort(400, '%s must be a unix timestamp or an iso time' % name)
+    return t.strftime(TIMESTAMP_FORMAT)
+
+
+@app.route('/rollups/<token>', methods=['GET'])
+def get_rollups(token):
+    '''
+    the rollups of a token's events, per event type and ?bucket= seconds (a
+    multiple of ROLLUP_BUCKET, which it defaults to): the number of events,
+    and the count, sum and ?percentiles= (default 50,90,99) of the $duration
+    of timed events. ?event= selects an event type, and ?since= and ?until=
+    the buckets by the time they start. only the rollups are read - never
+    the events themselves
+    '''
+    if event_rollups is None:
+        flask.abort(404, 'rollups are only kept with --rollups')
+    bucket = flask.request.args.get('bucket', event_rollups.bucket, type=int)
+    if bucket <= 0 or bucket % event_rollups.bucket:
+        flask.abort(400, 'bucket must be a multiple of %d seconds' %
+                    event_rollups.bucket)
+    try:
+        percentiles = [
+            float(p) for p in flask.request.args.get(
+                'percentiles', ','.join(map(str, rollups.PERCENTILES)))
+            .split(',') if p]
+    except ValueError:
+        percentiles = [-1]
+    if not all(0 <= p <= 100 for p in percentiles):
+        flask.abort(400, 'percentiles must be numbers between 0 and 100')
+    since, until = parse_time_arg('since'), parse_time_arg('until')
+    result = []
+    for start, event_type, rollup in event_rollups.query(
+            token, flask.request.args.get('event'),
+            since and unix_time(since), until and unix_time(until), bucket):
+        item = {'start': start, 'event': event_type}
+        item.update(rollup.to_json(percentiles))
+        result.append(item)
+    return flask.jsonify({'token': token, 'bucket': bucket,
+                          'rollups': result})
+
+
+@app.route('/rollups/rebuild', methods=['POST'])
+def rebuild_rollups():
+    '''
+    rebuilds the rollups of every token, or of ?token=, from the stored
+    events - the only way to roll up events stored before running with
+    --rollups
+    '''
+    if event_rollups is None:
+        flask.abort(404, 'rollups are only kept with --rollups')
+    token = flask.request.args.get('token')
+    start = time.perf_counter()
+    num_events = event_rollups.rebuild(get_store(), token)
+    return flask.jsonify({
+        'success': True,
+        'token': token,
+        'num_events': num_events,
+        'seconds': round(time.perf_counter() - start, 3),
+    })
+
+
+def unix_time(timestamp):
+    '''the unix time of a TIMESTAMP_FORMAT string'''
+    return calendar.timegm(time.strptime(timestamp, TIMESTAMP_FORMAT))
+
+
+@app.route('/stats/', methods=['GET'])
+def stats():
+    '''
+    the counters of this process and of its storage: with sqlite, summed
+    over the shards under 'pool' and 'write_behind', and per shard under
+    'shards'; with the log, its segments, events and fsyncs
+    '''
+    event_store = get_store()
+    result = {'pid': os.getpid(), 'storage': event_store.name}
+    result.update(event_store.stats())
+    if event_cache is not None:
+        result['hot_cache'] = event_cache.stats()
+    if event_rollups is not None:
+        result['rollups'] = event_rollups.stats()
+    if deduplicator is not None:
+        result['dedup'] = deduplicator.stats()
+    return flask.jsonify(result)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    '''the metrics of this process, in the prometheus text format'''
+    return flask.Response(registry.render(),
+                          content_type=metrics.CONTENT_TYPE)
+
+
+def count_events():
+    return [((shard, ), n) for shard, n in get_store().sizes()]
+
+
+def write_behind_depth():
+    return [((shard, ), n) for shard, n in get_store().queue_depths()]
+
+
+events_table_rows = registry.register(metrics.Gauge(
+    'events_table_rows', 'events stored, by shard', count_events,
+    ('shard', ), max_age=EVENTS_TABLE_ROWS_MAX_AGE))
+registry.register(metrics.Gauge(
+    'write_behind_queue_depth', 'batches waiting to be committed, by shard',
+    write_behind_depth, ('shard', )))
+registry.register(metrics.Gauge(
+    'events_duplicate_ratio', 'the fraction of the events received that '
+    'were duplicates', lambda: deduplicator.duplicate_ratio()
+    if deduplicator is not None else 0.0))
+registry.register(metrics.Gauge(
+    'events_per_second', 'events received per second, over the last %d '
+    'seconds' % metrics.RATE_WINDOW, event_rate.rate))
+
+
+@app.before_request
+def start_request_timer():
+    flask.g.request_start = time.perf_counter()
+
+
+@app.after_request
+def observe_request(response):
+    rule = flask.request.url_rule
+    route = rule.rule if rule is not None else '<unmatched>'
+    request_duration.observe(
+        time.perf_counter() - flask.g.request_start, route)
+    requests_total.inc(route, flask.request.method, response.status_code)
+    return response
+
+
+def sum_stats(stats_list):
+    result = {}
+    for s in stats_list:
+        for key, value in s.items():
+            result[key] = result.get(key, 0) + value
+    return result
+
+
+def shard_of(token):
+    '''
+    the shard holding the events of a token. crc32 is stable across
+    processes, unlike hash() of a str
+    '''
+    return zlib.crc32(token.encode()) % len(get_pools())
+
+
+def shard_database(shard):
+    database = app.config['DATABASE']
+    if app.config['SHARDS'] == 1:
+        return database
+    root, ext = os.path.splitext(database)
+    return '%s.shard%d%s' % (root, shard, ext)
+
+
+def count_shards(database):
+    '''the number of shards of the database files written at database'''
+    root, ext = os.path.splitext(database)
+    shards = 0
+    while os.path.exists('%s.shard%d%s' % (root, shards, ext)):
+        shards += 1
+    return shards or 1
+
+
+def get_pools():
+    global pools, partitions, cache_locks
+    if not pools:
+        pools = [
+            db_pool.ConnectionPool(
+                shard_database(shard),
+                synchronous=app.config['SYNCHRONOUS'],
+                max_size=app.config['POOL_SIZE'],
+                cached_statements=app.config['STATEMENT_CACHE_SIZE'],
+                read_only=app.config['READ_ONLY'])
+            for shard in range(app.config['SHARDS'])
+        ]
+        cache_locks = [threading.Lock() for _ in pools]
+        # read-only, partitions are found by their names, whatever their
+        # width
+        if app.config['PARTITION'] != 'none' or app.config['READ_ONLY']:
+            partitions = [
+                partitioning.Partitions(
+                    partitioning.WIDTHS.get(app.config['PARTITION']),
+                    extracted_columns.values())
+                for _ in pools
+            ]
+    return pools
+
+
+def get_db(shard=0):
+    databases = flask.g.setdefault('_databases', {})
+    db = databases.get(shard)
     if db is None:
-        db = flask.g._database = sqlite3.connect(TEST_DB)
+        db = databases[shard] = get_pools()[shard].acquire()
     return db
 
 
 @app.teardown_appcontext
 def close_connection(exception):
-    db = getattr(flask.g, '_database', None)
-    if db is not None:
-        db.close()
+    for shard, db in flask.g.pop('_databases', {}).items():
+        get_pools()[shard].release(db)
+
+
+class SQLiteStore(storage.EventStore):
+    '''the events table, in a database file per shard'''
+    name = 'sqlite'
+
+    def open(self):
+        start_writers()
+        start_retention()
+
+    def close(self):
+        close_pools()
+
+    def append(self, events):
+        rows_by_shard = {}
+        with phase_duration.time('extract'):
+            for token, data, e in events:
+                rows_by_shard.setdefault(shard_of(token), []).append(
+                    extraction.make_row(
+                        token, data, e, extracted_columns.values()))
+        # a batch normally holds a single token, and so a single shard. when
+        # it spans several, each shard's part is committed on its own
+        if writers:
+            with phase_duration.time('enqueue'):
+                for shard, rows in rows_by_shard.items():
+                    if not writers[shard].put(rows):
+                        return False
+            return True
+        # the whole batch goes in with a single parameterized statement and
+        # a single commit, rather than one statement per event
+        for shard, rows in rows_by_shard.items():
+            db = get_db(shard)
+            with cache_lock(shard):
+                try:
+                    with phase_duration.time('insert'):
+                        insert_rows(shard, db, rows)
+                    with phase_duration.time('commit'):
+                        db.execute(COMMIT)
+                except Exception:
+                    discard_cached(shard, rows)
+                    raise
+                commit_cached(shard)
+        if self.on_commit is not None:
+            self.on_commit()
+        return True
+
+    def flush(self):
+        for w in writers:
+            w.flush()
+
+    def connections(self):
+        return pooled_connections()
+
+    def select(self, event_filter, after=0, limit=-1, connect=None):
+        return select_events(event_filter, after, limit, connect or get_db)
+
+    def count(self, event_filter, after=0, connect=None):
+        return count_events_after(event_filter, after, connect or get_db)
+
+    def delete(self, event_filter):
+        # delete whatever was acknowledged before this request
+        self.flush()
+        conditions, params = event_filter.sql()
+        num_events = 0
+        for shard in event_shards(event_filter.token):
+            db = get_db(shard)
+            cursor = db.cursor()
+            if partitions and not db.in_transaction:
+                # the events are counted, and their partitions dropped,
+                # holding the write lock: none can be inserted in between,
+                # and dropped uncounted
+                cursor.execute(BEGIN_IMMEDIATE)
+            tables = shard_tables(db, shard, event_filter)
+            for table in tables:
+                if conditions:
+                    cursor.execute(DELETE_EVENTS_QUERY_TPL.format(
+                        table=table, where=' and '.join(conditions)), params)
+                    num_events += cursor.rowcount
+                elif table == EVENTS_TABLE:
+                    cursor.execute(
+                        DELETE_ALL_EVENTS_QUERY_TPL.format(table=table))
+                    num_events += cursor.rowcount
+                else:
+                    num_events += cursor.execute(
+                        COUNT_ALL_EVENTS_QUERY_TPL.format(
+                            table=table)).fetchone()[0]
+            if not conditions and len(tables) > 1:
+                # dropping partitions takes a moment, whatever their size.
+                # this commits the transaction
+                partitions[shard].drop(db, tables[1:])
+            else:
+                cursor.execute(COMMIT)
+            if event_cache is not None:
+                event_cache.invalidate(
+                    [event_filter.token] if event_filter.token else None)
+        return num_events
+
+    def sizes(self):
+        result = []
+        for shard in range(len(get_pools())):
+            db = get_db(shard)
+            result.append((shard, sum(
+                db.execute(COUNT_ALL_EVENTS_QUERY_TPL.format(
+                    table=table)).fetchone()[0]
+                for table in shard_tables(db, shard))))
+        return result
+
+    def queue_depths(self):
+        return [(shard, w.stats()['depth']) for shard, w in enumerate(writers)]
+
+    def stats(self):
+        shards = []
+        for shard, p in enumerate(get_pools()):
+            shard_stats = {'database': p.database, 'pool': p.stats()}
+            if writers:
+                shard_stats['write_behind'] = writers[shard].stats()
+            shards.append(shard_stats)
+        result = {
+            'pool': sum_stats(s['pool'] for s in shards),
+            'shards': shards,
+        }
+        if writers:
+            result['write_behind'] = sum_stats(
+                s['write_behind'] for s in shards)
+        if partitions:
+            result['partitions'] = sum_stats(p.stats() for p in partitions)
+        if retention is not None:
+            result['retention'] = retention.stats()
+        return result
+
+
+def insert_rows(shard, db, rows):
+    '''
+    inserts rows into a shard with db, in its current transaction or else
+    in a new one, and prepares their addition to the hot cache, which
+    commit_cached() makes once the transaction commits. with PARTITION, the
+    transaction takes the write lock first, so that the partition inserted
+    into stays the newest one until it commits
+    '''
+    table = EVENTS_TABLE
+    if partitions:
+        if not db.in_transaction:
+            db.execute(BEGIN_IMMEDIATE)
+        table = partitions[shard].insert_table(db, time.time())
+    query = insert_queries.get(table)
+    if query is None:
+        query = insert_queries[table] = extraction.insert_query(
+            extracted_columns.values(), table)
+    db.executemany(query, rows)
+    if event_cache is not None:
+        cache_pending.setdefault(shard, []).extend(
+            cache_inserted(shard, db, table, rows))
+
+
+def cache_inserted(shard, db, table, rows):
+    '''
+    returns the (token, events, floor) additions to the hot cache of rows
+    just inserted into a shard's table with db. they are read in the
+    inserting transaction, which sees the rows, and added once it commits,
+    under the shard's cache lock or by its single write-behind writer: the
+    cache then gets the events of every token in _id order, as it must, and
+    never events that are rolled back
+    '''
+    last_id = db.execute(LAST_INSERT_ROWID_QUERY).fetchone()[0]
+    first_id = last_id - len(rows) + 1
+    inserted = db.execute(INSERTED_EVENTS_QUERY_TPL.format(table=table),
+                          (first_id, last_id)).fetchall()
+    if len(inserted) != len(rows):
+        # the tokens are dropped from the cache instead, once committed
+        return [(token, None, None) for token in {row[0] for row in rows}]
+    num_shards = len(get_pools())
+    events_by_token = {}
+    for (_id, date_created), row in zip(inserted, rows):
+        global_id = _id * num_shards + shard
+        events_by_token.setdefault(row[0], []).append((
+            global_id, format_event((global_id, date_created) + row[:2])))
+    additions = []
+    for token, events in events_by_token.items():
+        floor = None
+        if token not in event_cache:
+            # the token's earlier events, if any, aren't cached
+            floor = 0
+            tables = shard_tables(db, shard)
+            for earlier in reversed(tables[:tables.index(table) + 1]):
+                previous_id = db.execute(
+                    PREVIOUS_EVENT_QUERY_TPL.format(table=earlier),
+                    (token, first_id)).fetchone()[0]
+                if previous_id is not None:
+                    floor = previous_id * num_shards + shard
+                    break
+        additions.append((token, events, floor))
+    return additions
+
+
+def cache_lock(shard):
+    '''held from inserting into a shard until its commit is cached'''
+    if event_cache is None:
+        return contextlib.nullcontext()
+    return cache_locks[shard]
+
+
+def commit_cached(shard):
+    '''adds the events of a shard's committed transaction to the cache'''
+    for token, events, floor in cache_pending.pop(shard, ()):
+        if events is None:
+            event_cache.invalidate([token])
+        else:
+            event_cache.add(token, events, floor)
+
+
+def discard_cached(shard, rows):
+    '''
+    drops the cache additions of a shard's transaction that was rolled back,
+    and the tokens of its rows, whose cached events may be missing some
+    '''
+    cache_pending.pop(shard, None)
+    forget_cached(rows)
+
+
+def writer_committed(shard):
+    commit_cached(shard)
+    event_notifier.notify()
+
+
+def forget_cached(rows):
+    '''drops the tokens of rows that failed to commit from the hot cache'''
+    if event_cache is not None:
+        event_cache.invalidate({row[0] for row in rows})
+
+
+def forget_failed(rows):
+    '''
+    forgets rows the write-behind writer failed to commit, and dropped: in
+    the hot cache, and as seen by the deduplicator, so that they are stored
+    if they are sent again
+    '''
+    forget_cached(rows)
+    if deduplicator is None:
+        return
+    keys = []
+    for row in rows:
+        try:
+            key = dedup.event_key(row[0], codec.loads(row[1]))
+        except ValueError:
+            continue
+        if key is not None:
+            keys.append(key)
+    deduplicator.forget(keys)
+
+
+def get_store():
+    global store
+    if store is None:
+        if app.config['STORAGE'] == 'log':
+            store = segment_log.SegmentLogStore(
+                app.config['LOG_DIRECTORY'],
+                segment_size=app.config['LOG_SEGMENT_SIZE'],
+                sync=app.config['LOG_SYNC'],
+                on_commit=event_notifier.notify)
+        else:
+            store = SQLiteStore(on_commit=event_notifier.notify)
+    return store
+
+
+def open_store():
+    '''
+    opens the storage. threads don't survive a fork, so prefork workers call
+    this again after forking
+    '''
+    get_store().open()
+
+
+def start_writers():
+    '''starts a write-behind queue per shard, when configured to'''
+    global writers
+    writers = []
+    if app.config['WRITE_BEHIND']:
+        for shard, p in enumerate(get_pools()):
+            w = write_behind.WriteBehindQueue(
+                p, functools.partial(insert_rows, shard),
+                max_batches=app.config['WRITE_BEHIND_QUEUE_SIZE'],
+                on_commit=functools.partial(writer_committed, shard),
+                on_rollback=lambda batches, shard=shard: discard_cached(
+                    shard, [row for rows in batches for row in rows]),
+                on_failure=forget_failed)
+            w.start()
+            writers.append(w)
+
+
+def start_retention():
+    '''drops expired partitions in the background, when configured to'''
+    global retention
+    retention = None
+    get_pools()
+    if partitions and app.config['RETENTION']:
+        retention = partitioning.Retention(
+            get_pools(), partitions, app.config['RETENTION'],
+            app.config['RETENTION_INTERVAL'],
+            on_drop=event_cache.invalidate if event_cache is not None
+            else None)
+        retention.start()
+
+
+def stop_writers():
+    '''commits whatever the write-behind queues hold'''
+    for w in writers:
+        w.stop()
+
+
+def close_db():
+    '''stores whatever was acknowledged, and closes the storage'''
+    global store
+    if store is not None:
+        store.close()
+        store = None
+    close_pools()
+    events_table_rows.reset()
+
+
+def close_pools():
+    '''commits whatever the write-behind queues hold and closes the pools'''
+    global pools, writers, partitions, retention
+    if retention is not None:
+        retention.stop()
+        retention = None
+    stop_writers()
+    writers = []
+    for p in pools:
+        p.close()
+    pools = []
+    partitions = []
+    cache_pending.clear()
 
 
 def init_db():
-    with app.app_context():
-        db = get_db()
-        db.cursor().executescript(TEST_DB_SCHEMA)
-        db.commit()
+    global extracted_columns, deduplicator, schema, event_cache, \
+        event_rollups
+    close_db()
+    schema = validation.Schema(app.config['STRICT_SCHEMA'])
+    event_cache = None
+    if app.config['STORAGE'] == 'sqlite' and app.config['HOT_CACHE_BYTES']:
+        event_cache = hot_cache.HotCache(app.config['HOT_CACHE_BYTES'])
+    event_rollups = None
+    if app.config['ROLLUPS']:
+        event_rollups = rollups.Rollups(app.config['ROLLUP_BUCKET'],
+                                        app.config['ROLLUP_MAX_AGE'])
+    deduplicator = None
+    if app.config['DEDUP']:
+        deduplicator = dedup.Deduplicator(app.config['DEDUP_MAX_KEYS'],
+                                          app.config['DEDUP_MAX_AGE'])
+    columns = extraction.parse_columns(app.config['EXTRACTED_COLUMNS'])
+    extracted_columns = {c.name: c for c in columns}
+    insert_queries.clear()
+    if app.config['STORAGE'] == 'sqlite':
+        with app.app_context():
+            for shard in range(len(get_pools())):
+                db = get_db(shard)
+                if partitions:
+                    partitioning.enable_incremental_vacuum(db)
+                db.execute(JOURNAL_MODE_PRAGMA_TPL.format(
+                    journal_mode=app.config['JOURNAL_MODE']))
+                db.cursor().executescript(TEST_DB_SCHEMA)
+                db.commit()
+                migrate_db(db)
+                for table in shard_tables(db, shard):
+                    extraction.sync_schema(db, columns, table)
+    open_store()
 
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser('simple iossdk http server')
+def open_read_only():
+    '''
+    opens the storage to read the events stored there, for tools such as
+    event_export.py: sqlite database files are opened read-only, with as
+    many shards as there are files and whatever partitions they hold, and
+    nothing is created, migrated or started. close_db() closes it
+    '''
+    global extracted_columns, event_cache
+    close_db()
+    event_cache = None
+    extracted_columns = {
+        c.name: c
+        for c in extraction.parse_columns(app.config['EXTRACTED_COLUMNS'])}
+    if app.config['STORAGE'] == 'sqlite':
+        app.config.update(READ_ONLY=True,
+                          SHARDS=count_shards(app.config['DATABASE']))
+        get_store()
+    else:
+        open_store()
+
+
+def migrate_db(db):
+    version = db.execute(USER_VERSION_PRAGMA).fetchone()[0]
+    for idx, migration in enumerate(MIGRATIONS[version:], version):
+        app.logger.info('applying migration %d: %s', idx + 1, migration)
+        db.executescript(MIGRATION_TPL.format(
+            migration=migration, version=idx + 1))
+
+
+def make_arg_parser(description='simple iossdk http server'):
+    parser = argparse.ArgumentParser(description)
     parser.add_argument('--host', '-d', default='0.0.0.0')
     parser.add_argument('--port', '-p', default='8000')
     parser.add_argument('--debug', action='store_true')
+    parser.add_argument('--storage', default='sqlite',
+                        choices=STORAGE_BACKENDS,
+                        help='store events in sqlite, or in an append-only '
+                             'segment log')
+    parser.add_argument('--db', default=TEST_DB)
+    parser.add_argument('--journal-mode', default='wal', choices=JOURNAL_MODES)
+    parser.add_argument('--synchronous', default='normal',
+                        choices=SYNCHRONOUS_MODES)
+    parser.add_argument('--pool-size', type=int, default=db_pool.POOL_MAX_SIZE)
+    parser.add_argument('--json-backend', choices=codec.BACKENDS,
+                        help='defaults to the fastest one installed')
+    parser.add_argument('--keep-raw-events', action='store_true',
+                        help='store events as received, instead of '
+                             'serializing the parsed events again')
+    parser.add_argument('--extracted-columns',
+                        default=','.join(extraction.DEFAULT_COLUMNS),
+                        help='comma separated name[:type] of properties to '
+                             'extract into indexed columns, type being one '
+                             'of %s' % ', '.join(extraction.COLUMN_TYPES))
+    parser.add_argument('--workers', type=int, default=1,
+                        help='serve with this many prefork processes')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='spread events over this many database files, '
+                             'by token')
+    parser.add_argument('--partition', default='none',
+                        choices=PARTITION_MODES,
+                        help='store events in a table per hour or day')
+    parser.add_argument('--retention', type=float, default=0,
+                        help='with --partition, drop partitions once all '
+                             'their events are older than this many seconds')
+    parser.add_argument('--write-behind', action='store_true',
+                        help='acknowledge /track/ before events are committed')
+    parser.add_argument('--write-behind-queue-size', type=int,
+                        default=write_behind.QUEUE_MAX_BATCHES)
+    parser.add_argument('--log-dir', default=TEST_LOG_DIRECTORY,
+                        help='the directory of the log, with --storage log')
+    parser.add_argument('--log-segment-size', type=int,
+                        default=segment_log.SEGMENT_SIZE,
+                        help='bytes after which a new log segment is started')
+    parser.add_argument('--log-sync', default='interval',
+                        choices=segment_log.SYNC_MODES,
+                        help='when appends to the log are fsynced: group '
+                             'acknowledges them once fsynced, interval '
+                             'fsyncs every %gs' % segment_log.SYNC_INTERVAL)
+    parser.add_argument('--hot-cache-bytes', type=int, default=0,
+                        help='keep the recent events of each token in '
+                             'memory, up to this many bytes (e.g. %d), to '
+                             'serve /events/<token> from' %
+                             hot_cache.MAX_BYTES)
+    parser.add_argument('--rollups', action='store_true',
+                        help='count events per token, event type and time '
+                             'bucket as they are received, for /rollups/')
+    parser.add_argument('--rollup-bucket', type=int, default=rollups.BUCKET,
+                        help='seconds per bucket of the rollups')
+    parser.add_argument('--rollup-max-age', type=int,
+                        default=rollups.MAX_AGE,
+                        help='seconds of buckets the rollups keep')
+    parser.add_argument('--strict-schema', action='store_true',
+                        help='reject events missing any of the properties '
+                             'the sdk sends, not only the token')
+    parser.add_argument('--dedup', action='store_true',
+                        help='drop events whose token, session_id and '
+                             'message_index were received before')
+    parser.add_argument('--dedup-max-keys', type=int, default=dedup.MAX_KEYS,
+                        help='events remembered for --dedup')
+    parser.add_argument('--dedup-max-age', type=float, default=dedup.MAX_AGE,
+                        help='seconds events are remembered for --dedup')
+    parser.add_argument('--event-log-every', type=int, default=1,
+                        help='with --debug, log every n-th received event; '
+                             '0 logs none')
+    return parser
+
+
+def configure(args):
+    app.config.update(
+        STORAGE=args.storage,
+        DATABASE=args.db,
+        JOURNAL_MODE=args.journal_mode,
+        SYNCHRONOUS=args.synchronous,
+        POOL_SIZE=args.pool_size,
+        WRITE_BEHIND=args.write_behind,
+        WRITE_BEHIND_QUEUE_SIZE=args.write_behind_queue_size,
+        KEEP_RAW_EVENTS=args.keep_raw_events,
+        EXTRACTED_COLUMNS=[
+            spec for spec in args.extracted_columns.split(',') if spec],
+        SHARDS=args.shards,
+        PARTITION=args.partition,
+        RETENTION=args.retention,
+        LOG_DIRECTORY=args.log_dir,
+        LOG_SEGMENT_SIZE=args.log_segment_size,
+        LOG_SYNC=args.log_sync,
+        HOT_CACHE_BYTES=args.hot_cache_bytes,
+        ROLLUPS=args.rollups,
+        ROLLUP_BUCKET=args.rollup_bucket,
+        ROLLUP_MAX_AGE=args.rollup_max_age,
+        STRICT_SCHEMA=args.strict_schema,
+        DEDUP=args.dedup,
+        DEDUP_MAX_KEYS=args.dedup_max_keys,
+        DEDUP_MAX_AGE=args.dedup_max_age,
+        EVENT_LOG_EVERY=args.event_log_every,
+    )
+    codec.set_backend(args.json_backend)
+    app.logger.info('json backend: %s', codec.backend.name)
+
+
+def check_args(parser, args):
+    '''exits with parser's usage on options that can't be used together'''
+    if args.storage == 'log' and args.workers != 1:
+        parser.error('the log can only be opened by a single process')
+    if args.storage == 'log' and (args.write_behind or args.shards != 1):
+        parser.error('--write-behind and --shards apply to sqlite storage')
+    if args.partition != 'none' and args.storage != 'sqlite':
+        parser.error('--partition applies to sqlite storage')
+    if args.retention and args.partition == 'none':
+        parser.error('--retention needs --partition')
+    if args.hot_cache_bytes and (args.storage != 'sqlite' or
+                                 args.workers != 1):
+        parser.error('the hot cache needs sqlite storage and a single '
+                     'process, which sees every insert')
+    if args.rollups and args.workers != 1:
+        parser.error('rollups are kept by a single process, which must '
+                     'receive every event')
+    if args.rollup_bucket <= 0:
+        parser.error('--rollup-bucket must be a positive number of seconds')
+
+
+if __name__ == '__main__':
+    parser = make_arg_parser()
     args = parser.parse_args()
+    check_args(parser, args)
+    configure(args)
     init_db()
-    app.run(host=args.host, port=args.port, debug=args.debug)
+    if args.workers == 1:
+        # stores what the write-behind queues hold, and fsyncs the log, on
+        # /kill, ctrl-c and SIGTERM alike
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            app.run(host=args.host, port=args.port, debug=args.debug)
+        finally:
+            close_db()
+    else:
+        # the workers open their own connections and writer threads
+        close_db()
+        master_pid = os.getpid()
+        prefork.serve(app, args.host, args.port, args.workers,
+                      on_worker_start=open_store, on_worker_exit=close_db)
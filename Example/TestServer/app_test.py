@@ -0,0 +1,1703 @@
+import argparse
+import asyncio
+import base64
+import datetime
+import gzip
+import hashlib
+import http.server
+import http.client
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import urllib.parse
+import zipfile
+import zlib
+
+import alooma_client
+import app
+import async_app
+import benchmark
+import codec
+import dedup
+import event_export
+import extraction
+import hot_cache
+import load_generator
+import metrics
+import parallel_test_runner
+import partitioning
+import rollups
+import sauce_connect
+import segment_log
+import validation
+
+
+class AppTestCase(unittest.TestCase):
+    config = {}
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.orig_config = dict(app.app.config)
+        app.app.config.update(
+            DATABASE=os.path.join(self.tmp_dir, 'test.db'),
+            LOG_DIRECTORY=os.path.join(self.tmp_dir, 'log'),
+            JOURNAL_MODE='wal',
+            SYNCHRONOUS='normal',
+        )
+        app.app.config.update(self.config)
+        app.init_db()
+        self.client = app.app.test_client()
+
+    def tearDown(self):
+        app.close_db()
+        app.app.config.clear()
+        app.app.config.update(self.orig_config)
+        shutil.rmtree(self.tmp_dir)
+
+    def post_events(self, events):
+        return self.client.post(
+            '/track/', data=benchmark.encode_batch(events),
+            content_type='application/x-www-form-urlencoded')
+
+    def get_events(self, token=''):
+        return self.client.get('/events/%s' % token).get_json()['events']
+
+
+class AppTest(AppTestCase):
+
+    def test_track_batch(self):
+        events = [benchmark.make_event('TOKEN_A', 'session', i)
+                  for i in range(1, 51)]
+        events[0]['properties']['quoted'] = "it's"
+        res = self.post_events(events)
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(b'0', res.data)
+        received = self.get_events('TOKEN_A')
+        self.assertEqual(50, len(received))
+        self.assertEqual(
+            list(range(1, 51)),
+            [e['data']['properties']['message_index'] for e in received])
+        self.assertEqual("it's", received[0]['data']['properties']['quoted'])
+
+    def test_wal_journal_mode(self):
+        with app.app.app_context():
+            mode = app.get_db().execute('pragma journal_mode;').fetchone()[0]
+        self.assertEqual('wal', mode)
+
+    def test_delete_by_token(self):
+        self.post_events([benchmark.make_event('TOKEN_A', 's', 1),
+                          benchmark.make_event('TOKEN_B', 's', 2)])
+        res = self.client.delete('/events/TOKEN_A').get_json()
+        self.assertEqual(1, res['num_deleted_events'])
+        self.assertEqual([], self.get_events('TOKEN_A'))
+        self.assertEqual(1, len(self.get_events()))
+
+    def test_get_events_pagination(self):
+        self.post_events([benchmark.make_event('TOKEN_%s' % (i % 2), 's', i)
+                          for i in range(10)])
+        page = self.client.get('/events/TOKEN_0?limit=3').get_json()['events']
+        self.assertEqual([0, 2, 4], [e['data']['properties']['message_index']
+                                     for e in page])
+        page = self.client.get('/events/TOKEN_0?limit=3&after=%d' % (
+            page[-1]['_id'])).get_json()['events']
+        self.assertEqual([6, 8], [e['data']['properties']['message_index']
+                                  for e in page])
+        self.assertEqual(
+            400, self.client.get('/events/?limit=0').status_code)
+
+    def test_get_events_ndjson(self):
+        self.post_events([benchmark.make_event('TOKEN_A', 's', i)
+                          for i in range(app.FETCH_SIZE + 1)])
+        res = self.client.get('/events/?format=ndjson&after=1')
+        self.assertEqual(app.NDJSON_MIMETYPE, res.mimetype)
+        lines = res.get_data(as_text=True).splitlines()
+        self.assertEqual(app.FETCH_SIZE, len(lines))
+        self.assertEqual(
+            self.get_events()[1:], [json.loads(line) for line in lines])
+        res = self.client.get('/events/TOKEN_B',
+                              headers={'Accept': app.NDJSON_MIMETYPE})
+        self.assertEqual(b'', res.data)
+
+    def test_migrations(self):
+        with app.app.app_context():
+            db = app.get_db()
+            self.assertEqual(
+                len(app.MIGRATIONS),
+                db.execute(app.USER_VERSION_PRAGMA).fetchone()[0])
+            plan = db.execute(
+                'explain query plan ' + app.DELETE_EVENTS_QUERY_TPL.format(
+                    table='events', where='token=?'), ('TOKEN_A', )).fetchall()
+        self.assertIn('events_token_idx', str(plan))
+        # applying the migrations again is a no-op
+        app.init_db()
+
+    def test_time_range(self):
+        self.post_events([benchmark.make_event('TOKEN_A', 's', i)
+                          for i in range(3)])
+        with app.app.app_context():
+            db = app.get_db()
+            db.execute('update events set date_created=? where _id=1',
+                       ('2019-01-01 10:00:00', ))
+            db.commit()
+        self.assertEqual(
+            1, len(self.get_events('TOKEN_A?until=2019-01-01T10:00:00')))
+        self.assertEqual(2, len(self.get_events('TOKEN_A?since=1546340401')))
+        self.assertEqual(
+            400, self.client.get('/events/?since=yesterday').status_code)
+        res = self.client.delete(
+            '/events/?until=2019-01-02T00:00:00%2B02:00').get_json()
+        self.assertEqual(1, res['num_deleted_events'])
+        self.assertEqual(2, len(self.get_events('TOKEN_A')))
+
+    def test_gzip_form(self):
+        events = [benchmark.make_event('TOKEN_A', 's', i) for i in range(3)]
+        res = self.client.post(
+            '/track/', data=gzip.compress(
+                benchmark.encode_batch(events).encode()),
+            content_type='application/x-www-form-urlencoded',
+            headers={'Content-Encoding': 'gzip'})
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(3, len(self.get_events('TOKEN_A')))
+
+    def test_track_v2(self):
+        body = json.dumps(
+            [benchmark.make_event('TOKEN_A', 's', i) for i in range(3)]
+        ).encode()
+        for data, headers in [
+                (body, {}),
+                (gzip.compress(body), {'Content-Encoding': 'gzip'}),
+                (zlib.compress(body), {'Content-Encoding': 'deflate'})]:
+            res = self.client.post('/v2/track/', data=data, headers=headers,
+                                   content_type='application/json')
+            self.assertEqual(200, res.status_code)
+            self.assertEqual(b'0', res.data)
+        self.assertEqual(9, len(self.get_events('TOKEN_A')))
+
+    def test_bad_bodies(self):
+        body = gzip.compress(b'[]')
+        self.assertEqual(415, self.client.post(
+            '/v2/track/', data=body, headers={'Content-Encoding': 'br'}
+        ).status_code)
+        self.assertEqual(400, self.client.post(
+            '/v2/track/', data=body[:-4], headers={'Content-Encoding': 'gzip'}
+        ).status_code)
+        self.assertEqual(400, self.client.post(
+            '/v2/track/', data=b'{"event": "x"}').status_code)
+
+    def test_extracted_column_filters(self):
+        events = [benchmark.make_event('TOKEN_A', 's%d' % (i % 2), i,
+                                       event_type='TYPE_%d' % (i % 3))
+                  for i in range(1, 10)]
+        events[0]['properties']['message_index'] = 'not a number'
+        self.post_events(events)
+        self.assertEqual(
+            [3, 6, 9],
+            [e['data']['properties']['message_index']
+             for e in self.get_events('TOKEN_A?event=TYPE_0')])
+        self.assertEqual(
+            [4, 6], [e['data']['properties']['message_index']
+                     for e in self.get_events(
+                         '?session_id=s0&min_message_index=3'
+                         '&max_message_index=7')])
+        # values that don't convert to the column's type are stored as null
+        self.assertEqual(
+            [], self.get_events('?event=TYPE_1&max_message_index=1'))
+        self.assertEqual(
+            400, self.client.get('/events/?min_event=a').status_code)
+        self.assertEqual(
+            400, self.client.get('/events/?message_index=a').status_code)
+        res = self.client.delete('/events/TOKEN_A?event=TYPE_2').get_json()
+        self.assertEqual(3, res['num_deleted_events'])
+        with app.app.app_context():
+            plan = app.get_db().execute(
+                'explain query plan select _id from events where event=?',
+                ('TYPE_0', )).fetchall()
+        self.assertIn('events_event_idx', str(plan))
+
+    def test_extracted_columns_backfill(self):
+        app.app.config['EXTRACTED_COLUMNS'] = ['event']
+        app.init_db()
+        self.post_events([benchmark.make_event('TOKEN_A', 's', 7)])
+        app.app.config['EXTRACTED_COLUMNS'] = ['event', 'mp_lib']
+        app.init_db()
+        with app.app.app_context():
+            row = app.get_db().execute(
+                'select event, mp_lib from events').fetchone()
+        self.assertEqual(('EVENT_TYPE', 'iphone'), row)
+        self.assertEqual(1, len(self.get_events('?mp_lib=iphone')))
+
+    def test_invalid_extracted_columns(self):
+        for spec in ('limit', 'data', 'a-b', 'x:blob', 'count:integer',
+                     'timeout', 'verbose'):
+            with self.assertRaises(ValueError):
+                extraction.ExtractedColumn.parse(spec)
+
+    def test_connection_pool_reuse(self):
+        for i in range(5):
+            self.post_events([benchmark.make_event('TOKEN_A', 's', i)])
+        pool_stats = self.client.get('/stats/').get_json()['pool']
+        # the only connection is the one init_db opened
+        self.assertEqual(1, pool_stats['misses'])
+        self.assertEqual(5, pool_stats['hits'])
+        self.assertEqual(1, pool_stats['idle'])
+
+
+class WriteBehindTest(AppTestCase):
+    config = {'WRITE_BEHIND': True, 'WRITE_BEHIND_QUEUE_SIZE': 2}
+
+    def test_write_behind(self):
+        for i in range(10):
+            res = self.post_events([benchmark.make_event('TOKEN_A', 's', i)])
+            self.assertEqual(200, res.status_code)
+            app.writers[0].flush()
+        stats = self.client.get('/stats/').get_json()['write_behind']
+        self.assertEqual(10, stats['written'])
+        self.assertEqual(0, stats['depth'])
+        self.assertEqual(10, len(self.get_events('TOKEN_A')))
+
+    def test_delete_sees_queued_events(self):
+        app.writers[0].stop()
+        self.post_events([benchmark.make_event('TOKEN_A', 's', 1)])
+        app.writers[0].start()
+        res = self.client.delete('/events/TOKEN_A').get_json()
+        self.assertEqual(1, res['num_deleted_events'])
+
+    def test_backpressure_and_drain_on_stop(self):
+        # with the writer stopped nothing drains the queue
+        app.writers[0].stop()
+        for i in range(2):
+            res = self.post_events([benchmark.make_event('TOKEN_A', 's', i)])
+            self.assertEqual(200, res.status_code)
+        res = self.post_events([benchmark.make_event('TOKEN_A', 's', 2)])
+        self.assertEqual(503, res.status_code)
+        self.assertEqual('1', res.headers['Retry-After'])
+        self.assertEqual(
+            1, self.client.get('/stats/').get_json()['write_behind']['rejected'])
+        # stopping commits everything that was acknowledged
+        app.writers[0].start()
+        app.writers[0].stop()
+        self.assertEqual(2, len(self.get_events('TOKEN_A')))
+
+    def test_failed_batch_only_loses_itself(self):
+        writer = app.writers[0]
+        writer.stop()
+        # as many batches as the queue holds, written in one transaction
+        for token in ('TOKEN_A', 'TOKEN_BAD'):
+            self.post_events([benchmark.make_event(token, 's', 1)])
+        insert = writer.insert
+
+        def failing_insert(db, rows):
+            insert(db, rows)
+            if rows[0][0] == 'TOKEN_BAD':
+                raise RuntimeError('bad batch')
+        writer.insert = failing_insert
+        writer.start()
+        writer.flush()
+        self.assertEqual(1, len(self.get_events('TOKEN_A')))
+        self.assertEqual([], self.get_events('TOKEN_BAD'))
+        self.assertEqual(1, writer.stats()['failed'])
+
+    def test_wait_woken_by_writer(self):
+        poster = post_later([benchmark.make_event('TOKEN_A', 's', 1)])
+        start = time.monotonic()
+        res = self.client.get('/events/TOKEN_A/wait?timeout=10')
+        poster.join()
+        self.assertEqual(1, len(res.get_json()['events']))
+        self.assertLess(time.monotonic() - start, 5)
+
+
+def post_later(events, delay=0.2):
+    '''posts events from another thread, with a client of its own'''
+    def post():
+        app.app.test_client().post(
+            '/track/', data=benchmark.encode_batch(events),
+            content_type='application/x-www-form-urlencoded')
+    thread = threading.Timer(delay, post)
+    thread.start()
+    return thread
+
+
+def parse_sse(body):
+    return [dict(line.split(': ', 1) for line in message.splitlines())
+            for message in body.split('\n\n')
+            if message and not message.startswith(':')]
+
+
+class WaitTest(AppTestCase):
+
+    def test_wait_returns_received_events(self):
+        self.post_events([benchmark.make_event('TOKEN_A', 's', i)
+                          for i in range(2)])
+        res = self.client.get('/events/TOKEN_A/wait?count=2')
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(2, len(res.get_json()['events']))
+
+    def test_wait_blocks_until_events_arrive(self):
+        self.post_events([benchmark.make_event('TOKEN_A', 's', 1)])
+        poster = post_later([benchmark.make_event('TOKEN_A', 's', i)
+                             for i in range(2, 4)])
+        start = time.monotonic()
+        res = self.client.get('/events/TOKEN_A/wait?count=3&timeout=10')
+        elapsed = time.monotonic() - start
+        poster.join()
+        self.assertEqual(3, len(res.get_json()['events']))
+        self.assertGreaterEqual(elapsed, 0.1)
+        self.assertLess(elapsed, 5)
+
+    def test_wait_timeout(self):
+        self.post_events([benchmark.make_event('TOKEN_A', 's', 1)])
+        start = time.monotonic()
+        res = self.client.get('/events/TOKEN_A/wait?count=2&timeout=0.3')
+        self.assertGreaterEqual(time.monotonic() - start, 0.3)
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(1, len(res.get_json()['events']))
+
+    def test_wait_does_not_hold_connections(self):
+        app.app.config['POOL_SIZE'] = 1
+        app.init_db()
+        poster = post_later([benchmark.make_event('TOKEN_A', 's', 1)])
+        start = time.monotonic()
+        res = self.client.get('/events/TOKEN_A/wait?timeout=10')
+        poster.join()
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(1, len(res.get_json()['events']))
+
+    def test_bad_arguments(self):
+        for query in ('count=0', 'timeout=-1', 'timeout=x',
+                      'timeout=100000'):
+            res = self.client.get('/events/TOKEN_A/wait?%s' % query)
+            self.assertEqual(400, res.status_code, query)
+        res = self.client.get('/events/TOKEN_A/stream?count=0')
+        self.assertEqual(400, res.status_code)
+
+    def test_stream(self):
+        self.post_events([benchmark.make_event('TOKEN_A', 's', i)
+                          for i in range(2)])
+        self.post_events([benchmark.make_event('TOKEN_B', 's', 0)])
+        poster = post_later([benchmark.make_event('TOKEN_A', 's', 2)])
+        res = self.client.get('/events/TOKEN_A/stream?count=3&timeout=10')
+        self.assertEqual('text/event-stream', res.mimetype)
+        messages = parse_sse(res.get_data(as_text=True))
+        poster.join()
+        self.assertEqual(
+            [0, 1, 2], [json.loads(m['data'])['data']['properties']
+                        ['message_index'] for m in messages])
+        self.assertEqual([json.loads(m['data'])['_id'] for m in messages],
+                         [int(m['id']) for m in messages])
+
+        # resuming after the last event received
+        res = self.client.get('/events/TOKEN_A/stream?timeout=0', headers={
+            'Last-Event-ID': messages[1]['id']})
+        self.assertEqual([messages[2]['id']],
+                         [m['id'] for m in
+                          parse_sse(res.get_data(as_text=True))])
+
+
+class ShardedTest(AppTestCase):
+    config = {'SHARDS': 3}
+
+    def test_sharded_events(self):
+        tokens = ['TOKEN_%d' % i for i in range(10)]
+        self.post_events([benchmark.make_event(token, 's', i)
+                          for i, token in enumerate(tokens)])
+        self.assertEqual(3, len(set(app.shard_of(t) for t in tokens)))
+        for shard in range(3):
+            self.assertTrue(os.path.exists(os.path.join(
+                self.tmp_dir, 'test.shard%d.db' % shard)))
+        received = self.get_events()
+        ids = [e['_id'] for e in received]
+        self.assertEqual(sorted(set(ids)), ids)
+        self.assertEqual(set(tokens), set(e['token'] for e in received))
+
+        page = self.get_events('?limit=4&after=%d' % ids[2])
+        self.assertEqual(ids[3:7], [e['_id'] for e in page])
+        self.assertEqual(['TOKEN_5'],
+                         [e['token'] for e in self.get_events('TOKEN_5')])
+
+        res = self.client.delete('/events/TOKEN_5').get_json()
+        self.assertEqual(1, res['num_deleted_events'])
+        res = self.client.delete('/events/').get_json()
+        self.assertEqual(9, res['num_deleted_events'])
+        stats = self.client.get('/stats/').get_json()
+        self.assertEqual(3, len(stats['shards']))
+        self.assertEqual(
+            stats['pool']['misses'],
+            sum(s['pool']['misses'] for s in stats['shards']))
+
+
+class LogStorageTest(AppTestCase):
+    config = {'STORAGE': 'log', 'LOG_SEGMENT_SIZE': 4096}
+
+    def message_indexes(self, query=''):
+        return [e['data']['properties']['message_index']
+                for e in self.get_events(query)]
+
+    def test_http_api(self):
+        self.post_events([benchmark.make_event(
+            'TOKEN_%d' % (i % 2), 's', i, event_type='TYPE_%d' % (i % 3))
+            for i in range(60)])
+        self.assertEqual(60, len(self.get_events()))
+        page = self.get_events('TOKEN_0?limit=3')
+        self.assertEqual([0, 2, 4], [e['data']['properties']['message_index']
+                                     for e in page])
+        self.assertEqual([6, 8], self.message_indexes(
+            'TOKEN_0?limit=2&after=%d' % page[-1]['_id']))
+        self.assertEqual([0, 6, 12], self.message_indexes(
+            'TOKEN_0?event=TYPE_0&max_message_index=12'))
+        self.assertEqual([], self.get_events('?since=4102444800'))
+        res = self.client.get('/events/TOKEN_1?format=ndjson')
+        self.assertEqual(30, len(res.get_data(as_text=True).splitlines()))
+        res = self.client.get('/events/TOKEN_1/wait?count=30&timeout=0')
+        self.assertEqual(30, len(res.get_json()['events']))
+
+        res = self.client.delete('/events/TOKEN_1?event=TYPE_1').get_json()
+        self.assertEqual(10, res['num_deleted_events'])
+        self.assertEqual(20, len(self.get_events('TOKEN_1')))
+        stats = self.client.get('/stats/').get_json()
+        self.assertEqual('log', stats['storage'])
+        self.assertEqual(50, stats['events'])
+        self.assertGreater(stats['segments'], 1)
+        res = self.client.delete('/events/').get_json()
+        self.assertEqual(50, res['num_deleted_events'])
+        self.assertEqual([], self.get_events())
+
+    def test_deleted_ids_are_skipped(self):
+        self.post_events([benchmark.make_event('TOKEN_%d' % (i % 4), 's', i)
+                          for i in range(40)])
+        self.client.delete('/events/TOKEN_1')
+        store = app.get_store()
+        # the other tokens' ids are left alone, and readers skip the deleted
+        # ones until they are half of all_ids
+        self.assertEqual(40, len(store.all_ids))
+        self.assertEqual(10, store.stale_ids)
+        self.assertEqual(30, len(self.get_events()))
+        self.assertEqual(list(range(2, 40, 4)), self.message_indexes(
+            'TOKEN_2'))
+        after = self.get_events()[10]['_id']
+        self.assertEqual(19, len(self.get_events('?after=%d' % after)))
+        self.assertEqual(19, store.count(app.storage.EventFilter(), after))
+        self.assertEqual(30, store.count(app.storage.EventFilter()))
+        self.client.delete('/events/TOKEN_2')
+        self.assertEqual(20, len(store.all_ids))
+        self.assertEqual(0, store.stale_ids)
+        self.assertEqual(['TOKEN_0', 'TOKEN_3'], sorted(store.token_ids))
+
+    def test_reopen(self):
+        self.post_events([benchmark.make_event('TOKEN_%d' % (i % 2), 's', i)
+                          for i in range(40)])
+        self.client.delete('/events/TOKEN_1')
+        before = self.get_events()
+        app.close_db()
+        app.init_db()
+        self.assertEqual(before, self.get_events())
+        self.post_events([benchmark.make_event('TOKEN_1', 's', 40)])
+        self.assertGreater(self.get_events('TOKEN_1')[0]['_id'],
+                           before[-1]['_id'])
+
+    def test_torn_record_is_truncated(self):
+        self.post_events([benchmark.make_event('TOKEN_A', 's', i)
+                          for i in range(3)])
+        app.close_db()
+        log_dir = app.app.config['LOG_DIRECTORY']
+        last_segment = sorted(
+            f for f in os.listdir(log_dir) if f.endswith('.log'))[-1]
+        with open(os.path.join(log_dir, last_segment), 'ab') as f:
+            f.write(b'\x40\x00\x00\x00partial')
+        app.init_db()
+        self.assertEqual([0, 1, 2], self.message_indexes('TOKEN_A'))
+        self.assertEqual(
+            11, self.client.get('/stats/').get_json()['truncated_bytes'])
+
+    def test_compaction(self):
+        # a batch is written to a single segment
+        for start in range(0, 80, 8):
+            self.post_events([
+                benchmark.make_event('TOKEN_%d' % (i % 4), 's', i)
+                for i in range(start, start + 8)])
+        before = self.client.get('/stats/').get_json()
+        for token in ('TOKEN_0', 'TOKEN_1', 'TOKEN_2'):
+            self.client.delete('/events/' + token)
+        # deletes wake the compaction thread up, which may have beaten this
+        app.get_store().compact()
+        after = self.client.get('/stats/').get_json()
+        self.assertGreater(after['compactions'], 0)
+        self.assertLess(after['bytes'], before['bytes'] / 2)
+        self.assertEqual(list(range(3, 80, 4)),
+                         self.message_indexes('TOKEN_3'))
+        # the tombstones still hide whatever compaction didn't remove
+        app.close_db()
+        app.init_db()
+        self.assertEqual(list(range(3, 80, 4)), self.message_indexes())
+
+    def test_group_sync(self):
+        app.app.config['LOG_SYNC'] = 'group'
+        app.init_db()
+        threads = [post_later([benchmark.make_event('TOKEN_A', 's', i)], 0)
+                   for i in range(5)]
+        for thread in threads:
+            thread.join()
+        self.assertEqual(5, len(self.get_events('TOKEN_A')))
+        self.assertGreater(
+            self.client.get('/stats/').get_json()['fsyncs'], 0)
+
+
+class PartitionTest(AppTestCase):
+    config = {'PARTITION': 'hour'}
+
+    def insert_at(self, hours_ago, message_indexes):
+        """
+        inserts events as if received hours_ago, two minutes into the hour
+        """
+        t = time.time() // 3600 * 3600 - hours_ago * 3600 + 120
+        columns = app.extracted_columns.values()
+        rows = []
+        for i in message_indexes:
+            e = benchmark.make_event('TOKEN_A', 's', i)
+            rows.append(extraction.make_row(
+                'TOKEN_A', json.dumps(e), e, columns))
+        with app.app.app_context():
+            db = app.get_db()
+            db.execute(app.BEGIN_IMMEDIATE)
+            table = app.partitions[0].insert_table(db, t)
+            db.executemany(extraction.insert_query(columns, table), rows)
+            db.execute('update %s set date_created=?;' % table,
+                       (partitioning.format_time(t), ))
+            db.commit()
+
+    def message_indexes(self, query):
+        return [e['data']['properties']['message_index']
+                for e in self.get_events(query)]
+
+    def partition_starts(self):
+        with app.app.app_context():
+            return list(app.partitions[0].starts_of(app.get_db()))
+
+    def test_partitions(self):
+        self.insert_at(3, [0, 1])
+        self.insert_at(2, [2])
+        self.post_events([benchmark.make_event('TOKEN_A', 's', 3)])
+        self.assertEqual(3, len(self.partition_starts()))
+        events = self.get_events('TOKEN_A')
+        self.assertEqual([0, 1, 2, 3], [
+            e['data']['properties']['message_index'] for e in events])
+        self.assertEqual(sorted(e['_id'] for e in events),
+                         [e['_id'] for e in events])
+        self.assertEqual([2, 3], self.message_indexes(
+            'TOKEN_A?after=%d&limit=2' % events[1]['_id']))
+        # the oldest partition is left out
+        since = self.partition_starts()[1] + partitioning.SLACK
+        self.assertEqual([2, 3], self.message_indexes(
+            'TOKEN_A?since=%d' % since))
+        with app.app.app_context():
+            self.assertEqual(3, len(app.partitions[0].tables(
+                app.get_db(), partitioning.format_time(since))))
+        res = self.client.get('/events/TOKEN_A/wait?count=4&timeout=0')
+        self.assertEqual(4, len(res.get_json()['events']))
+        with app.app.app_context():
+            self.assertEqual([(0, 4)], app.get_store().sizes())
+
+        retention = partitioning.Retention(
+            app.get_pools(), app.partitions, 7200)
+        retention.run_once(now=time.time() + 3600)
+        self.assertEqual([2, 3], self.message_indexes('TOKEN_A'))
+        self.assertEqual(2, len(self.partition_starts()))
+        stats = retention.stats()
+        self.assertEqual(1, stats['dropped_partitions'])
+        self.assertGreater(stats['vacuumed_pages'], 0)
+        with app.app.app_context():
+            db = app.get_db()
+            self.assertEqual(0, db.execute(
+                partitioning.FREELIST_COUNT_PRAGMA).fetchone()[0])
+            self.assertEqual(partitioning.AUTO_VACUUM_INCREMENTAL, db.execute(
+                partitioning.AUTO_VACUUM_PRAGMA).fetchone()[0])
+
+        # deleting every event drops every partition; _ids aren't reused
+        res = self.client.delete('/events/').get_json()
+        self.assertEqual(2, res['num_deleted_events'])
+        self.assertEqual([], self.partition_starts())
+        self.post_events([benchmark.make_event('TOKEN_A', 's', 4)])
+        self.assertGreater(self.get_events('TOKEN_A')[0]['_id'],
+                           events[-1]['_id'])
+
+    def test_events_inserted_while_deleting_are_kept(self):
+        self.insert_at(1, [0, 1])
+        self.post_events([benchmark.make_event('TOKEN_A', 's', 2)])
+        partitions = app.partitions[0]
+        drop = partitions.drop
+        poster = []
+
+        def drop_while_posting(db, tables):
+            # waits for the write lock, held until the drop commits
+            poster.append(post_later(
+                [benchmark.make_event('TOKEN_A', 's', 3)], delay=0))
+            time.sleep(0.2)
+            drop(db, tables)
+        partitions.drop = drop_while_posting
+        try:
+            res = self.client.delete('/events/').get_json()
+        finally:
+            partitions.drop = drop
+        poster[0].join()
+        self.assertEqual(3, res['num_deleted_events'])
+        self.assertEqual([3], self.message_indexes('TOKEN_A'))
+
+    def test_delete_and_write_behind(self):
+        app.app.config['WRITE_BEHIND'] = True
+        app.init_db()
+        self.insert_at(1, [0, 1])
+        self.post_events([benchmark.make_event('TOKEN_A', 's', i)
+                          for i in range(2, 6)])
+        app.get_store().flush()
+        self.assertEqual(2, len(self.partition_starts()))
+        self.assertEqual(list(range(6)), self.message_indexes('TOKEN_A'))
+        res = self.client.delete(
+            '/events/TOKEN_A?min_message_index=1&max_message_index=4')
+        self.assertEqual(4, res.get_json()['num_deleted_events'])
+        self.assertEqual([0, 5], self.message_indexes('TOKEN_A'))
+
+
+class HotCacheTest(AppTestCase):
+    config = {'HOT_CACHE_BYTES': 1024 * 1024, 'SHARDS': 2}
+
+    def post_tokens(self, num_events, first_index=0):
+        self.post_events([
+            benchmark.make_event('TOKEN_%d' % (i % 3), 's', i)
+            for i in range(first_index, first_index + num_events)])
+
+    def assert_cached(self, query):
+        hits = app.event_cache.stats()['hits']
+        cached = self.client.get('/events/%s' % query).data
+        self.assertEqual(hits + 1, app.event_cache.stats()['hits'])
+        event_cache, app.event_cache = app.event_cache, None
+        try:
+            self.assertEqual(self.client.get('/events/%s' % query).data,
+                             cached)
+        finally:
+            app.event_cache = event_cache
+        return cached
+
+    def test_served_from_cache(self):
+        self.post_tokens(30)
+        self.post_tokens(30, 30)
+        self.assertEqual(20, len(json.loads(
+            self.assert_cached('TOKEN_1'))['events']))
+        page = json.loads(self.assert_cached('TOKEN_1?limit=3'))['events']
+        self.assertEqual([1, 4, 7], [e['data']['properties']['message_index']
+                                     for e in page])
+        self.assert_cached('TOKEN_1?limit=3&after=%d' % page[-1]['_id'])
+        self.assert_cached('TOKEN_2?format=ndjson')
+        self.assert_cached('TOKEN_0?after=1000000')
+        self.assertEqual(
+            {'tokens': 3, 'events': 60},
+            {key: app.event_cache.stats()[key]
+             for key in ('tokens', 'events')})
+        stats = app.event_cache.stats()
+        self.get_events('TOKEN_1?event=EVENT_TYPE')
+        self.get_events()
+        self.assertEqual(stats, app.event_cache.stats())
+
+    def test_earlier_events_are_not_cached(self):
+        self.post_tokens(6)
+        app.event_cache.invalidate()
+        self.post_tokens(6, 6)
+        misses = app.event_cache.stats()['misses']
+        events = self.get_events('TOKEN_0')
+        self.assertEqual(misses + 1, app.event_cache.stats()['misses'])
+        self.assertEqual([0, 3, 6, 9], [
+            e['data']['properties']['message_index'] for e in events])
+        self.assert_cached('TOKEN_0?after=%d' % events[1]['_id'])
+
+    def test_delete_invalidates(self):
+        self.post_tokens(9)
+        self.client.delete('/events/TOKEN_0')
+        self.assertEqual([], self.get_events('TOKEN_0'))
+        self.assertEqual(3, len(self.get_events('TOKEN_1')))
+        self.client.delete('/events/TOKEN_1?event=EVENT_TYPE')
+        self.assertEqual([], self.get_events('TOKEN_1'))
+        self.post_tokens(3, 9)
+        self.assertEqual(1, len(json.loads(
+            self.assert_cached('TOKEN_0'))['events']))
+        self.client.delete('/events/')
+        self.assertEqual({'tokens': 0, 'bytes': 0}, {
+            key: app.event_cache.stats()[key] for key in ('tokens', 'bytes')})
+
+    def test_write_behind(self):
+        app.app.config['WRITE_BEHIND'] = True
+        app.init_db()
+        self.post_tokens(30)
+        app.get_store().flush()
+        self.assertEqual(10, len(json.loads(
+            self.assert_cached('TOKEN_2'))['events']))
+
+    def test_rolled_back_events_are_not_cached(self):
+        self.post_tokens(3)
+        insert_rows = app.insert_rows
+        cached = []
+
+        def failing_insert(shard, db, rows):
+            insert_rows(shard, db, rows)
+            cached.append(app.event_cache.get('TOKEN_1'))
+            raise RuntimeError('rolled back')
+        app.insert_rows = failing_insert
+        try:
+            res = self.post_events([benchmark.make_event('TOKEN_1', 's', 3)])
+        finally:
+            app.insert_rows = insert_rows
+        self.assertEqual(500, res.status_code)
+        # not served while being inserted, nor after being rolled back
+        self.assertEqual(1, len(cached[0]))
+        self.assertIsNone(app.event_cache.get('TOKEN_1'))
+        self.post_tokens(3, 3)
+        self.assertEqual([1, 4], [e['data']['properties']['message_index']
+                                  for e in self.get_events('TOKEN_1')])
+
+    def test_eviction(self):
+        cache = hot_cache.HotCache(4 * (10 + hot_cache.EVENT_OVERHEAD))
+        cache.add('A', [(1, 'x' * 10), (2, 'x' * 10)], 0)
+        cache.add('B', [(3, 'x' * 10)], 0)
+        self.assertEqual(2, len(cache.get('A')))
+        cache.add('C', [(4, 'x' * 10), (5, 'x' * 10)], 0)
+        self.assertIsNone(cache.get('B'))
+        self.assertEqual(['x' * 10], cache.get('A', after=1))
+        cache.add('C', [(6, 'y' * 10), (7, 'y' * 10), (8, 'y' * 10),
+                        (9, 'y' * 10)])
+        self.assertIsNone(cache.get('A'))
+        self.assertIsNone(cache.get('C', after=4))
+        self.assertEqual(['y' * 10] * 2, cache.get('C', after=7))
+        self.assertEqual(
+            {'tokens': 1, 'events': 4, 'evicted_tokens': 2,
+             'trimmed_events': 2},
+            {key: cache.stats()[key] for key in (
+                'tokens', 'events', 'evicted_tokens', 'trimmed_events')})
+        # added out of order
+        cache.add('C', [(8, 'z')])
+        self.assertIsNone(cache.get('C', after=9))
+
+
+class RollupsTest(AppTestCase):
+    config = {'ROLLUPS': True}
+
+    def setUp(self):
+        super().setUp()
+        # the start of an hour, an hour ago
+        self.hour = int(time.time()) // 3600 * 3600 - 3600
+
+    def event_at(self, token, minute, index, event_type='EVENT_TYPE',
+                 duration=None):
+        event = benchmark.make_event(token, 's', index, event_type)
+        event['properties']['time'] = self.hour + 60 * minute + 1
+        if duration is not None:
+            event['properties']['$duration'] = duration
+        return event
+
+    def post_minutes(self):
+        self.post_events(
+            [self.event_at('TOKEN_A', 0, i) for i in range(3)] +
+            [self.event_at('TOKEN_A', 0, 3, 'TIMED', 0.5),
+             self.event_at('TOKEN_A', 1, 4, 'TIMED', 1.5),
+             self.event_at('TOKEN_A', 1, 5, 'TIMED', 2.5),
+             self.event_at('TOKEN_B', 2, 6)])
+
+    def get_rollups(self, query=''):
+        return self.client.get('/rollups/TOKEN_A%s' % query).get_json()
+
+    def test_counts_per_bucket_and_type(self):
+        self.post_minutes()
+        result = self.get_rollups()
+        self.assertEqual(60, result['bucket'])
+        self.assertEqual(
+            [(self.hour, 'EVENT_TYPE', 3, None),
+             (self.hour, 'TIMED', 1, 1),
+             (self.hour + 60, 'TIMED', 2, 2)],
+            [(r['start'], r['event'], r['count'],
+              r.get('duration', {}).get('count'))
+             for r in result['rollups']])
+        self.assertEqual(
+            {'count': 2, 'sum': 4.0},
+            {key: result['rollups'][2]['duration'][key]
+             for key in ('count', 'sum')})
+        self.assertEqual(1, len(self.client.get(
+            '/rollups/TOKEN_B').get_json()['rollups']))
+
+    def test_coarser_buckets_and_percentiles(self):
+        self.post_minutes()
+        result = self.get_rollups('?bucket=3600&event=TIMED&'
+                                  'percentiles=0,50,100')
+        self.assertEqual(1, len(result['rollups']))
+        duration = result['rollups'][0]['duration']
+        self.assertEqual(3, duration['count'])
+        for p, expected in (('p0', 0.5), ('p50', 1.5), ('p100', 2.5)):
+            self.assertAlmostEqual(
+                expected, duration[p],
+                delta=expected * rollups.RELATIVE_ACCURACY)
+        self.assertEqual(400, self.client.get(
+            '/rollups/TOKEN_A?bucket=90').status_code)
+        self.assertEqual(400, self.client.get(
+            '/rollups/TOKEN_A?percentiles=101').status_code)
+
+    def test_since_and_until(self):
+        self.post_minutes()
+        result = self.get_rollups('?since=%d&until=%d' % (
+            self.hour + 60, self.hour + 60))
+        self.assertEqual([(self.hour + 60, 'TIMED')], [
+            (r['start'], r['event']) for r in result['rollups']])
+
+    def test_rebuild(self):
+        self.post_minutes()
+        incremental = self.get_rollups()
+        app.event_rollups.forget()
+        self.assertEqual([], self.get_rollups()['rollups'])
+        result = self.client.post('/rollups/rebuild').get_json()
+        self.assertEqual(7, result['num_events'])
+        self.assertEqual(incremental, self.get_rollups())
+
+    def test_rebuild_keeps_max_age(self):
+        self.post_minutes()
+        event_rollups = app.event_rollups
+        self.assertEqual(7, event_rollups.stats()['events'])
+        # expires the buckets of minutes 0 and 1
+        event_rollups.max_age = 60
+        event_rollups.add([('TOKEN_C', None, self.event_at('TOKEN_C', 3, 0))])
+        self.assertEqual(2, event_rollups.stats()['events'])
+        self.client.post('/rollups/rebuild?token=TOKEN_A')
+        self.assertEqual([], self.get_rollups()['rollups'])
+        self.assertEqual(2, event_rollups.stats()['events'])
+        # TOKEN_C's event was never stored
+        self.client.post('/rollups/rebuild')
+        self.assertEqual({'tokens': 1, 'events': 1}, {
+            key: event_rollups.stats()[key] for key in ('tokens', 'events')})
+
+    def test_delete(self):
+        self.post_minutes()
+        self.client.delete('/events/TOKEN_A?event=TIMED')
+        self.assertEqual(['EVENT_TYPE'], [
+            r['event'] for r in self.get_rollups()['rollups']])
+        self.client.delete('/events/TOKEN_A')
+        self.assertEqual([], self.get_rollups()['rollups'])
+        self.assertEqual(1, len(self.client.get(
+            '/rollups/TOKEN_B').get_json()['rollups']))
+
+    def test_disabled(self):
+        app.app.config['ROLLUPS'] = False
+        app.init_db()
+        self.assertEqual(404, self.client.get('/rollups/TOKEN_A').status_code)
+
+
+class ValidationTest(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.rejected_before = {
+            name: app.events_rejected.value(name)
+            for name in ('token', 'properties')}
+
+    def test_valid_subset_is_stored(self):
+        events = [benchmark.make_event('TOKEN_A', 's', i) for i in range(5)]
+        del events[1]['properties']['token']
+        events[2]['properties']['$screen_height'] = '667'
+        events[3]['properties'] = 'not an object'
+        res = self.client.post('/v2/track/', data=json.dumps(events),
+                               content_type='application/json')
+        self.assertEqual(200, res.status_code)
+        self.assertEqual({
+            'status': 0,
+            'accepted': 2,
+            'rejected': [
+                {'index': 1, 'property': 'token', 'error': 'is required'},
+                {'index': 2, 'property': '$screen_height',
+                 'error': 'must be a number'},
+                {'index': 3, 'property': 'properties',
+                 'error': 'must be an object'},
+            ]}, res.get_json())
+        self.assertEqual([0, 4], [e['data']['properties']['message_index']
+                                  for e in self.get_events('TOKEN_A')])
+        self.assertEqual(1, app.events_rejected.value('properties') -
+                         self.rejected_before.get('properties', 0))
+
+    def test_verbose(self):
+        body = json.dumps([benchmark.make_event('TOKEN_A', 's', 1),
+                           benchmark.make_event('', 's', 2)])
+        res = self.client.post('/v2/track/?verbose=1', data=body,
+                               content_type='application/json')
+        self.assertEqual(
+            {'status': 0, 'accepted': 1, 'rejected': [
+                {'index': 1, 'property': 'token',
+                 'error': 'must not be empty'}]}, res.get_json())
+        res = self.post_events([benchmark.make_event('TOKEN_A', 's', 3)])
+        self.assertEqual(b'0', res.data)
+
+    def test_strict_schema(self):
+        event = benchmark.make_event('TOKEN_A', 's', 1)
+        del event['properties']['$os']
+        del event['properties']['session_id']
+        self.assertEqual(b'0', self.post_events([event]).data)
+        app.app.config['STRICT_SCHEMA'] = True
+        app.init_db()
+        self.assertEqual(
+            [{'index': 0, 'property': '$os', 'error': 'is required'}],
+            self.post_events([event]).get_json()['rejected'])
+
+    def test_schema_types(self):
+        schema = validation.Schema()
+        events = [{'properties': {'token': 'T', 'message_index': value}}
+                  for value in (1, 1.0, True, None, '1')]
+        events.append({'event': 1, 'properties': {'token': 'T'}})
+        events.append([])
+        self.assertEqual(
+            [None, ('message_index', 'must be an integer'),
+             ('message_index', 'must be an integer'), None,
+             ('message_index', 'must be an integer'),
+             ('event', 'must be a string'),
+             ('properties', 'must be an object')],
+            schema.validate(events))
+
+
+class DedupTest(AppTestCase):
+    config = {'DEDUP': True}
+
+    def test_retried_batch_is_dropped(self):
+        duplicates = app.events_duplicate.value()
+        events = [benchmark.make_event('TOKEN_A', 's', i) for i in range(5)]
+        self.assertEqual(200, self.post_events(events).status_code)
+        # resent along with new events, as flushQueue: does after a failure
+        more = [benchmark.make_event('TOKEN_A', 's', i) for i in range(5, 8)]
+        self.assertEqual(200, self.post_events(events + more).status_code)
+        self.assertEqual(list(range(8)), [
+            e['data']['properties']['message_index']
+            for e in self.get_events('TOKEN_A')])
+        # the same indexes of another session, or token, are other events
+        self.post_events([benchmark.make_event('TOKEN_A', 's2', 1),
+                          benchmark.make_event('TOKEN_B', 's', 1)])
+        self.assertEqual(10, len(self.get_events()))
+        stats = self.client.get('/stats/').get_json()['dedup']
+        self.assertEqual(5, stats['duplicates'])
+        self.assertEqual(5, app.events_duplicate.value() - duplicates)
+        body = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('events_duplicate_ratio 0.333', body)
+
+    def test_events_without_keys_are_kept(self):
+        event = benchmark.make_event('TOKEN_A', 's', 1)
+        del event['properties']['message_index']
+        self.post_events([event])
+        self.post_events([event])
+        self.assertEqual(2, len(self.get_events('TOKEN_A')))
+
+    def test_rejected_batch_may_be_retried(self):
+        app.app.config.update(WRITE_BEHIND=True, WRITE_BEHIND_QUEUE_SIZE=1)
+        app.init_db()
+        app.writers[0].stop()
+        self.post_events([benchmark.make_event('TOKEN_A', 's', 1)])
+        retried = [benchmark.make_event('TOKEN_A', 's', 2)]
+        self.assertEqual(503, self.post_events(retried).status_code)
+        app.writers[0].start()
+        app.writers[0].flush()
+        self.assertEqual(200, self.post_events(retried).status_code)
+        app.writers[0].flush()
+        self.assertEqual(2, len(self.get_events('TOKEN_A')))
+
+    def test_batch_failing_to_store_may_be_retried(self):
+        store = app.get_store()
+        append = store.append
+
+        def failing_append(batch):
+            raise OSError('disk I/O error')
+        store.append = failing_append
+        events = [benchmark.make_event('TOKEN_A', 's', 1)]
+        try:
+            self.assertEqual(500, self.post_events(events).status_code)
+        finally:
+            store.append = append
+        self.assertEqual(200, self.post_events(events).status_code)
+        self.assertEqual(1, len(self.get_events('TOKEN_A')))
+
+    def test_batch_dropped_by_writer_may_be_retried(self):
+        app.app.config.update(WRITE_BEHIND=True)
+        app.init_db()
+        writer = app.writers[0]
+        insert = writer.insert
+
+        def failing_insert(db, rows):
+            raise RuntimeError('bad batch')
+        writer.insert = failing_insert
+        events = [benchmark.make_event('TOKEN_A', 's', 1)]
+        self.post_events(events)
+        writer.flush()
+        self.assertEqual(1, writer.stats()['failed'])
+        writer.insert = insert
+        self.post_events(events)
+        writer.flush()
+        self.assertEqual(1, len(self.get_events('TOKEN_A')))
+
+    def test_eviction(self):
+        deduplicator = dedup.Deduplicator(max_keys=2, max_age=60)
+        batch = [('T', None, benchmark.make_event('T', 's', i))
+                 for i in range(3)]
+        kept, keys = deduplicator.filter(batch)
+        self.assertEqual(3, len(kept))
+        self.assertEqual({'keys': 2, 'received': 3, 'duplicates': 0,
+                          'evicted': 1, 'expired': 0}, deduplicator.stats())
+        # the oldest key was evicted, so only its event is taken as new
+        self.assertEqual(1, len(deduplicator.filter(batch[:2])[0]))
+        deduplicator.max_age = 0
+        deduplicator.filter([])
+        self.assertEqual(0, deduplicator.stats()['keys'])
+
+
+class ExportTest(AppTestCase):
+
+    def export(self, event_filter=None):
+        path = os.path.join(self.tmp_dir, 'events.ndjson')
+        with app.app.app_context():
+            event_export.export_events(app.get_store(), path, event_filter)
+        return event_export.Export(path)
+
+    def post(self, body):
+        return self.client.post(
+            '/track/', data=body,
+            content_type='application/x-www-form-urlencoded').status_code
+
+    def test_export(self):
+        self.post_events([benchmark.make_event('TOKEN_%d' % (i % 2), 's', i)
+                          for i in range(5)])
+        stored = self.get_events()
+        with self.export() as export:
+            self.assertEqual(5, len(export))
+            self.assertEqual([e['_id'] for e in stored], list(export.ids))
+            self.assertEqual(stored[3]['data'], json.loads(export.event(3)))
+            self.assertEqual([e['data'] for e in stored[1:4]],
+                             json.loads(export.events(1, 4)))
+            self.assertAlmostEqual(time.time(), export.times[0], delta=5)
+        with open(os.path.join(self.tmp_dir, 'events.ndjson')) as f:
+            self.assertEqual([e['data'] for e in stored],
+                             [json.loads(line) for line in f])
+        with self.export(app.storage.EventFilter('TOKEN_1')) as export:
+            self.assertEqual(2, len(export))
+
+    def test_run_export(self):
+        app.app.config.update(SHARDS=2, PARTITION='hour')
+        app.init_db()
+        self.post_events([benchmark.make_event('TOKEN_%d' % i, 's', i)
+                          for i in range(6)])
+        stored = self.get_events()
+        self.assertEqual(2, len({e['_id'] % 2 for e in stored}))
+        app.close_db()
+        app.app.config.update(SHARDS=1, PARTITION='none',
+                              EXTRACTED_COLUMNS='')
+
+        def digests():
+            digest = {}
+            # reading a wal database may add its -wal and -shm files
+            for name in os.listdir(self.tmp_dir):
+                if not name.endswith('.db'):
+                    continue
+                with open(os.path.join(self.tmp_dir, name), 'rb') as f:
+                    digest[name] = hashlib.sha256(f.read()).hexdigest()
+            return digest
+        before = digests()
+        path = os.path.join(self.tmp_dir, 'events.ndjson')
+        self.assertEqual(6, event_export.run_export(argparse.Namespace(
+            path=path, storage='sqlite', db=app.app.config['DATABASE'],
+            log_dir=app.app.config['LOG_DIRECTORY'], token=None, since=None,
+            until=None)))
+        # neither migrated nor altered
+        self.assertEqual(before, digests())
+        with event_export.Export(path) as export:
+            self.assertEqual([e['_id'] for e in stored], list(export.ids))
+
+    def test_empty_export(self):
+        with self.export() as export:
+            self.assertEqual(0, len(export))
+            report = event_export.replay(export, self.post)
+        self.assertEqual(0, report.summary()['batches'])
+
+    def test_replay(self):
+        events = [benchmark.make_event('TOKEN_A', 's', i) for i in range(10)]
+        self.post_events(events)
+        export = self.export()
+        self.client.delete('/events/')
+        report = event_export.replay(export, self.post, batch_size=4,
+                                     rate=200)
+        export.close()
+        summary = report.summary()
+        self.assertEqual(10, summary['sent_events'])
+        self.assertEqual(3, summary['batches'])
+        self.assertEqual(0, summary['rejected_batches'])
+        # the last batch starts after 8 events, at 200 events per second
+        self.assertGreaterEqual(summary['elapsed'], 0.04)
+        self.assertEqual([e['properties'] for e in events],
+                         [e['data']['properties'] for e in self.get_events()])
+
+    def test_replay_by_time(self):
+        self.post_events([benchmark.make_event('TOKEN_A', 's', i)
+                          for i in range(3)])
+        with self.export() as export:
+            self.assertEqual([(0, 3)],
+                             list(event_export.iter_batches(export, 50, True)))
+            report = event_export.replay(export, self.post, speed=10)
+        self.assertEqual(1, report.summary()['batches'])
+
+
+class AsyncServerTestCase(AppTestCase):
+    executor_threads = 4
+    max_waiters = async_app.MAX_WAITERS
+
+    def setUp(self):
+        super().setUp()
+        self.server = async_app.AsyncServer(
+            app.app, '127.0.0.1', 0, self.executor_threads, self.max_waiters)
+        started = threading.Event()
+
+        def run():
+            async def serve():
+                serving = asyncio.ensure_future(self.server.serve())
+                while self.server.server is None:
+                    await asyncio.sleep(0.01)
+                started.set()
+                await serving
+            asyncio.run(serve())
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        started.wait()
+        self.conn = http.client.HTTPConnection(
+            '127.0.0.1', self.server.port, timeout=10)
+
+    def tearDown(self):
+        self.conn.close()
+        if not self.server.stopping.is_set():
+            self.server.shutdown()
+        self.thread.join()
+        self.server.shutdown_executors()
+        super().tearDown()
+
+    def request(self, method, path, body=None, headers={}):
+        self.conn.request(method, path, body, headers)
+        res = self.conn.getresponse()
+        return res, res.read()
+
+
+class AsyncServerTest(AsyncServerTestCase):
+
+    def test_same_contract_over_one_connection(self):
+        events = [benchmark.make_event('TOKEN_A', 's', i) for i in range(3)]
+        res, body = self.request(
+            'POST', '/track/', benchmark.encode_batch(events),
+            {'Content-Type': 'application/x-www-form-urlencoded'})
+        self.assertEqual((200, b'0'), (res.status, body))
+        res, body = self.request(
+            'POST', '/v2/track/',
+            gzip.compress(json.dumps(events).encode()),
+            {'Content-Encoding': 'gzip'})
+        self.assertEqual((200, b'0'), (res.status, body))
+
+        res, body = self.request('GET', '/events/TOKEN_A')
+        self.assertEqual('chunked', res.getheader('Transfer-Encoding'))
+        self.assertEqual(self.get_events('TOKEN_A'),
+                         json.loads(body)['events'])
+        self.assertEqual(6, len(json.loads(body)['events']))
+        res, body = self.request('DELETE', '/events/TOKEN_A')
+        self.assertEqual(
+            {'success': True, 'token': 'TOKEN_A', 'num_deleted_events': 6},
+            json.loads(body))
+        self.assertEqual(1, self.server.connections)
+        self.assertEqual(4, self.server.requests)
+
+        res, body = self.request('POST', '/kill')
+        self.assertEqual(b'Shutting down...\n', body)
+        self.thread.join(10)
+        self.assertFalse(self.thread.is_alive())
+
+    def test_bad_requests(self):
+        res, _ = self.request('POST', '/v2/track/', b'[]',
+                              {'Content-Length': 'x'})
+        self.assertEqual(400, res.status)
+        self.conn.close()
+        res, _ = self.request('GET', '/events/', None,
+                              {'X-Large': 'x' * async_app.MAX_LINE_SIZE})
+        self.assertEqual(431, res.status)
+
+
+class AsyncServerWaitTest(AsyncServerTestCase):
+    executor_threads = 1
+    max_waiters = 2
+
+    def test_waiters_dont_hold_the_executor(self):
+        def wait(path):
+            conn = http.client.HTTPConnection(
+                '127.0.0.1', self.server.port, timeout=10)
+            self.addCleanup(conn.close)
+            conn.request('GET', path)
+            return conn
+        waiting = [wait('/events/TOKEN_A/wait?timeout=5'),
+                   wait('/events/TOKEN_A/stream?count=1&timeout=5')]
+        deadline = time.monotonic() + 5
+        while self.server.waiters < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        res, _ = self.request('GET', '/events/TOKEN_A/wait?timeout=5')
+        self.assertEqual(503, res.status)
+        self.assertEqual('1', res.getheader('Retry-After'))
+        self.conn.close()
+
+        start = time.monotonic()
+        res, _ = self.request(
+            'POST', '/track/',
+            benchmark.encode_batch([benchmark.make_event('TOKEN_A', 's', 1)]),
+            {'Content-Type': 'application/x-www-form-urlencoded'})
+        self.assertEqual(200, res.status)
+        self.assertLess(time.monotonic() - start, 1)
+        res = waiting[0].getresponse()
+        self.assertEqual(1, len(json.loads(res.read())['events']))
+        res = waiting[1].getresponse()
+        self.assertIn(b'"TOKEN_A"', res.read())
+        self.assertLess(time.monotonic() - start, 2)
+
+
+class AloomaClientTest(AsyncServerTestCase):
+
+    def make_client(self, queue_dir=None, url=None, **kwargs):
+        client = alooma_client.Alooma(
+            'TOKEN_A', url or 'http://127.0.0.1:%d' % self.server.port,
+            queue_dir=queue_dir, **kwargs)
+        self.addCleanup(client.close, 10)
+        return client
+
+    def test_wire_format(self):
+        client = self.make_client()
+        client.register_super_properties({'super_prop': 1.5})
+        client.time_event('TIMED')
+        client.track('EVENT_TYPE', {'prop': 'value'})
+        client.track('TIMED', custom_event={'custom': True})
+        self.assertTrue(client.flush(10))
+        events = [e['data'] for e in self.get_events('TOKEN_A')]
+        self.assertEqual(['EVENT_TYPE', 'TIMED'], [e['event'] for e in events])
+        self.assertTrue(events[1]['custom'])
+        properties = events[0]['properties']
+        self.assertEqual(
+            {'token': 'TOKEN_A', 'session_id': client.session_id,
+             'distinct_id': client.distinct_id, 'message_index': 1,
+             'super_prop': 1.5, 'prop': 'value', 'mp_lib': 'python',
+             '$lib_version': alooma_client.LIB_VERSION},
+            {key: properties[key] for key in (
+                'token', 'session_id', 'distinct_id', 'message_index',
+                'super_prop', 'prop', 'mp_lib', '$lib_version')})
+        self.assertIsInstance(properties['sending_time'], int)
+        self.assertEqual(2, events[1]['properties']['message_index'])
+        self.assertIn('$duration', events[1]['properties'])
+        self.assertNotIn('$duration', properties)
+
+        # the body flushQueue:endpoint: sends
+        data = alooma_client.serialize_event({'properties': {
+            'sending_time': alooma_client.SENDING_TIME_PLACEHOLDER,
+            'date': datetime.datetime(
+                2019, 1, 1, 10, tzinfo=datetime.timezone.utc)}})
+        body = urllib.parse.parse_qs(alooma_client.encode_batch([data], 7))
+        self.assertEqual(['1'], body['ip'])
+        self.assertEqual(
+            [{'properties': {'sending_time': 7,
+                             'date': '2019-01-01T10:00:00.000Z'}}],
+            json.loads(base64.b64decode(body['data'][0])))
+
+    def test_adaptive_batches_over_pooled_connections(self):
+        sizer = alooma_client.BatchSizer(initial_bytes=4096, min_bytes=1024)
+        client = self.make_client(batch_sizer=sizer, max_connections=2)
+        for i in range(500):
+            client.track('EVENT_TYPE', {'i': i})
+        self.assertTrue(client.flush(10))
+        events = self.get_events('TOKEN_A')
+        self.assertEqual(list(range(1, 501)), sorted(
+            e['data']['properties']['message_index'] for e in events))
+        stats = client.stats()
+        self.assertEqual(500, stats['sent'])
+        self.assertGreater(stats['batches'], 1)
+        self.assertGreater(stats['batch_bytes'], 4096)
+        # the senders' connections, and the test's own
+        self.assertLessEqual(self.server.connections, 3)
+
+    def test_rejected_events(self):
+        client = self.make_client()
+        client.track('EVENT_TYPE')
+        client.track('EVENT_TYPE', {'message_index': 'not a number'})
+        self.assertTrue(client.flush(10))
+        self.assertEqual(1, len(self.get_events('TOKEN_A')))
+        self.assertEqual({'sent': 1, 'rejected': 1}, {
+            key: client.stats()[key] for key in ('sent', 'rejected')})
+
+    def test_gzipped_response(self):
+        class CollectorHandler(http.server.BaseHTTPRequestHandler):
+            # a collector that gzips its responses
+            def do_POST(self):
+                self.rfile.read(int(self.headers['Content-Length']))
+                response = gzip.compress(json.dumps(
+                    {'status': 0, 'rejected': [{'index': 0}]}).encode())
+                self.send_response(200)
+                self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+            def log_message(self, *args):
+                pass
+        collector = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), CollectorHandler)
+        threading.Thread(target=collector.serve_forever, daemon=True).start()
+        self.addCleanup(collector.server_close)
+        self.addCleanup(collector.shutdown)
+        client = self.make_client(
+            url='http://127.0.0.1:%d' % collector.server_address[1])
+        client.track('EVENT_TYPE')
+        self.assertTrue(client.flush(10))
+        self.assertEqual({'sent': 0, 'rejected': 1}, {
+            key: client.stats()[key] for key in ('sent', 'rejected')})
+
+    def test_queue_survives_restart(self):
+        queue_dir = os.path.join(self.tmp_dir, 'queue')
+        # nothing listens on port 1
+        client = self.make_client(queue_dir, url='http://127.0.0.1:1')
+        client.register_super_properties({'super_prop': 'kept'})
+        for _ in range(5):
+            client.track('EVENT_TYPE')
+        self.assertFalse(client.close(0.2))
+        self.assertGreater(client.stats()['retries'], 0)
+        session_id = client.session_id
+
+        client = self.make_client(queue_dir)
+        client.track('EVENT_TYPE')
+        self.assertTrue(client.flush(10))
+        events = [e['data']['properties'] for e in self.get_events('TOKEN_A')]
+        self.assertEqual([session_id] * 5 + [client.session_id],
+                         [e['session_id'] for e in events])
+        self.assertEqual(['kept'] * 6, [e['super_prop'] for e in events])
+        client.close(10)
+        self.assertEqual([], alooma_client.DiskQueue(queue_dir).open())
+
+    def test_disk_queue(self):
+        queue_dir = os.path.join(self.tmp_dir, 'queue')
+        queue = alooma_client.DiskQueue(queue_dir, segment_size=10)
+        queue.open()
+        self.assertEqual(1, queue.append([b'a', b'b']))
+        self.assertEqual(3, queue.append([b'c']))
+        self.assertEqual(4, queue.append([b'd']))
+        queue.ack(3)
+        # the first segment was full, and only held acknowledged events
+        self.assertEqual([3], queue.segments)
+        queue.close()
+        # a record torn by a crash
+        with open(queue._segment_path(queue.segments[-1]), 'ab') as f:
+            f.write(segment_log.encode_record(b'torn')[:-1])
+        queue = alooma_client.DiskQueue(queue_dir)
+        self.assertEqual([(4, b'd')], queue.open())
+        self.assertEqual(5, queue.append([b'e']))
+        queue.close()
+        self.assertEqual([(4, b'd'), (5, b'e')],
+                         alooma_client.DiskQueue(queue_dir).open())
+
+
+class KeepRawEventsTest(AppTestCase):
+    config = {'KEEP_RAW_EVENTS': True}
+
+    def test_events_stored_as_received(self):
+        body = '[ {"event": "a",  "properties": {"token": "TOKEN_A"}} ,' \
+               '{"properties": {"token": "TOKEN_A", "x": [1, 2.5]}}]'
+        res = self.client.post('/v2/track/', data=body)
+        self.assertEqual(200, res.status_code)
+        with app.app.app_context():
+            stored = [r[0] for r in app.get_db().execute(
+                'select data from events order by _id;')]
+        self.assertEqual(
+            ['{"event": "a",  "properties": {"token": "TOKEN_A"}}',
+             '{"properties": {"token": "TOKEN_A", "x": [1, 2.5]}}'],
+            stored)
+        self.assertEqual(json.loads(body),
+                         [e['data'] for e in self.get_events('TOKEN_A')])
+
+
+class LoadGeneratorTest(AppTestCase):
+
+    def make_post(self):
+        def post(body):
+            return self.client.post(
+                '/track/', data=body,
+                headers=load_generator.FORM_HEADERS).status_code
+        return post
+
+    def test_backlog_drain(self):
+        devices = load_generator.make_devices(3, num_tokens=3)
+        report = load_generator.run(self.make_post, devices, 'backlog',
+                                    concurrency=2, backlog=510)
+        summary = report.summary()
+        self.assertEqual(summary['dropped_events'], 30)
+        self.assertEqual(summary['sent_events'], 1500)
+        # every full queue is sent in batches of 50
+        self.assertEqual(summary['batches'], 30)
+        self.assertEqual(summary['rejected_batches'], 0)
+        for device in devices:
+            events = self.get_events(device.token)
+            self.assertEqual(
+                [e['data']['properties']['message_index'] for e in events],
+                list(range(11, 511)))
+            self.assertEqual(
+                {e['data']['properties']['session_id'] for e in events},
+                {device.session_id})
+            self.assertTrue(all(e['data']['properties']['sending_time']
+                                for e in events))
+
+    def test_steady(self):
+        devices = load_generator.make_devices(4)
+        report = load_generator.run(self.make_post, devices, 'steady',
+                                    concurrency=2, rate=400, duration=0.5,
+                                    flush_interval=0.1)
+        summary = report.summary()
+        self.assertGreater(summary['tracked_events'], 0)
+        self.assertEqual(summary['sent_events'], summary['tracked_events'])
+        self.assertEqual(len(self.get_events()), summary['sent_events'])
+
+    def test_network_failure_keeps_the_queue(self):
+        device = load_generator.Device('TOKEN_A')
+        report = load_generator.Report()
+        for _ in range(60):
+            device.track(report)
+
+        def failing_post(body):
+            raise ConnectionError()
+        self.assertFalse(device.flush(failing_post, report))
+        self.assertEqual(len(device.queue), 60)
+        self.assertTrue(device.flush(self.make_post(), report))
+        self.assertEqual(report.failed_batches, 1)
+        self.assertEqual(len(self.get_events('TOKEN_A')), 60)
+
+
+class BenchmarkSuiteTest(AppTestCase):
+
+    def test_suite_and_compare(self):
+        poster = benchmark.InProcessPoster('wal', 'normal')
+        try:
+            results = benchmark.suite(poster, [1, 5], [10, 20], repeat=2)
+        finally:
+            poster.close()
+        self.assertIn('track[batch=5,table=20]', results)
+        self.assertIn('decode[batch=1]', results)
+        self.assertIn('delete_events_token[table=10]', results)
+        self.assertEqual(results['get_events_all[table=20]']['n'], 2)
+
+        path = os.path.join(self.tmp_dir, 'results.json')
+        benchmark.write_results(path, results, {})
+        baseline = benchmark.read_results(path)
+        self.assertEqual(
+            {verdict for _, _, _, verdict in
+             benchmark.compare(results, baseline)}, {'ok'})
+        slower = {case: dict(timings, p50_ms=timings['p50_ms'] * 2 + 1)
+                  for case, timings in results.items()}
+        del slower['decode[batch=1]']
+        verdicts = {case: verdict for case, _, _, verdict in
+                    benchmark.compare(slower, baseline)}
+        self.assertEqual(verdicts['decode[batch=1]'], 'missing')
+        self.assertEqual(verdicts['track[batch=1,table=10]'], 'regression')
+
+
+class MetricsTest(AppTestCase):
+
+    def test_metrics_endpoint(self):
+        track_requests = app.requests_total.value('/track/', 'POST', 200)
+        base64_batches = app.phase_duration.count('base64')
+        commits = app.phase_duration.count('commit')
+        self.post_events([benchmark.make_event('TOKEN_A', 's', i)
+                          for i in range(3)])
+        self.assertEqual(app.requests_total.value('/track/', 'POST', 200),
+                         track_requests + 1)
+        self.assertEqual(app.phase_duration.count('base64'),
+                         base64_batches + 1)
+        self.assertEqual(app.phase_duration.count('commit'), commits + 1)
+
+        res = self.client.get('/metrics')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.content_type, metrics.CONTENT_TYPE)
+        lines = res.get_data(as_text=True).splitlines()
+        self.assertIn('# TYPE http_requests_total counter', lines)
+        self.assertIn('events_table_rows{shard="0"} 3', lines)
+        self.assertIn('http_requests_total{route="/track/",method="POST",'
+                      'status="200"} %d' % (track_requests + 1), lines)
+        self.assertIn('track_phase_duration_seconds_count{phase="json"} %d'
+                      % app.phase_duration.count('json'), lines)
+        self.assertTrue(any(line.startswith('events_per_second ')
+                            for line in lines))
+
+        # counted again only once the count is EVENTS_TABLE_ROWS_MAX_AGE old
+        self.post_events([benchmark.make_event('TOKEN_A', 's', 3)])
+        body = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('events_table_rows{shard="0"} 3\n', body)
+        app.events_table_rows.read_at -= app.EVENTS_TABLE_ROWS_MAX_AGE
+        body = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('events_table_rows{shard="0"} 4\n', body)
+
+    def test_event_logging_is_sampled(self):
+        app.app.config['EVENT_LOG_EVERY'] = 2
+        with self.assertLogs(app.app.logger, 'DEBUG') as logs:
+            self.post_events([benchmark.make_event('TOKEN_A', 's', i)
+                              for i in range(4)])
+        self.assertEqual(
+            len([r for r in logs.output if 'event idx=' in r]), 2)
+
+    def test_histogram(self):
+        histogram = metrics.Histogram('latency', 'help', ('route', ),
+                                      buckets=(0.1, 1))
+        for value in (0.05, 0.5, 5):
+            histogram.observe(value, '/a"b')
+        self.assertEqual(histogram.render(), [
+            '# HELP latency help',
+            '# TYPE latency histogram',
+            'latency_bucket{route="/a\\"b",le="0.1"} 1',
+            'latency_bucket{route="/a\\"b",le="1.0"} 2',
+            'latency_bucket{route="/a\\"b",le="+Inf"} 3',
+            'latency_sum{route="/a\\"b"} 5.55',
+            'latency_count{route="/a\\"b"} 3',
+        ])
+
+
+class CodecTest(unittest.TestCase):
+
+    def tearDown(self):
+        codec.set_backend()
+
+    def test_backends(self):
+        events = [benchmark.make_event('TOKEN_A', 's', i) for i in range(3)]
+        events[0]['properties']['unicode'] = 'ש/'
+        data = json.dumps(events).encode()
+        for name in codec.available_backends():
+            codec.set_backend(name)
+            decoded = codec.decode_events(data)
+            self.assertEqual(events, [e for e, _ in decoded])
+            self.assertEqual(events, [json.loads(raw) for _, raw in decoded])
+
+    def test_iter_raw_events(self):
+        self.assertEqual([], list(codec.iter_raw_events(b' [ ] ')))
+        self.assertEqual(
+            [({'a': [1, 2]}, '{"a": [1,2]}'), ('x', '"x"')],
+            list(codec.iter_raw_events(b'[{"a": [1,2]} ,\n"x"]')))
+        for data in (b'{}', b'[1 2]', b'[1,', b'[1] 2'):
+            with self.assertRaises(ValueError):
+                list(codec.iter_raw_events(data))
+
+
+class SauceConnectTest(unittest.TestCase):
+    # stands in for the sc binary
+    TUNNEL_SCRIPT = 'import sys, time; time.sleep(0.1); print(%r, flush=True)'
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.app_path = os.path.join(self.tmp_dir, 'SampleApp.app')
+        os.makedirs(os.path.join(self.app_path, 'Frameworks'))
+        self.write_app_file('SampleApp', b'binary')
+        self.write_app_file('Frameworks/Info.plist', b'plist')
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+        self.uploads = []
+        uploads = self.uploads
+
+        class StorageHandler(http.server.BaseHTTPRequestHandler):
+            # stands in for sauce storage
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                uploads.append((self.path, body))
+                response = json.dumps(
+                    {'md5': hashlib.md5(body).hexdigest()}).encode()
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+            def log_message(self, *args):
+                pass
+        self.server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), StorageHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        del sauce_connect.SETUP_TIMES[:]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def write_app_file(self, name, content):
+        with open(os.path.join(self.app_path, name), 'wb') as f:
+            f.write(content)
+
+    def upload(self, **kwargs):
+        return sauce_connect.upload_app_file(
+            self.app_path, 'sample_app.zip', cache_dir=self.cache_dir,
+            storage_url='http://127.0.0.1:%d/storage' %
+            self.server.server_address[1],
+            username='user', access_key='key', **kwargs)
+
+    def test_tunnel(self):
+        tunnel = sauce_connect.start_tunnel([
+            sys.executable, '-c',
+            self.TUNNEL_SCRIPT % sauce_connect.CONNECTED_MESSAGE])
+        self.assertIs(tunnel, tunnel.ready.result(10))
+        tunnel.close()
+        failed = sauce_connect.start_tunnel([
+            sys.executable, '-c',
+            self.TUNNEL_SCRIPT % sauce_connect.FINISHED_MESSAGE])
+        with self.assertRaises(Exception):
+            failed.ready.result(10)
+        self.assertEqual(['tunnel'],
+                         [step for step, _, _ in sauce_connect.SETUP_TIMES])
+
+    def test_zip_is_cached_by_content(self):
+        zip_path = sauce_connect.zip_app(self.app_path, self.cache_dir)
+        with zipfile.ZipFile(zip_path) as z:
+            self.assertEqual(['SampleApp.app/Frameworks/Info.plist',
+                              'SampleApp.app/SampleApp'],
+                             sorted(z.namelist()))
+        # a rebuild changes the times only
+        os.utime(os.path.join(self.app_path, 'SampleApp'), (0, 0))
+        self.assertEqual(zip_path, sauce_connect.zip_app(
+            self.app_path, self.cache_dir))
+        self.assertEqual('cached', sauce_connect.SETUP_TIMES[-1][2])
+        self.write_app_file('SampleApp', b'rebuilt')
+        self.assertNotEqual(zip_path, sauce_connect.zip_app(
+            self.app_path, self.cache_dir))
+
+    def test_upload_dedup(self):
+        self.assertTrue(self.upload())
+        self.assertEqual('/storage/user/sample_app.zip?overwrite=true',
+                         self.uploads[0][0])
+        self.assertFalse(self.upload())
+        self.assertEqual(1, len(self.uploads))
+        self.write_app_file('SampleApp', b'rebuilt')
+        future = sauce_connect.upload_app_file_async(
+            self.app_path, 'sample_app.zip', cache_dir=self.cache_dir,
+            storage_url='http://127.0.0.1:%d/storage' %
+            self.server.server_address[1],
+            username='user', access_key='key')
+        sauce_connect.wait_until_ready([future], timeout=10)
+        self.assertTrue(future.result())
+        self.assertEqual(2, len(self.uploads))
+        self.assertTrue(self.upload(force=True))
+        self.assertEqual(3, len(self.uploads))
+        report = sauce_connect.format_setup_times()
+        self.assertIn('skipped, unchanged', report)
+        self.assertIn('upload', report)
+
+
+class ParallelTestRunnerTest(unittest.TestCase):
+
+    def test_run(self):
+        test_ids = parallel_test_runner.discover(['app_test.CodecTest'])
+        self.assertEqual(['app_test.CodecTest.test_backends',
+                          'app_test.CodecTest.test_iter_raw_events'],
+                         sorted(test_ids))
+        results = parallel_test_runner.run(
+            test_ids + ['app_test.CodecTest.test_missing'], workers=2)
+        outcomes = {r['test']: r['outcome'] for r in results}
+        self.assertEqual({'app_test.CodecTest.test_backends': 'ok',
+                          'app_test.CodecTest.test_iter_raw_events': 'ok',
+                          'app_test.CodecTest.test_missing': 'error'},
+                         outcomes)
+        self.assertLessEqual({r['worker'] for r in results}, {0, 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,344 @@
+'''
+An asyncio front end for app.py.
+
+Connections are served by coroutines instead of threads, so idle keep-alive
+connections - e.g. of slow mobile clients - cost a few KB each rather than
+a thread. Every request is handed to app.py's wsgi app on a bounded thread
+pool, which is where all the storage I/O happens; the endpoints and their
+responses are exactly those of app.py.
+
+Requests waiting for events - long polls and server-sent event streams -
+hold their thread for as long as they wait. They run on a pool of their
+own, of max_waiters threads, so that they never keep the requests storing
+and reading events waiting; a waiting request beyond max_waiters is
+answered 503 at once.
+'''
+import asyncio
+import concurrent.futures
+import contextvars
+import email.utils
+import functools
+import io
+import logging
+import re
+import resource
+import sys
+import urllib.parse
+
+import app
+
+
+KEEP_ALIVE_TIMEOUT = 75
+MAX_LINE_SIZE = 64 * 1024
+MAX_BODY_SIZE = 64 * 1024 * 1024
+EXECUTOR_THREADS = 16
+MAX_WAITERS = 64
+# the endpoints of app.py which wait for events
+WAITING_PATH = re.compile(r'^/events/[^/]+/(?:wait|stream)$')
+
+logger = logging.getLogger(__name__)
+
+_END = object()
+
+
+class HTTPError(Exception):
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+
+class AsyncServer:
+
+    def __init__(self, wsgi_app, host, port,
+                 executor_threads=EXECUTOR_THREADS, max_waiters=MAX_WAITERS):
+        self.wsgi_app = wsgi_app
+        self.host = host
+        self.port = int(port)
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            executor_threads, thread_name_prefix='wsgi')
+        self.wait_executor = concurrent.futures.ThreadPoolExecutor(
+            max_waiters, thread_name_prefix='wsgi-wait')
+        self.max_waiters = max_waiters
+        self.waiters = 0
+        self.loop = None
+        self.server = None
+        self.stopping = None
+        self.connections = 0
+        self.requests = 0
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        self.server = await asyncio.start_server(
+            self.handle_connection, self.host, self.port,
+            limit=MAX_LINE_SIZE)
+        # the actual port, when asked to bind port 0
+        self.port = self.server.sockets[0].getsockname()[1]
+        logger.info('serving on %s:%d', self.host, self.port)
+        await self.stopping.wait()
+        self.server.close()
+        await self.server.wait_closed()
+
+    def shutdown(self):
+        '''
+        stops accepting connections; called by /kill, from an executor
+        thread, as werkzeug.server.shutdown
+        '''
+        self.loop.call_soon_threadsafe(self.stopping.set)
+
+    def shutdown_executors(self):
+        self.executor.shutdown(wait=True)
+        self.wait_executor.shutdown(wait=True)
+
+    async def handle_connection(self, reader, writer):
+        self.connections += 1
+        peer = writer.get_extra_info('peername') or ('', 0)
+        try:
+            keep_alive = True
+            while keep_alive and not self.stopping.is_set():
+                try:
+                    request = await asyncio.wait_for(
+                        self.read_request(reader, writer), KEEP_ALIVE_TIMEOUT)
+                except HTTPError as e:
+                    await self.write_error(writer, e.status)
+                    break
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError,
+                        ConnectionError):
+                    break
+                if request is None:
+                    break
+                self.requests += 1
+                if not WAITING_PATH.match(request[1].partition('?')[0]):
+                    keep_alive = await self.respond(
+                        request, peer, writer, self.executor)
+                elif self.waiters >= self.max_waiters:
+                    await self.write_error(writer, '503 Service Unavailable',
+                                           'Retry-After: 1\r\n')
+                    break
+                else:
+                    self.waiters += 1
+                    try:
+                        keep_alive = await self.respond(
+                            request, peer, writer, self.wait_executor)
+                    finally:
+                        self.waiters -= 1
+        except ConnectionError:
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    async def read_request(self, reader, writer):
+        try:
+            line = await reader.readline()
+            if not line:
+                return None
+            try:
+                method, target, version = \
+                    line.decode('latin-1').rstrip('\r\n').split(' ')
+            except ValueError:
+                raise HTTPError('400 Bad Request')
+            headers = []
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, sep, value = line.decode('latin-1').partition(':')
+                if not sep:
+                    raise HTTPError('400 Bad Request')
+                headers.append((name.strip().lower(), value.strip()))
+        except (ValueError, asyncio.LimitOverrunError):
+            raise HTTPError('431 Request Header Fields Too Large')
+
+        header_dict = {}
+        for name, value in headers:
+            if name in header_dict:
+                header_dict[name] += ',' + value
+            else:
+                header_dict[name] = value
+        if header_dict.get('expect', '').lower() == '100-continue':
+            writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+        if 'chunked' in header_dict.get('transfer-encoding', '').lower():
+            body = await self.read_chunked_body(reader)
+        else:
+            try:
+                length = int(header_dict.get('content-length', 0))
+            except ValueError:
+                raise HTTPError('400 Bad Request')
+            if length > MAX_BODY_SIZE:
+                raise HTTPError('413 Request Entity Too Large')
+            body = await reader.readexactly(length)
+        return method, target, version, header_dict, body
+
+    async def read_chunked_body(self, reader):
+        chunks = []
+        size = 0
+        while True:
+            try:
+                line = await reader.readline()
+                chunk_size = int(line.split(b';')[0], 16)
+            except ValueError:
+                raise HTTPError('400 Bad Request')
+            if chunk_size == 0:
+                # skip trailers
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                return b''.join(chunks)
+            size += chunk_size
+            if size > MAX_BODY_SIZE:
+                raise HTTPError('413 Request Entity Too Large')
+            chunks.append(await reader.readexactly(chunk_size))
+            await reader.readexactly(2)
+
+    def make_environ(self, method, target, version, headers, body, peer):
+        path, _, query = target.partition('?')
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': urllib.parse.unquote(path, 'latin-1'),
+            'QUERY_STRING': query,
+            'SERVER_NAME': self.host,
+            'SERVER_PORT': str(self.port),
+            'SERVER_PROTOCOL': version,
+            'REMOTE_ADDR': peer[0],
+            'REMOTE_PORT': str(peer[1]),
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+            'werkzeug.server.shutdown': self.shutdown,
+        }
+        for name, value in headers.items():
+            key = name.upper().replace('-', '_')
+            if key == 'CONTENT_TYPE':
+                environ[key] = value
+            elif key not in ('CONTENT_LENGTH', 'TRANSFER_ENCODING'):
+                environ['HTTP_' + key] = value
+        return environ
+
+    async def respond(self, request, peer, writer, executor):
+        '''
+        writes the response, running the app on executor, and returns
+        whether to keep the connection
+        '''
+        method, target, version, headers, body = request
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.1':
+            keep_alive = connection != 'close'
+        else:
+            keep_alive = connection == 'keep-alive'
+        environ = self.make_environ(
+            method, target, version, headers, body, peer)
+
+        response = {}
+
+        def start_response(status, response_headers, exc_info=None):
+            response['status'] = status
+            response['headers'] = response_headers
+            return self._unsupported_write
+
+        def call_app():
+            result = self.wsgi_app(environ, start_response)
+            iterator = iter(result)
+            # start_response may be called as late as the first chunk
+            return result, iterator, next(iterator, _END)
+
+        # every step of a request runs in the same context: flask keeps its
+        # request context in context variables, and a streamed response
+        # pushes it on its first chunk and pops it when closed
+        context = contextvars.copy_context()
+        result, iterator, chunk = await self.loop.run_in_executor(
+            executor, context.run, call_app)
+        try:
+            response_headers = [
+                (name, value) for name, value in response['headers']
+                if name.lower() not in ('connection', 'transfer-encoding')]
+            has_length = any(name.lower() == 'content-length'
+                             for name, _ in response_headers)
+            chunked = not has_length and version == 'HTTP/1.1'
+            if not has_length and not chunked:
+                keep_alive = False
+            if chunked:
+                response_headers.append(('Transfer-Encoding', 'chunked'))
+            response_headers.append(
+                ('Date', email.utils.formatdate(usegmt=True)))
+            response_headers.append(
+                ('Connection', 'keep-alive' if keep_alive else 'close'))
+            head = '%s %s\r\n%s\r\n\r\n' % (
+                version if version == 'HTTP/1.1' else 'HTTP/1.0',
+                response['status'],
+                '\r\n'.join('%s: %s' % h for h in response_headers))
+            writer.write(head.encode('latin-1'))
+
+            send_body = method != 'HEAD'
+            next_chunk = functools.partial(context.run, next, iterator, _END)
+            while chunk is not _END:
+                if chunk and send_body:
+                    if chunked:
+                        writer.write(b'%x\r\n' % len(chunk))
+                        writer.write(chunk)
+                        writer.write(b'\r\n')
+                    else:
+                        writer.write(chunk)
+                    await writer.drain()
+                chunk = await self.loop.run_in_executor(
+                    executor, next_chunk)
+            if chunked and send_body:
+                writer.write(b'0\r\n\r\n')
+            await writer.drain()
+        finally:
+            if hasattr(result, 'close'):
+                # closing a streamed flask response tears down its request
+                # context, which returns the db connections to the pool
+                await self.loop.run_in_executor(
+                    executor, context.run, result.close)
+        return keep_alive
+
+    async def write_error(self, writer, status, headers=''):
+        writer.write(('HTTP/1.1 %s\r\n%sContent-Length: 0\r\n'
+                      'Connection: close\r\n\r\n' %
+                      (status, headers)).encode())
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+    @staticmethod
+    def _unsupported_write(data):
+        raise NotImplementedError('the write() callable is not supported')
+
+
+if __name__ == '__main__':
+    parser = app.make_arg_parser('asyncio iossdk http server')
+    parser.add_argument('--executor-threads', type=int,
+                        default=EXECUTOR_THREADS,
+                        help='threads running the requests, and their '
+                             'storage I/O')
+    parser.add_argument('--max-waiters', type=int, default=MAX_WAITERS,
+                        help='requests waiting for events at once, each on '
+                             'a thread of its own')
+    args = parser.parse_args()
+    if args.workers != 1:
+        parser.error('--workers is not supported by the asyncio server')
+    app.check_args(parser, args)
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+    # every connection is a file descriptor, allow as many as possible
+    soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard_limit, hard_limit))
+    except (ValueError, OSError):
+        logger.warning('could not raise the open files limit from %d',
+                       soft_limit)
+    app.configure(args)
+    app.init_db()
+    server = AsyncServer(app.app, args.host, args.port,
+                         args.executor_threads, args.max_waiters)
+    try:
+        asyncio.run(server.serve())
+    finally:
+        server.shutdown_executors()
+        app.close_db()
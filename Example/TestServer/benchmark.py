@@ -0,0 +1,588 @@
+import argparse
+import base64
+import concurrent.futures
+import gzip
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+
+import requests
+
+from load_generator import (
+    BATCH_SIZE, SUPER_PROPERTIES, encode_batch, make_event, percentile)
+
+
+FILL_BATCH_SIZE = 1000
+SUITE_PROBE_TOKEN = 'SUITE_PROBE_TOKEN'
+# the slowdown, as a fraction of the baseline, that counts as a regression
+REGRESSION_THRESHOLD = 0.2
+# differences below this are noise, whatever their fraction of the baseline
+MIN_REGRESSION_MS = 0.25
+
+
+def encode_batch_v2(batch):
+    '''the raw json body of /v2/track/'''
+    sending_time = int(time.time())
+    for e in batch:
+        e['properties']['sending_time'] = sending_time
+    return json.dumps(batch)
+
+
+# name -> (endpoint, batch encoder, content type, content encoding)
+WIRE_FORMATS = {
+    'form': ('/track/', encode_batch,
+             'application/x-www-form-urlencoded', None),
+    'form+gzip': ('/track/', encode_batch,
+                  'application/x-www-form-urlencoded', 'gzip'),
+    'json': ('/v2/track/', encode_batch_v2, 'application/json', None),
+    'json+gzip': ('/v2/track/', encode_batch_v2, 'application/json', 'gzip'),
+}
+
+
+def make_bodies(num_batches, batch_size=BATCH_SIZE, num_tokens=10):
+    tokens = ['BENCH_TOKEN_%d' % i for i in range(num_tokens)]
+    session_id = str(uuid.uuid4())
+    message_index = 0
+    bodies = []
+    for _ in range(num_batches):
+        batch = []
+        for _ in range(batch_size):
+            message_index += 1
+            batch.append(make_event(
+                random.choice(tokens), session_id, message_index))
+        bodies.append(encode_batch(batch))
+    return bodies
+
+
+class HttpPoster:
+    def __init__(self, url):
+        self.base_url = url.rstrip('/')
+        self.url = self.base_url + '/track/'
+        self.local = threading.local()
+
+    def session(self):
+        # one keep-alive session per thread, like one sdk instance per device
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.local.session = requests.Session()
+        return session
+
+    def post(self, body):
+        res = self.session().post(self.url, data=body, headers={
+            'Content-Type': 'application/x-www-form-urlencoded'})
+        res.raise_for_status()
+
+    def request(self, method, path, data=None, headers=None):
+        '''returns the status and the body of the response'''
+        res = self.session().request(method, self.base_url + path,
+                                     data=data, headers=headers)
+        return res.status_code, res.content
+
+    def fill(self, num_events, num_tokens=1000):
+        fill_through_api(self, num_events, num_tokens)
+
+    def stats(self):
+        return requests.get(self.base_url + '/stats/').json()
+
+
+def fill_through_api(poster, num_events, num_tokens=1000):
+    '''appends num_events events through /v2/track/'''
+    data = make_event('BENCH_TOKEN', str(uuid.uuid4()), 1)
+    for offset in range(0, num_events, FILL_BATCH_SIZE):
+        batch = []
+        for i in range(offset, min(num_events, offset + FILL_BATCH_SIZE)):
+            event = json.loads(json.dumps(data))
+            event['properties']['token'] = 'BENCH_TOKEN_%d' % (i % num_tokens)
+            batch.append(event)
+        status, _ = poster.request(
+            'POST', '/v2/track/', json.dumps(batch),
+            {'Content-Type': 'application/json'})
+        assert status == 200, status
+
+
+class InProcessPoster:
+    '''
+    posts straight into app.py through the flask test client, against a
+    throwaway database configured with the given sqlite settings - or a
+    throwaway log, with storage='log'
+    '''
+    def __init__(self, journal_mode, synchronous, storage='sqlite'):
+        import app
+        fd, self.db_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.log_dir = tempfile.mkdtemp()
+        self.storage = storage
+        app.app.config.update(
+            STORAGE=storage,
+            DATABASE=self.db_path,
+            LOG_DIRECTORY=self.log_dir,
+            JOURNAL_MODE=journal_mode,
+            SYNCHRONOUS=synchronous,
+        )
+        app.init_db()
+        self.client = app.app.test_client()
+
+    def post(self, body):
+        res = self.client.post('/track/', data=body, headers={
+            'Content-Type': 'application/x-www-form-urlencoded'})
+        assert res.status_code == 200, res.status_code
+
+    def request(self, method, path, data=None, headers=None):
+        res = self.client.open(path, method=method, data=data,
+                               headers=headers)
+        return res.status_code, res.get_data()
+
+    def fill(self, num_events, num_tokens=1000):
+        import app
+        if self.storage != 'sqlite':
+            fill_through_api(self, num_events, num_tokens)
+            return
+        with app.app.app_context():
+            fill_table(app.get_db(), num_events, num_tokens)
+
+    def stats(self):
+        return self.client.get('/stats/').get_json()
+
+    def close(self):
+        import app
+        app.close_db()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.db_path + suffix):
+                os.remove(self.db_path + suffix)
+        shutil.rmtree(self.log_dir, ignore_errors=True)
+
+
+def fill_table(db, num_events, num_tokens=1000):
+    '''
+    appends num_events rows straight into the events table, spread over
+    num_tokens tokens, reusing a single serialized event as the payload
+    '''
+    data = json.dumps(make_event('BENCH_TOKEN', str(uuid.uuid4()), 1))
+    rows = (('BENCH_TOKEN_%d' % (i % num_tokens), data)
+            for i in range(num_events))
+    with db:
+        db.executemany('insert into events (token, data) values (?, ?);',
+                       rows)
+
+
+def token_queries(table_sizes, repeat, drop_indexes=False):
+    '''
+    measures the latency of per-token requests as the table grows. every
+    probe inserts a fresh token with a single batch, then reads and deletes
+    it, while the rest of the table belongs to other tokens
+    '''
+    import app
+    poster = InProcessPoster('wal', 'normal')
+    client = poster.client
+    with app.app.app_context():
+        db = app.get_db()
+        if drop_indexes:
+            for name, in db.execute("select name from sqlite_master "
+                                    "where type='index' and "
+                                    "tbl_name='events' and sql is not null;"
+                                    ).fetchall():
+                db.execute('drop index %s;' % name)
+        total = 0
+        for size in table_sizes:
+            fill_table(db, size - total)
+            total = size
+            get_times, delete_times = [], []
+            for i in range(repeat):
+                token = 'PROBE_TOKEN_%d_%d' % (size, i)
+                poster.post(encode_batch([
+                    make_event(token, 's', j) for j in range(BATCH_SIZE)]))
+                start = time.perf_counter()
+                res = client.get('/events/%s' % token)
+                assert len(res.get_json()['events']) == BATCH_SIZE
+                get_times.append(time.perf_counter() - start)
+                start = time.perf_counter()
+                res = client.delete('/events/%s' % token)
+                assert res.get_json()['num_deleted_events'] == BATCH_SIZE
+                delete_times.append(time.perf_counter() - start)
+            print('%9d events: GET /events/<token> p50=%.2fms, '
+                  'DELETE /events/<token> p50=%.2fms' % (
+                      size,
+                      percentile(sorted(get_times), 50) * 1000,
+                      percentile(sorted(delete_times), 50) * 1000))
+    poster.close()
+
+
+def wire_formats(num_batches, batch_size):
+    '''
+    compares the bytes on the wire and the cpu time spent per event for
+    every format /track/ and /v2/track/ accept, in-process
+    '''
+    poster = InProcessPoster('wal', 'normal')
+    for name, (endpoint, encode, content_type, content_encoding) in \
+            WIRE_FORMATS.items():
+        bodies = []
+        for i in range(num_batches):
+            body = encode([make_event('BENCH_TOKEN', 's', j)
+                           for j in range(batch_size)]).encode()
+            if content_encoding == 'gzip':
+                body = gzip.compress(body)
+            bodies.append(body)
+        headers = {'Content-Type': content_type}
+        if content_encoding:
+            headers['Content-Encoding'] = content_encoding
+        start = time.process_time()
+        for body in bodies:
+            res = poster.client.post(endpoint, data=body, headers=headers)
+            assert res.status_code == 200, res.status_code
+        cpu_time = time.process_time() - start
+        num_events = num_batches * batch_size
+        print('%-10s %7.1f bytes/event, %6.1fus cpu/event' % (
+            name, sum(len(b) for b in bodies) / num_events,
+            cpu_time / num_events * 1e6))
+    poster.close()
+
+
+def codec_costs(num_batches, batch_size):
+    '''
+    per event cost of every installed json backend: parsing a batch,
+    serializing an event for storage, and the two ways codec.decode_events
+    produces the stored form
+    '''
+    import codec
+    batches = [
+        json.dumps([make_event('BENCH_TOKEN', 's', j,
+                               super_properties=SUPER_PROPERTIES)
+                    for j in range(batch_size)]).encode()
+        for _ in range(num_batches)]
+    num_events = num_batches * batch_size
+
+    def per_event(fn):
+        start = time.perf_counter()
+        for data in batches:
+            fn(data)
+        return (time.perf_counter() - start) / num_events * 1e6
+
+    for name in codec.available_backends():
+        codec.set_backend(name)
+        parsed = [codec.loads(data) for data in batches]
+        start = time.perf_counter()
+        for events in parsed:
+            for e in events:
+                codec.dumps(e)
+        dumps_cost = (time.perf_counter() - start) / num_events * 1e6
+        print('%-7s loads %5.2fus  dumps %5.2fus  '
+              'decode_events %5.2fus  decode_events(keep_raw) %5.2fus '
+              '(per event)' % (
+                  name, per_event(codec.loads), dumps_cost,
+                  per_event(codec.decode_events),
+                  per_event(lambda d: codec.decode_events(d, True))))
+    codec.set_backend()
+
+
+def measure(fn, repeat, setup=None):
+    '''
+    times repeat calls of fn, running setup (untimed) before each, and
+    returns the timings in milliseconds
+    '''
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+    return {
+        'n': repeat,
+        'mean_ms': sum(times) / repeat,
+        'min_ms': times[0],
+        'p50_ms': percentile(times, 50),
+        'p90_ms': percentile(times, 90),
+        'p99_ms': percentile(times, 99),
+    }
+
+
+def case_name(name, **params):
+    return '%s[%s]' % (name, ','.join(
+        '%s=%s' % item for item in sorted(params.items())))
+
+
+def suite(poster, batch_sizes, table_sizes, repeat):
+    '''
+    times the collector's hot paths and returns {case name: timings}:
+    - decode: the base64 and json decoding of a /track/ body, at every
+      batch size, outside of any request
+    - track: POST /track/ of a batch, at every batch and table size
+    - get_events_token, get_events_all and delete_events_token: GET
+      /events/<token>, GET /events/ and DELETE /events/<token>, with the
+      token holding BATCH_SIZE events, at every table size
+    the events table is emptied first, then filled up to every table size
+    in turn
+    '''
+    import codec
+    results = {}
+    form_headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+    probe_path = '/events/%s' % SUITE_PROBE_TOKEN
+
+    def request(method, path, data=None, headers=None):
+        status, _ = poster.request(method, path, data, headers)
+        assert status == 200, (method, path, status)
+
+    def make_body(batch_size):
+        return encode_batch([make_event(SUITE_PROBE_TOKEN, 's', j)
+                             for j in range(batch_size)])
+
+    for batch_size in batch_sizes:
+        data = iter([make_body(batch_size).partition('data=')[2]
+                     for _ in range(repeat)])
+        results[case_name('decode', batch=batch_size)] = measure(
+            lambda: codec.decode_events(base64.decodebytes(
+                urllib.parse.unquote(next(data)).encode())), repeat)
+
+    request('DELETE', '/events/')
+    total = 0
+    for size in table_sizes:
+        poster.fill(size - total)
+        total = size
+        for batch_size in batch_sizes:
+            bodies = iter([make_body(batch_size) for _ in range(repeat)])
+            results[case_name('track', batch=batch_size, table=size)] = \
+                measure(lambda: request('POST', '/track/', next(bodies),
+                                        form_headers), repeat)
+            request('DELETE', probe_path)
+        request('POST', '/track/', make_body(BATCH_SIZE), form_headers)
+        results[case_name('get_events_token', table=size)] = measure(
+            lambda: request('GET', probe_path), repeat)
+        results[case_name('get_events_all', table=size)] = measure(
+            lambda: request('GET', '/events/'), repeat)
+        request('DELETE', probe_path)
+        results[case_name('delete_events_token', table=size)] = measure(
+            lambda: request('DELETE', probe_path), repeat,
+            setup=lambda: request('POST', '/track/', make_body(BATCH_SIZE),
+                                  form_headers))
+        print('table size %d done' % size, file=sys.stderr)
+    return results
+
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD,
+            metric='p50_ms'):
+    '''
+    compares the metric of every case to the baseline's, and returns a
+    list of (case, baseline value, value, verdict). a case regressed when
+    it's slower than the baseline by more than threshold (a fraction of
+    the baseline value) and by at least MIN_REGRESSION_MS
+    '''
+    rows = []
+    for case in sorted(set(results) | set(baseline)):
+        if case not in baseline:
+            rows.append((case, None, results[case][metric], 'new'))
+            continue
+        if case not in results:
+            rows.append((case, baseline[case][metric], None, 'missing'))
+            continue
+        old, new = baseline[case][metric], results[case][metric]
+        verdict = 'ok'
+        if abs(new - old) >= MIN_REGRESSION_MS:
+            if new > old * (1 + threshold):
+                verdict = 'regression'
+            elif new < old * (1 - threshold):
+                verdict = 'improvement'
+        rows.append((case, old, new, verdict))
+    return rows
+
+
+def format_comparison(rows):
+    def ms(value):
+        return '%10.3fms' % value if value is not None else '%12s' % '-'
+    lines = []
+    for case, old, new, verdict in rows:
+        change = '%+7.1f%%' % ((new - old) / old * 100) \
+            if old and new is not None else '%8s' % ''
+        lines.append('%-45s %s %s %s  %s' % (
+            case, ms(old), ms(new), change, verdict))
+    return '\n'.join(lines)
+
+
+def write_results(path, results, meta):
+    with open(path, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=2,
+                  sort_keys=True)
+
+
+def read_results(path):
+    with open(path) as f:
+        return json.load(f)['results']
+
+
+def open_idle_connections(url, num_connections):
+    '''
+    opens connections to the server that never send a request, the way
+    idle keep-alive connections of mobile clients sit on a server
+    '''
+    parsed = urllib.parse.urlparse(url)
+    connections = []
+    for _ in range(num_connections):
+        connections.append(socket.create_connection(
+            (parsed.hostname, parsed.port or 80)))
+    return connections
+
+
+def server_resources(pid):
+    '''
+    the resident memory and number of threads of a server running on this
+    machine, read from /proc (linux only)
+    '''
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            status = dict(line.split(':', 1) for line in f)
+    except OSError:
+        return None
+    return {'rss': status['VmRSS'].strip(),
+            'threads': int(status['Threads'])}
+
+
+def run(poster, bodies, batch_size, concurrency=1):
+    def timed_post(body):
+        start = time.perf_counter()
+        poster.post(body)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        latencies = sorted(executor.map(timed_post, bodies))
+    elapsed = time.perf_counter() - start
+    num_events = len(bodies) * batch_size
+    print('%d events in %d batches: %.2fs, %.0f events/s' % (
+        num_events, len(bodies), elapsed, num_events / elapsed))
+    print('latency per batch: p50=%.2fms p90=%.2fms p99=%.2fms' % tuple(
+        percentile(latencies, p) * 1000 for p in (50, 90, 99)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('/track/ throughput benchmark')
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--batches', type=int, default=200)
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='number of clients flushing concurrently')
+    parser.add_argument('--idle-connections', type=int, default=0,
+                        help='keep this many idle connections open to the '
+                             'server while posting')
+    parser.add_argument('--in-process', action='store_true',
+                        help='use the flask test client instead of http')
+    parser.add_argument('--journal-mode', default='wal')
+    parser.add_argument('--synchronous', default='normal')
+    parser.add_argument('--storage', default='sqlite',
+                        choices=('sqlite', 'log'),
+                        help='the storage of app.py, with --in-process')
+    parser.add_argument('--scenario', default='track',
+                        choices=('track', 'token-queries', 'wire-formats',
+                                 'codec', 'suite'),
+                        help='track: /track/ throughput. token-queries: '
+                             'latency of per-token requests (in-process) '
+                             'as the table grows. wire-formats: bytes and '
+                             'cpu per event of each body format '
+                             '(in-process). codec: json encode/decode cost '
+                             'per event of each installed backend. suite: '
+                             'timings of every hot path at every batch and '
+                             'table size, in-process or over http - note '
+                             'that it deletes all the events of the server')
+    parser.add_argument('--table-sizes',
+                        help='comma separated, for token-queries (default '
+                             '10000,100000,1000000) and suite (default '
+                             '1000,10000,100000)')
+    parser.add_argument('--batch-sizes', default='1,%d,500' % BATCH_SIZE,
+                        help='comma separated, for suite')
+    parser.add_argument('--output',
+                        help='file to write the results of suite to, as '
+                             'json')
+    parser.add_argument('--baseline',
+                        help='results of a previous suite run to compare '
+                             'with; exits with status 1 on regressions')
+    parser.add_argument('--threshold', type=float,
+                        default=REGRESSION_THRESHOLD,
+                        help='slowdown of the p50 of a case, as a fraction '
+                             'of the baseline, flagged as a regression')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--drop-indexes', action='store_true',
+                        help='run token-queries without the events indexes')
+    args = parser.parse_args()
+
+    if args.scenario == 'token-queries':
+        table_sizes = args.table_sizes or '10000,100000,1000000'
+        token_queries([int(n) for n in table_sizes.split(',')],
+                      args.repeat, args.drop_indexes)
+        sys.exit(0)
+    if args.scenario == 'wire-formats':
+        wire_formats(args.batches, args.batch_size)
+        sys.exit(0)
+    if args.scenario == 'codec':
+        codec_costs(args.batches, args.batch_size)
+        sys.exit(0)
+
+    if args.scenario == 'suite':
+        import codec
+        if args.in_process:
+            poster = InProcessPoster(args.journal_mode, args.synchronous,
+                                     args.storage)
+        else:
+            poster = HttpPoster(args.url)
+        try:
+            results = suite(
+                poster,
+                [int(n) for n in args.batch_sizes.split(',')],
+                [int(n) for n in
+                 (args.table_sizes or '1000,10000,100000').split(',')],
+                args.repeat)
+        finally:
+            if args.in_process:
+                poster.close()
+        if args.output:
+            meta = {
+                'transport': 'in-process' if args.in_process else args.url,
+                'json_backend': codec.backend.name,
+                'python': platform.python_version(),
+                'repeat': args.repeat,
+                'time': int(time.time()),
+            }
+            if args.in_process:
+                meta.update(storage=args.storage,
+                            journal_mode=args.journal_mode,
+                            synchronous=args.synchronous)
+            write_results(args.output, results, meta)
+        if not args.baseline:
+            for case, timings in sorted(results.items()):
+                print('%-45s p50=%8.3fms p90=%8.3fms' % (
+                    case, timings['p50_ms'], timings['p90_ms']))
+            sys.exit(0)
+        rows = compare(results, read_results(args.baseline), args.threshold)
+        print(format_comparison(rows))
+        sys.exit(1 if any(r[3] == 'regression' for r in rows) else 0)
+
+    bodies = make_bodies(args.batches, args.batch_size)
+    if args.in_process:
+        poster = InProcessPoster(args.journal_mode, args.synchronous,
+                                 args.storage)
+        print('in-process, storage=%s journal_mode=%s synchronous=%s' % (
+            args.storage, args.journal_mode, args.synchronous))
+    else:
+        poster = HttpPoster(args.url)
+        print('posting to %s' % poster.url)
+    idle_connections = []
+    if args.idle_connections:
+        idle_connections = open_idle_connections(
+            args.url, args.idle_connections)
+        print('opened %d idle connections' % len(idle_connections))
+    run(poster, bodies, args.batch_size, args.concurrency)
+    server_stats = poster.stats()
+    print('server stats: %s' % json.dumps(server_stats))
+    if not args.in_process:
+        print('server resources: %s' % server_resources(server_stats['pid']))
+    for connection in idle_connections:
+        connection.close()
+    if args.in_process:
+        poster.close()
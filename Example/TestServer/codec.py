@@ -0,0 +1,114 @@
+'''
+The json codec used by app.py.
+
+The fastest available backend is picked on import - orjson, then ujson,
+falling back to the standard library json module - and can be overridden
+with set_backend(). Encoding always produces str, whatever the backend.
+'''
+import json
+import re
+
+
+# in order of preference
+BACKENDS = ('orjson', 'ujson', 'json')
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_raw_decoder = json.JSONDecoder()
+
+
+class Backend:
+    def __init__(self, name, loads, dumps):
+        self.name = name
+        self.loads = loads
+        self.dumps = dumps
+
+
+def load_backend(name):
+    '''raises ImportError if the backend's module is not installed'''
+    if name == 'orjson':
+        import orjson
+        return Backend(name, orjson.loads,
+                       lambda obj: orjson.dumps(obj).decode())
+    if name == 'ujson':
+        import ujson
+        return Backend(name, ujson.loads,
+                       lambda obj: ujson.dumps(
+                           obj, ensure_ascii=False,
+                           escape_forward_slashes=False))
+    if name == 'json':
+        return Backend(name, json.loads, json.dumps)
+    raise ValueError('unknown json backend: %s' % name)
+
+
+def available_backends():
+    result = []
+    for name in BACKENDS:
+        try:
+            load_backend(name)
+        except ImportError:
+            continue
+        result.append(name)
+    return result
+
+
+def set_backend(name=None):
+    '''
+    switches the module level loads/dumps to the given backend, or to the
+    fastest available one if no name is given
+    '''
+    global backend, loads, dumps
+    backend = load_backend(name or available_backends()[0])
+    loads = backend.loads
+    dumps = backend.dumps
+    return backend
+
+
+def iter_raw_events(data):
+    '''
+    yields (event, raw) for every element of a json array, where raw is the
+    element's original json text, sliced out of data. this lets callers
+    store events exactly as they were received, without serializing the
+    parsed event again
+    '''
+    if isinstance(data, (bytes, bytearray)):
+        data = data.decode()
+    idx = _WHITESPACE.match(data, 0).end()
+    if data[idx:idx + 1] != '[':
+        raise ValueError('expected a json array')
+    idx = _WHITESPACE.match(data, idx + 1).end()
+    if data[idx:idx + 1] == ']':
+        return
+    while True:
+        event, end = _raw_decoder.raw_decode(data, idx)
+        yield event, data[idx:end]
+        idx = _WHITESPACE.match(data, end).end()
+        delimiter = data[idx:idx + 1]
+        idx = _WHITESPACE.match(data, idx + 1).end()
+        if delimiter == ']':
+            break
+        if delimiter != ',':
+            raise ValueError('expected , or ] at %d' % idx)
+    if idx != len(data):
+        raise ValueError('extra data at %d' % idx)
+
+
+def decode_events(data, keep_raw=False):
+    '''
+    decodes a json array of events into a list of (event, json) pairs,
+    json being the event's serialized form to be stored.
+    with keep_raw, json is the event's original text; otherwise the events
+    are parsed and serialized again by the current backend, which
+    normalizes their formatting
+    '''
+    if keep_raw:
+        return list(iter_raw_events(data))
+    events = loads(data)
+    if not isinstance(events, list):
+        raise ValueError('expected a json array')
+    return [(e, dumps(e)) for e in events]
+
+
+backend = None
+loads = None
+dumps = None
+set_backend()
@@ -0,0 +1,119 @@
+import os
+import sqlite3
+import threading
+import time
+import urllib.request
+
+
+POOL_MAX_SIZE = 16
+STATEMENT_CACHE_SIZE = 128
+
+
+class ConnectionPool:
+    '''
+    A process wide pool of sqlite connections.
+
+    Connections are checked out for the duration of a request and returned
+    on teardown, instead of being opened and closed on every request, so
+    connection setup, schema reads and compiled statements (sqlite3 keeps
+    a per-connection cache of up to cached_statements statements) are
+    reused across requests.
+    With read_only, connections can't write, and never create the database
+    file.
+    The pool remembers the pid it was created in - a forked worker never
+    uses connections inherited from its parent.
+    '''
+
+    def __init__(self, database, synchronous='normal',
+                 max_size=POOL_MAX_SIZE,
+                 cached_statements=STATEMENT_CACHE_SIZE, read_only=False):
+        self.database = database
+        self.read_only = read_only
+        self.synchronous = synchronous
+        self.max_size = max_size
+        self.cached_statements = cached_statements
+        self.pid = os.getpid()
+        self.idle = []
+        self.size = 0
+        self.cond = threading.Condition()
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.wait_time = 0.0
+
+    def connect(self):
+        database, uri = self.database, False
+        if self.read_only:
+            database = 'file:%s?mode=ro' % urllib.request.pathname2url(
+                os.path.abspath(self.database))
+            uri = True
+        db = sqlite3.connect(database,
+                             check_same_thread=False,
+                             cached_statements=self.cached_statements,
+                             uri=uri)
+        # synchronous is a per-connection setting, unlike journal_mode which
+        # is persisted in the database file
+        db.execute('pragma synchronous=%s;' % self.synchronous)
+        return db
+
+    def acquire(self):
+        with self.cond:
+            self._check_pid()
+            if not self.idle and self.size >= self.max_size:
+                self.waits += 1
+                start = time.perf_counter()
+                while not self.idle and self.size >= self.max_size:
+                    self.cond.wait()
+                self.wait_time += time.perf_counter() - start
+            if self.idle:
+                self.hits += 1
+                return self.idle.pop()
+            self.misses += 1
+            self.size += 1
+        try:
+            return self.connect()
+        except Exception:
+            with self.cond:
+                self.size -= 1
+                self.cond.notify()
+            raise
+
+    def release(self, db):
+        if db.in_transaction:
+            db.rollback()
+        with self.cond:
+            if self.pid != os.getpid():
+                db.close()
+                return
+            self.idle.append(db)
+            self.cond.notify()
+
+    def close(self):
+        with self.cond:
+            for db in self.idle:
+                db.close()
+            self.size -= len(self.idle)
+            self.idle = []
+            self.cond.notify_all()
+
+    def stats(self):
+        with self.cond:
+            return {
+                'size': self.size,
+                'idle': len(self.idle),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'waits': self.waits,
+                'wait_time': self.wait_time,
+            }
+
+    def _check_pid(self):
+        if self.pid != os.getpid():
+            # connections must not be shared across a fork; drop them
+            # without closing, the parent still owns them
+            self.pid = os.getpid()
+            self.idle = []
+            self.size = 0
+            self.hits = self.misses = self.waits = 0
+            self.wait_time = 0.0
@@ -0,0 +1,106 @@
+'''
+Drops events that were already received, e.g. a batch the sdk sent again
+because the response to the first attempt was lost.
+
+An event is identified by its (token, session_id, message_index): every
+sdk session numbers its events. The keys seen recently are kept in an LRU
+of at most max_keys, and a key is forgotten max_age seconds after it was
+last seen - a retry comes within a flush interval or two, so the memory
+needed depends on the rate of events, not on how long the server runs.
+Events without a session_id or a message_index are never dropped.
+'''
+import collections
+import threading
+import time
+
+
+MAX_KEYS = 1000000
+# ten flush intervals of the sdk
+MAX_AGE = 600
+
+
+def event_key(token, event):
+    properties = event.get('properties')
+    if not isinstance(properties, dict):
+        return None
+    session_id = properties.get('session_id')
+    message_index = properties.get('message_index')
+    if session_id is None or message_index is None:
+        return None
+    return token, session_id, message_index
+
+
+class Deduplicator:
+
+    def __init__(self, max_keys=MAX_KEYS, max_age=MAX_AGE):
+        self.max_keys = max_keys
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        # key -> the monotonic time it was last seen, oldest first
+        self.keys = collections.OrderedDict()
+        self.received = 0
+        self.duplicates = 0
+        self.evicted = 0
+        self.expired = 0
+
+    def filter(self, batch):
+        '''
+        returns the events of a batch of (token, data, event) that weren't
+        seen before, and the keys they were recorded under. if the batch
+        isn't stored after all, forget() the keys, so that it may be retried
+        '''
+        keys = [event_key(token, event) for token, _, event in batch]
+        now = time.monotonic()
+        kept, added = [], []
+        with self.lock:
+            self._expire(now)
+            for key, item in zip(keys, batch):
+                if key is None:
+                    kept.append(item)
+                    continue
+                try:
+                    seen = key in self.keys
+                except TypeError:
+                    # an unhashable session_id or message_index
+                    kept.append(item)
+                    continue
+                self.keys[key] = now
+                if seen:
+                    self.keys.move_to_end(key)
+                    continue
+                kept.append(item)
+                added.append(key)
+            while len(self.keys) > self.max_keys:
+                self.keys.popitem(last=False)
+                self.evicted += 1
+            self.received += len(batch)
+            self.duplicates += len(batch) - len(kept)
+        return kept, added
+
+    def forget(self, keys):
+        with self.lock:
+            for key in keys:
+                self.keys.pop(key, None)
+
+    def duplicate_ratio(self):
+        with self.lock:
+            return self.duplicates / self.received if self.received else 0.0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'keys': len(self.keys),
+                'received': self.received,
+                'duplicates': self.duplicates,
+                'evicted': self.evicted,
+                'expired': self.expired,
+            }
+
+    def _expire(self, now):
+        keys = self.keys
+        while keys:
+            key, seen = next(iter(keys.items()))
+            if seen > now - self.max_age:
+                break
+            del keys[key]
+            self.expired += 1
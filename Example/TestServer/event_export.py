@@ -0,0 +1,280 @@
+'''
+Bulk export of the events stored by app.py, and replay of an export into
+/track/.
+
+An export is two files:
+- <path>: the events' json, as stored, one per line - itself a valid
+  newline delimited json file.
+- <path>.idx: a header of MAGIC and the number of events n, then three
+  columns: the n + 1 byte offsets of the lines (the last one is the size of
+  <path>), the n _ids and the n times the events were received at, as unix
+  timestamps. all are little endian, 8 bytes each.
+
+Both are memory-mapped by Export, so that replaying, or reading any single
+event, never parses more of the file than it sends:
+
+    python3 event_export.py export events.ndjson --token <token>
+    python3 event_export.py replay events.ndjson --url http://... --rate 500
+'''
+import argparse
+import array
+import base64
+import calendar
+import mmap
+import os
+import struct
+import sys
+import time
+import urllib.parse
+
+import load_generator
+import storage
+
+
+MAGIC = b'ALEXPRT1'
+INDEX_HEADER = struct.Struct('<8sQ')
+INDEX_SUFFIX = '.idx'
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+
+def index_path(path):
+    return path + INDEX_SUFFIX
+
+
+def export_events(event_store, path, event_filter=None):
+    '''
+    writes the events event_store selects with event_filter (all of them by
+    default) to an export at path, and returns their number. the files are
+    only put in place once complete
+    '''
+    event_filter = event_filter or storage.EventFilter()
+    offsets = array.array('Q', [0])
+    ids = array.array('Q')
+    times = array.array('d')
+    parsed_times = {}
+    with open(path + '.tmp', 'wb', WRITE_BUFFER_SIZE) as f:
+        for _id, date_created, _, data in event_store.select(event_filter):
+            if isinstance(data, str):
+                data = data.encode()
+            # events kept as received may be formatted over several lines.
+            # json strings can't hold a raw newline, so these are whitespace
+            data = data.replace(b'\n', b' ')
+            f.write(data)
+            f.write(b'\n')
+            offsets.append(offsets[-1] + len(data) + 1)
+            ids.append(_id)
+            received = parsed_times.get(date_created)
+            if received is None:
+                received = parsed_times[date_created] = calendar.timegm(
+                    time.strptime(date_created, storage.TIMESTAMP_FORMAT))
+            times.append(received)
+    with open(index_path(path) + '.tmp', 'wb') as f:
+        f.write(INDEX_HEADER.pack(MAGIC, len(ids)))
+        for column in (offsets, ids, times):
+            if sys.byteorder != 'little':
+                column.byteswap()
+            column.tofile(f)
+    os.replace(path + '.tmp', path)
+    os.replace(index_path(path) + '.tmp', index_path(path))
+    return len(ids)
+
+
+class Export:
+    '''
+    a memory-mapped export. offsets, ids and times are its index columns;
+    event(i) and events(start, end) return events' json as bytes
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.maps = []
+        self.views = []
+        index = self._map(index_path(path))
+        magic, count = INDEX_HEADER.unpack_from(index)
+        if magic != MAGIC:
+            raise ValueError('%s is not an export index' % index_path(path))
+        if len(index) != INDEX_HEADER.size + (3 * count + 1) * 8:
+            raise ValueError('%s is truncated' % index_path(path))
+        self.count = count
+        columns = memoryview(index)[INDEX_HEADER.size:]
+        self.views.append(columns)
+        self.offsets = self._column(columns[:(count + 1) * 8], 'Q')
+        self.ids = self._column(
+            columns[(count + 1) * 8:(2 * count + 1) * 8], 'Q')
+        self.times = self._column(columns[(2 * count + 1) * 8:], 'd')
+        self.data = self._map(path)
+        if len(self.data) != self.offsets[count]:
+            raise ValueError('%s does not match its index' % path)
+
+    def _map(self, path):
+        with open(path, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return b''
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.maps.append(m)
+        return m
+
+    def _column(self, view, typecode):
+        if sys.byteorder == 'little':
+            column = view.cast(typecode)
+            self.views.append(column)
+            return column
+        column = array.array(typecode, view)
+        column.byteswap()
+        return column
+
+    def __len__(self):
+        return self.count
+
+    def event(self, idx):
+        '''the json of the idx-th event, without its newline'''
+        return self.data[self.offsets[idx]:self.offsets[idx + 1] - 1]
+
+    def events(self, start, end):
+        '''the json of events start to end, as a json array'''
+        return b'[' + self.data[
+            self.offsets[start]:self.offsets[end] - 1].replace(
+                b'\n', b',') + b']'
+
+    def close(self):
+        # the column views have to be released before their maps
+        for view in reversed(self.views):
+            view.release()
+        self.views = []
+        self.offsets = self.ids = self.times = None
+        for m in self.maps:
+            m.close()
+        self.maps = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def encode_events(events_json):
+    '''the /track/ form body of a json array of events, as the sdk sends'''
+    data = base64.b64encode(events_json).decode()
+    return 'ip=1&data=%s' % urllib.parse.quote(data, safe='')
+
+
+def iter_batches(export, batch_size, by_time=False):
+    '''
+    yields the (start, end) ranges of the export's batches, of up to
+    batch_size events. with by_time, a batch only holds events received in
+    the same second
+    '''
+    start = 0
+    while start < len(export):
+        end = min(start + batch_size, len(export))
+        if by_time:
+            received = export.times[start]
+            for idx in range(start + 1, end):
+                if export.times[idx] != received:
+                    end = idx
+                    break
+        yield start, end
+        start = end
+
+
+def replay(export, post, batch_size=load_generator.BATCH_SIZE, rate=None,
+           speed=None):
+    '''
+    posts the export's events, in batches of batch_size, with post(body) -
+    see load_generator.http_poster - and returns a load_generator.Report.
+    rate paces the batches to that many events per second; speed instead
+    replays them as they were received, that many times faster. without
+    either they are posted as fast as the server takes them
+    '''
+    report = load_generator.Report()
+    start = time.monotonic()
+    first_received = export.times[0] if len(export) else 0
+    for begin, end in iter_batches(export, batch_size, by_time=bool(speed)):
+        if rate:
+            due = start + begin / rate
+        elif speed:
+            due = start + (export.times[begin] - first_received) / speed
+        else:
+            due = 0
+        delay = due - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        body = encode_events(export.events(begin, end))
+        sent = time.perf_counter()
+        try:
+            status = post(body)
+        except OSError:
+            report.add_failure()
+            continue
+        report.add_batch(end - begin, len(body), status,
+                         time.perf_counter() - sent)
+    report.elapsed = time.monotonic() - start
+    return report
+
+
+def format_replay_report(summary):
+    return '\n'.join([
+        '%d events replayed in %d batches in %.2fs: %.0f events/s' % (
+            summary['sent_events'], summary['batches'], summary['elapsed'],
+            summary['events_per_second']),
+        '%d batches rejected, %d network failures' % (
+            summary['rejected_batches'], summary['failed_batches']),
+        'latency per batch: p50=%(p50).2fms p90=%(p90).2fms '
+        'p99=%(p99).2fms max=%(max).2fms' % summary['latency_ms'],
+    ])
+
+
+def run_export(args):
+    import app
+    app.app.config.update(STORAGE=args.storage, DATABASE=args.db,
+                          LOG_DIRECTORY=args.log_dir)
+    app.open_read_only()
+    try:
+        with app.app.app_context():
+            return export_events(
+                app.get_store(), args.path,
+                storage.EventFilter(args.token, args.since, args.until))
+    finally:
+        app.close_db()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        'export the events stored by app.py, or replay an export')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = commands.add_parser(
+        'export', help='write the stored events to an export')
+    export_parser.add_argument('path')
+    export_parser.add_argument('--storage', default='sqlite',
+                               choices=('sqlite', 'log'))
+    export_parser.add_argument('--db', default='example_app_test_db.db')
+    export_parser.add_argument('--log-dir', default='example_app_test_log')
+    export_parser.add_argument('--token',
+                               help='export the events of this token only')
+    export_parser.add_argument('--since', help='as stored, e.g. '
+                               '"2019-01-01 10:00:00" (utc)')
+    export_parser.add_argument('--until')
+
+    replay_parser = commands.add_parser(
+        'replay', help="post an export's events to /track/")
+    replay_parser.add_argument('path')
+    replay_parser.add_argument('--url', default='http://127.0.0.1:8000')
+    replay_parser.add_argument('--batch-size', type=int,
+                               default=load_generator.BATCH_SIZE)
+    pacing = replay_parser.add_mutually_exclusive_group()
+    pacing.add_argument('--rate', type=float,
+                        help='events per second')
+    pacing.add_argument('--speed', type=float,
+                        help='replay the events as they were received, this '
+                             'many times faster')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        print('exported %d events to %s' % (run_export(args), args.path))
+    else:
+        with Export(args.path) as export:
+            report = replay(export, load_generator.http_poster(args.url),
+                            args.batch_size, args.rate, args.speed)
+            print(format_replay_report(report.summary()))
@@ -1,10 +1,16 @@
 import os
+import atexit
+import collections
 import enum
 import functools
 import glob
+import logging
 import sys
+import threading
+import time
 
 from appium import webdriver
+from appium.webdriver.common.touch_action import TouchAction
 import selenium
 
 try:
@@ -26,6 +32,9 @@ WEBDRIVER_CAPABILITIES = {
     'app': IOSSDK_EXAMPLE_APP_PATH
 }
 
+# the futures of the sauce labs tunnel and app upload, waited for before the
+# first session is created
+SAUCE_SETUP = []
 try:
     SAUCE_USERNAME = os.environ['SAUCE_USERNAME']
     SAUCE_ACCESS_KEY = os.environ['SAUCE_ACCESS_KEY']
@@ -35,11 +44,12 @@ try:
     import sauce_connect
     if not os.environ.get('TRAVIS'):
         # running locally, setting up sauce connect manually
-        sauce_connect.set_up_tunnel()
+        SAUCE_SETUP.append(sauce_connect.start_tunnel().ready)
     else:
         WEBDRIVER_CAPABILITIES['tunnel-identifier'] = \
             os.environ['TRAVIS_JOB_NUMBER']
-    sauce_connect.upload_app_file(IOSSDK_EXAMPLE_APP_PATH, 'sample_app.zip')
+    SAUCE_SETUP.append(sauce_connect.upload_app_file_async(
+        IOSSDK_EXAMPLE_APP_PATH, 'sample_app.zip'))
     WEBDRIVER_CAPABILITIES['platformVersion'] = '12.0'
     WEBDRIVER_CAPABILITIES['deviceName'] = 'iPhone 7 Simulator'
     WEBDRIVER_CAPABILITIES['app'] = 'sauce-storage:sample_app.zip'
@@ -47,6 +57,49 @@ except KeyError:
     USING_SAUCE = False
     DRIVER_URL = 'http://localhost:4723/wd/hub'
 
+# set by parallel_test_runner.py in every worker process. sauce labs gives
+# every session a simulator of its own; locally, every worker needs its own
+# simulator (SIMULATOR_UDIDS, comma separated) and WebDriverAgent port
+WORKER_INDEX = int(os.environ.get('TEST_WORKER_INDEX', 0))
+WDA_LOCAL_PORT = 8100
+if not USING_SAUCE:
+    WEBDRIVER_CAPABILITIES['wdaLocalPort'] = WDA_LOCAL_PORT + WORKER_INDEX
+    if os.environ.get('SIMULATOR_UDIDS'):
+        udids = os.environ['SIMULATOR_UDIDS'].split(',')
+        WEBDRIVER_CAPABILITIES['udid'] = udids[WORKER_INDEX % len(udids)]
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_APP_BUNDLE_ID = 'com.alooma.SampleApp'
+# pause between the taps of a batch, for the app to handle each of them
+BATCHED_TAP_WAIT_MS = 100
+UP = 'up'
+DOWN = 'down'
+# name -> (accessibility id, where the screen must be scrolled to for the
+# element to be visible: UP, DOWN or None when it always is)
+ELEMENTS = {
+    'token_text_box': ('token_text_box', UP),
+    'server_text_box': ('server_text_box', UP),
+    'event_type_text_box': ('event_type_text_box', UP),
+    'nil_event_type_switch': ('is_event_type_nil', UP),
+    'initialize_sdk_button': ('initialize_sdk_button', UP),
+    'send_event_button': ('send_event_button', None),
+    'flush_now_button': ('flush_now_button', None),
+    'track_function_selector': ('track_method_selector', UP),
+    'sample_object_selector': ('is_sample_object_included', None),
+    'register_super_props_button': ('register_super_props_button', DOWN),
+    'clear_all_super_props_button': ('clear_all_super_props', DOWN),
+    'add_duration_to_next_event_button': (
+        'add_duration_to_next_event', DOWN),
+}
+NUM_TRACKING_FUNCTIONS = 4
+NUM_SAMPLE_OBJECT_OPTIONS = 2
+
+# step name -> durations, in seconds, of every ExampleAppDriver of this
+# process
+STEP_TIMES = collections.defaultdict(list)
+
+
 class TrackingFunction(enum.Enum):
     TRACK = 0
     TRACK_WITH_PROPERTIES = 1
@@ -54,228 +107,345 @@ class TrackingFunction(enum.Enum):
     TRACK_CUSTOM_OBJECT_WITH_TYPE = 3
 
 
-def scroll_up_wrapper(fn):
+def timed_step(fn):
+    '''records the duration of every call in STEP_TIMES'''
     @functools.wraps(fn)
-    def scrolling_up_decorator(self, *args, **kwargs):
+    def timing_decorator(self, *args, **kwargs):
+        start = time.perf_counter()
         try:
-            element = fn(self, *args, **kwargs)
-            if not element.is_displayed():
-                self.scroll_up()
-            return element
-        except selenium.common.exceptions.NoSuchElementException:
-            self.scroll_up()
             return fn(self, *args, **kwargs)
-    return scrolling_up_decorator
+        finally:
+            elapsed = time.perf_counter() - start
+            STEP_TIMES[fn.__name__].append(elapsed)
+            logger.debug('%s took %.2fs', fn.__name__, elapsed)
+    return timing_decorator
+
+
+def format_step_times():
+    lines = []
+    for step, times in sorted(STEP_TIMES.items(),
+                              key=lambda item: -sum(item[1])):
+        lines.append('%-35s %4d calls, %7.2fs total, %5.2fs mean' % (
+            step, len(times), sum(times), sum(times) / len(times)))
+    return '\n'.join(lines)
+
+
+class SessionPool:
+    '''
+    appium sessions kept open across ExampleAppDriver instances. starting a
+    session installs and launches the app, which takes most of the time of
+    a short test; a released session only has its app relaunched, which
+    resets the app's state, and is handed to the next driver.
+    '''
+
+    def __init__(self, capabilities):
+        self.capabilities = capabilities
+        self.lock = threading.Lock()
+        self.idle = []
+        self.created = 0
+        self.reused = 0
+
+    def acquire(self):
+        with self.lock:
+            if self.idle:
+                self.reused += 1
+                return self.idle.pop()
+            self.created += 1
+        if SAUCE_SETUP:
+            sauce_connect.wait_until_ready(SAUCE_SETUP)
+        return webdriver.Remote(DRIVER_URL, self.capabilities)
+
+    def release(self, driver):
+        try:
+            driver.terminate_app(SAMPLE_APP_BUNDLE_ID)
+            driver.activate_app(SAMPLE_APP_BUNDLE_ID)
+        except selenium.common.exceptions.WebDriverException:
+            logger.warning('could not relaunch the app, closing its session')
+            self.discard(driver)
+            return
+        with self.lock:
+            self.idle.append(driver)
+
+    def discard(self, driver):
+        try:
+            driver.quit()
+        except selenium.common.exceptions.WebDriverException:
+            # the session was already closed
+            pass
 
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for driver in idle:
+            self.discard(driver)
+
+
+_session_pools = {}
 
-def scroll_down_wrapper(fn):
-    @functools.wraps(fn)
-    def scrolling_down_decorator(self, *args, **kwargs):
-        try:
-            element = fn(self, *args, **kwargs)
-            if not element.is_displayed():
-                self.scroll_down()
-            return element
-        except selenium.common.exceptions.NoSuchElementException:
-            self.scroll_down()
-            return fn(self, *args, **kwargs)
-    return scrolling_down_decorator
+
+def get_session_pool(new_command_timeout):
+    '''the pool of sessions created with the given newCommandTimeout'''
+    pool = _session_pools.get(new_command_timeout)
+    if pool is None:
+        capabilities = WEBDRIVER_CAPABILITIES.copy()
+        capabilities['newCommandTimeout'] = new_command_timeout
+        pool = _session_pools[new_command_timeout] = SessionPool(capabilities)
+    return pool
+
+
+@atexit.register
+def close_session_pools():
+    for pool in _session_pools.values():
+        pool.close()
 
 
 class ExampleAppDriver:
+    '''
+    drives the SampleApp through a session of the pool.
+
+    elements are looked up once by accessibility id, and looked up again
+    only when they go stale. the driver keeps track of where the screen is
+    scrolled to and of the values it set, so that it scrolls, reads and
+    types only when it has to, and batches taps into a single request.
+    '''
+
     def __init__(self, new_command_timeout=120):
         '''
         new_command_timeout controls how long it will take for the driver to
         close the session. when using this manually, you might want to increase
         '''
-        self.capabilities = WEBDRIVER_CAPABILITIES.copy()
-        self.capabilities['newCommandTimeout'] = new_command_timeout
-        self.driver = webdriver.Remote(
-            DRIVER_URL, self.capabilities)
-        self.token_text_box = None
-        self.server_text_box = None
-        self.event_type_text_box = None
-        self.nil_event_type_switch = None
-        self.initialize_sdk_button = None
-        self.send_event_button = None
-        self.flush_now_button = None
-        self.track_function_selector = None
-        self.sample_object_selector = None
-        self.register_super_props_button = None
-        self.clear_all_super_props_button = None
-        self.add_duration_to_next_event_button = None
+        self.pool = get_session_pool(new_command_timeout)
+        self.driver = self.pool.acquire()
+        self.reset_state()
+
+    def reset_state(self):
+        '''forgets what is known of the app, e.g. after it was relaunched'''
+        # accessibility id -> element
+        self.elements = {}
+        # accessibility id -> rect
+        self.rects = {}
+        # the app starts scrolled to the top
+        self.scrolled_to = UP
+        # text box name -> the text typed in it
+        self.texts = {}
+        self.nil_event_type = None
 
     def hide_keyboard(self):
-        self.driver.hide_keyboard()
+        try:
+            self.driver.hide_keyboard()
+        except selenium.common.exceptions.WebDriverException:
+            # no keyboard was shown
+            pass
 
+    @timed_step
     def set_token(self, token):
-        self._fill_in_text_box(self.get_token_text_box(), token)
+        self._fill_in_text_boxes([('token_text_box', token)])
 
+    @timed_step
     def set_server(self, server_url):
-        self._fill_in_text_box(self.get_server_text_box(), server_url)
+        self._fill_in_text_boxes([('server_text_box', server_url)])
 
+    @timed_step
     def set_event_type(self, event_type):
-        switch = self.get_nil_event_type_switch()
-        if switch.text == '0':
-            switch.click()
-        self._fill_in_text_box(self.get_event_type_text_box(), event_type)
+        self._set_nil_event_type(False)
+        self._fill_in_text_boxes([('event_type_text_box', event_type)])
 
+    @timed_step
     def set_nil_event_type(self):
-        switch = self.get_nil_event_type_switch()
-        if switch.text == '1':
-            switch.click()
+        self._set_nil_event_type(True)
 
+    @timed_step
+    def configure(self, server_url=None, token=None, event_type=None,
+                  tracking_function=None):
+        '''
+        sets any of the app's settings in one go, hiding the keyboard only
+        once, and initializes the sdk with them
+        '''
+        text_boxes = []
+        if server_url is not None:
+            text_boxes.append(('server_text_box', server_url))
+        if token is not None:
+            text_boxes.append(('token_text_box', token))
+        if event_type is not None:
+            self._set_nil_event_type(False)
+            text_boxes.append(('event_type_text_box', event_type))
+        self._fill_in_text_boxes(text_boxes)
+        points = []
+        if tracking_function is not None:
+            points.append(self._selector_option_point(
+                'track_function_selector', NUM_TRACKING_FUNCTIONS,
+                tracking_function.value))
+        points.append(self._center('initialize_sdk_button'))
+        self._tap(points)
+
+    @timed_step
     def initialize_sdk(self):
-        self.get_initialize_sdk_button().click()
+        self._click('initialize_sdk_button')
 
+    @timed_step
     def send_event(self):
-        self.get_send_event_button().click()
-        self.get_flush_now_button().click()
+        self._tap([self._center('send_event_button'),
+                   self._center('flush_now_button')])
 
+    @timed_step
     def set_tracking_function(self, tracking_function):
-        self._tap_selector_option(
-            self.get_track_function_selector().rect,
-            4,
-            tracking_function.value)
+        self._tap([self._selector_option_point(
+            'track_function_selector', NUM_TRACKING_FUNCTIONS,
+            tracking_function.value)])
 
+    @timed_step
     def set_nil_object(self):
         self._set_sample_object_selector(0)
 
+    @timed_step
     def set_sample_object(self):
         self._set_sample_object_selector(1)
 
+    @timed_step
     def register_super_props(self):
-        self.get_register_super_props_button().click()
+        self._click('register_super_props_button')
 
+    @timed_step
     def clear_all_super_props(self):
-        self.get_clear_all_super_props_button().click()
+        self._click('clear_all_super_props_button')
 
+    @timed_step
     def add_duration_to_next_event(self):
-        self.get_add_duration_to_next_event_button().click()
+        self._click('add_duration_to_next_event_button')
 
     def scroll_down(self):
-        self.hide_keyboard()
-        self.driver.execute_script(
-            "mobile: scroll",
-            {"direction": "down"}
-        )
+        self._scroll(DOWN)
 
     def scroll_up(self):
-        self.hide_keyboard()
-        self.driver.execute_script(
-            "mobile: scroll",
-            {"direction": "up"}
-        )
+        self._scroll(UP)
 
-    def _set_sample_object_selector(self, option_idx):
-        self._tap_selector_option(
-            self.get_sample_object_selector().rect, 2, option_idx)
+    def _scroll(self, direction):
+        self.hide_keyboard()
+        self.driver.execute_script("mobile: scroll", {"direction": direction})
+        self.scrolled_to = direction
+        # elements keep their identity, but not their position on screen
+        self.rects = {}
 
-    def _tap_selector_option(self, rect, num_options, option_idx):
+    def get_element(self, name):
+        '''
+        returns the element, scrolling to it first when the screen isn't
+        known to be scrolled to where it is
+        '''
+        accessibility_id, position = ELEMENTS[name]
+        if position is not None and self.scrolled_to != position:
+            self._scroll(position)
+        element = self.elements.get(accessibility_id)
+        if element is not None:
+            return element
+        try:
+            element = self.driver.find_element_by_accessibility_id(
+                accessibility_id)
+        except selenium.common.exceptions.NoSuchElementException:
+            # e.g. hidden by the keyboard
+            self._scroll(position or UP)
+            element = self.driver.find_element_by_accessibility_id(
+                accessibility_id)
+        self.elements[accessibility_id] = element
+        return element
+
+    def _with_element(self, name, fn):
+        '''
+        calls fn with the element, looking the element up again if the
+        cached one went stale
+        '''
+        try:
+            return fn(self.get_element(name))
+        except selenium.common.exceptions.StaleElementReferenceException:
+            accessibility_id = ELEMENTS[name][0]
+            self.elements.pop(accessibility_id, None)
+            self.rects.pop(accessibility_id, None)
+            return fn(self.get_element(name))
+
+    def _click(self, name):
+        self._with_element(name, lambda element: element.click())
+
+    def _rect(self, name):
+        accessibility_id = ELEMENTS[name][0]
+        rect = self.rects.get(accessibility_id)
+        if rect is None:
+            rect = self.rects[accessibility_id] = self._with_element(
+                name, lambda element: element.rect)
+        return rect
+
+    def _center(self, name):
+        rect = self._rect(name)
+        return (rect['x'] + rect['width'] // 2,
+                rect['y'] + rect['height'] // 2)
+
+    def _selector_option_point(self, name, num_options, option_idx):
+        rect = self._rect(name)
         half_button_width = int(rect['width'] / num_options / 2)
-        self.driver.tap([[
-            rect['x'] + half_button_width + (
-                option_idx * 2 * half_button_width
-            ),
-            rect['y'] + 1
-        ]])
-
-    @scroll_up_wrapper
-    def get_token_text_box(self):
-        if self.token_text_box is None:
-            self.token_text_box = self.driver.find_element_by_accessibility_id(
-                'token_text_box')
-        return self.token_text_box
-
-    @scroll_up_wrapper
-    def get_server_text_box(self):
-        if self.server_text_box is None:
-            self.server_text_box = self.driver.find_element_by_accessibility_id(
-                'server_text_box')
-        return self.server_text_box
-
-    @scroll_up_wrapper
-    def get_event_type_text_box(self):
-        if self.event_type_text_box is None:
-            self.event_type_text_box = \
-                self.driver.find_element_by_accessibility_id(
-                    'event_type_text_box')
-        return self.event_type_text_box
-
-    @scroll_up_wrapper
-    def get_nil_event_type_switch(self):
-        if self.nil_event_type_switch is None:
-            self.nil_event_type_switch = \
-                self.driver.find_element_by_accessibility_id(
-                    'is_event_type_nil')
-        return self.nil_event_type_switch
-
-    @scroll_up_wrapper
-    def get_initialize_sdk_button(self):
-        if self.initialize_sdk_button is None:
-            self.initialize_sdk_button = \
-                self.driver.find_element_by_accessibility_id(
-                    'initialize_sdk_button')
-        return self.initialize_sdk_button
-
-    def get_send_event_button(self):
-        if self.send_event_button is None:
-            self.send_event_button = \
-                self.driver.find_element_by_accessibility_id(
-                    'send_event_button')
-        return self.send_event_button
-
-    def get_flush_now_button(self):
-        if self.flush_now_button is None:
-            self.flush_now_button = \
-                self.driver.find_element_by_accessibility_id(
-                    'flush_now_button')
-        return self.flush_now_button
-
-    @scroll_up_wrapper
-    def get_track_function_selector(self):
-        if self.track_function_selector is None:
-            self.track_function_selector = \
-                self.driver.find_element_by_accessibility_id(
-                    'track_method_selector')
-        return self.track_function_selector
-
-    def get_sample_object_selector(self):
-        if self.sample_object_selector is None:
-            self.sample_object_selector = \
-                self.driver.find_element_by_accessibility_id(
-                    'is_sample_object_included')
-        return self.sample_object_selector
-
-    @scroll_down_wrapper
-    def get_register_super_props_button(self):
-        if self.register_super_props_button is None:
-            self.register_super_props_button = \
-                self.driver.find_element_by_accessibility_id(
-                    'register_super_props_button')
-        return self.register_super_props_button
-
-    @scroll_down_wrapper
-    def get_clear_all_super_props_button(self):
-        if self.clear_all_super_props_button is None:
-            self.clear_all_super_props_button = \
-                self.driver.find_element_by_accessibility_id(
-                    'clear_all_super_props')
-        return self.clear_all_super_props_button
-
-    @scroll_down_wrapper
-    def get_add_duration_to_next_event_button(self):
-        if self.add_duration_to_next_event_button is None:
-            self.add_duration_to_next_event_button = \
-                self.driver.find_element_by_accessibility_id(
-                    'add_duration_to_next_event')
-        return self.add_duration_to_next_event_button
-
-    def _fill_in_text_box(self, textbox, content):
-        textbox.click()
-        textbox.clear()
-        textbox.send_keys(content)
-        self.hide_keyboard()
+        return (rect['x'] + half_button_width + (
+            option_idx * 2 * half_button_width), rect['y'] + 1)
+
+    def _tap(self, points):
+        '''taps all the points, in order, with a single request'''
+        action = TouchAction(self.driver)
+        for idx, (x, y) in enumerate(points):
+            if idx:
+                action.wait(BATCHED_TAP_WAIT_MS)
+            action.tap(x=x, y=y)
+        action.perform()
+
+    def _set_sample_object_selector(self, option_idx):
+        self._tap([self._selector_option_point(
+            'sample_object_selector', NUM_SAMPLE_OBJECT_OPTIONS, option_idx)])
+
+    def _read_nil_event_type(self):
+        # the switch is on ('1') when the event type is sent, and the
+        # event type is nil when it's off
+        return self._with_element(
+            'nil_event_type_switch', lambda element: element.text) == '0'
+
+    def _set_nil_event_type(self, nil):
+        if self.nil_event_type is None:
+            self.nil_event_type = self._read_nil_event_type()
+        if self.nil_event_type == nil:
+            return
+        self._click('nil_event_type_switch')
+        # the cached state may be stale, e.g. if the app reset the switch;
+        # the switch itself tells whether the click set it
+        self.nil_event_type = self._read_nil_event_type()
+        if self.nil_event_type != nil:
+            self._click('nil_event_type_switch')
+            self.nil_event_type = self._read_nil_event_type()
+        if self.nil_event_type != nil:
+            raise AssertionError('could not %s the event type switch' % (
+                'turn off' if nil else 'turn on'))
+
+    def _fill_in_text_boxes(self, text_boxes):
+        '''
+        types every (name, text) into its text box, skipping those already
+        holding their text, and hides the keyboard once at the end
+        '''
+        typed = False
+        for name, text in text_boxes:
+            if self.texts.get(name) == text:
+                continue
+
+            def fill_in(element):
+                element.click()
+                element.clear()
+                element.send_keys(text)
+            self._with_element(name, fill_in)
+            self.texts[name] = text
+            typed = True
+        if typed:
+            self.hide_keyboard()
 
     def close(self):
-        self.driver.quit()
+        '''returns the session to the pool, relaunching the app'''
+        if self.driver is not None:
+            self.pool.release(self.driver)
+            self.driver = None
+
+    def discard(self):
+        '''closes the session, e.g. when it broke'''
+        if self.driver is not None:
+            self.pool.discard(self.driver)
+            self.driver = None
@@ -1,23 +1,27 @@
+import atexit
 import unittest
 import sys
 import os
 import pdb
 import functools
 import traceback
-import random
 import logging
+import uuid
 import warnings
 
 import requests
-import yaretry
 import selenium
 
 import example_app_driver
+import sauce_connect
 
 
 logger = logging.getLogger(__name__)
 
 LEGACY_IOSSDK = os.environ.get('LEGACY_IOSSDK')
+SERVER_URL = 'http://127.0.0.1:8000'
+# seconds to wait for the events sent by a test to reach the server
+RECEIVE_TIMEOUT = 60
 
 DEFAULT_PROPERTIES = {
     '$app_release', '$app_version', '$lib_version', '$manufacturer', '$model',
@@ -60,6 +64,16 @@ def debug_on(*exceptions):
     return decorator
 
 
+@atexit.register
+def report_step_times():
+    if example_app_driver.STEP_TIMES:
+        sys.stderr.write('time spent per app driver step:\n%s\n' % (
+            example_app_driver.format_step_times()))
+    if sauce_connect.SETUP_TIMES:
+        sys.stderr.write('time spent setting up sauce labs:\n%s\n' % (
+            sauce_connect.format_setup_times()))
+
+
 def retry_on_driver_failure(fn):
     @functools.wraps(fn)
     def wrapper(self, *args, **kwargs):
@@ -73,34 +87,37 @@ def retry_on_driver_failure(fn):
 
 
 class ExampleAppTest(unittest.TestCase):
-
-    @classmethod
-    def setUpClass(cls):
-        cls.delete_received_events()
+    '''
+    tests only ever read and delete the events of their own token, so that
+    they can run in parallel against the same server (see
+    parallel_test_runner.py). the tests of a process reuse the appium
+    sessions of example_app_driver's pool
+    '''
 
     @retry_on_driver_failure
     def setUp(self):
         # unittest resets warnings filter on every test run
         warnings.simplefilter("ignore", ResourceWarning)
         self.init_app_driver()
-        self.test_token = 'TEST_TOKEN_%d' % random.randint(100, 999)
-        self.app_driver.set_token(self.test_token)
-        self.app_driver.initialize_sdk()
-        self.event_type = 'EVENT_TYPE_%d' % random.randint(100, 999)
-        self.app_driver.set_event_type(self.event_type)
-        self.app_driver.set_tracking_function(
-            example_app_driver.TrackingFunction.TRACK)
+        self.test_token = 'TEST_TOKEN_%s' % uuid.uuid4().hex
+        self.event_type = 'EVENT_TYPE_%s' % uuid.uuid4().hex[:8]
+        self.app_driver.configure(
+            server_url=SERVER_URL, token=self.test_token,
+            event_type=self.event_type,
+            tracking_function=example_app_driver.TrackingFunction.TRACK)
 
     def init_app_driver(self):
+        '''
+        takes a session from the pool of this process - that is, a running
+        app, relaunched since its previous test. a session that broke is
+        discarded
+        '''
+        if getattr(self, 'app_driver', None) is not None:
+            self.app_driver.discard()
         self.app_driver = example_app_driver.ExampleAppDriver()
-        self.app_driver.set_server('http://127.0.0.1:8000')
 
     def tearDown(self):
-        try:
-            self.app_driver.close()
-        except selenium.common.exceptions.InvalidSessionIdException:
-            # Session was already closed
-            pass
+        self.app_driver.close()
 
     @debug_on()
     def test_basic_event_sending(self):
@@ -261,17 +278,21 @@ class ExampleAppTest(unittest.TestCase):
                 set(received_events[1]['data']['properties'])))
         self.delete_received_events(self.test_token)
 
-    @yaretry.decorate(yaretry.Params(timeout=60))
-    def get_received_events(self, expected_token='', min_count=1):
-        url = 'http://127.0.0.1:8000/events/%s' % expected_token
-        res = requests.get(url).json()
-        if len(res['events']) < min_count:
+    def get_received_events(self, expected_token, min_count=1):
+        # the server holds the request until the events arrive
+        url = '%s/events/%s/wait' % (SERVER_URL, expected_token)
+        res = requests.get(url, params={
+            'count': min_count, 'timeout': RECEIVE_TIMEOUT},
+            timeout=RECEIVE_TIMEOUT + 10)
+        res.raise_for_status()
+        events = res.json()['events']
+        if len(events) < min_count:
             raise Exception('received %d of %d events (token=%s)' % (
-                len(res['events']), min_count, expected_token))
-        return res['events']
+                len(events), min_count, expected_token))
+        return events
 
     @staticmethod
-    def delete_received_events(token=''):
-        res = requests.delete('http://127.0.0.1:8000/events/%s' % token)
+    def delete_received_events(token):
+        res = requests.delete('%s/events/%s' % (SERVER_URL, token))
         res.raise_for_status()
         logger.info(res.json())
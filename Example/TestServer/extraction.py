@@ -0,0 +1,132 @@
+'''
+Extraction of hot event properties into typed, indexed columns of the
+events table, so that events can be filtered on them without parsing the
+stored json.
+'''
+import logging
+import re
+import sqlite3
+
+import codec
+
+
+COLUMN_TYPES = ('text', 'integer', 'real')
+# the properties extracted by default, and their types
+DEFAULT_COLUMNS = (
+    'event:text', 'distinct_id:text', 'session_id:text',
+    'message_index:integer', 'time:integer',
+)
+ADD_COLUMN_TPL = 'alter table {table} add column {name} {type};'
+CREATE_INDEX_TPL = 'create index if not exists {table}_{name}_idx ' \
+                   'on {table} ({name});'
+BACKFILL_TPL = 'update {table} set {name}=json_extract(data, ?) ' \
+               'where {name} is null;'
+TABLE_INFO_PRAGMA_TPL = 'pragma table_info({table});'
+
+_NAME = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+# columns of the events table, and query arguments of /events/, of
+# /events/<token>/wait and /stream, and of /track/, that extracted columns
+# must not shadow
+_RESERVED_NAMES = {'_id', 'date_created', 'token', 'data',
+                   'after', 'limit', 'since', 'until', 'format',
+                   'count', 'timeout', 'verbose'}
+
+logger = logging.getLogger(__name__)
+
+
+class ExtractedColumn:
+    '''
+    a column holding the value found at path in every event. 'event' is
+    taken from the top level of the event, every other name from its
+    properties
+    '''
+
+    def __init__(self, name, type='text'):
+        if not _NAME.match(name) or name.lower() in _RESERVED_NAMES:
+            raise ValueError('invalid column name: %s' % name)
+        if type not in COLUMN_TYPES:
+            raise ValueError('column type must be one of %s' % (
+                ', '.join(COLUMN_TYPES)))
+        self.name = name
+        self.type = type
+        self.path = (name, ) if name == 'event' else ('properties', name)
+
+    @classmethod
+    def parse(cls, spec):
+        '''parses a name[:type] spec, e.g. message_index:integer'''
+        name, _, type = spec.partition(':')
+        return cls(name, type or 'text')
+
+    def extract(self, event):
+        value = event
+        for key in self.path:
+            if not isinstance(value, dict):
+                return None
+            value = value.get(key)
+        if value is None:
+            return None
+        if self.type == 'text':
+            return value if isinstance(value, str) else codec.dumps(value)
+        if isinstance(value, (bool, dict, list)):
+            return None
+        try:
+            return int(value) if self.type == 'integer' else float(value)
+        except (TypeError, ValueError):
+            return None
+
+    def parse_arg(self, value):
+        '''converts a query string argument to the column's type'''
+        if self.type == 'integer':
+            return int(value)
+        if self.type == 'real':
+            return float(value)
+        return value
+
+    @property
+    def json_path(self):
+        return '$.' + '.'.join('"%s"' % key for key in self.path)
+
+
+def parse_columns(specs):
+    return [ExtractedColumn.parse(spec) for spec in specs]
+
+
+def insert_query(columns, table='events'):
+    names = ['token', 'data'] + [c.name for c in columns]
+    return 'insert into %s (%s) values (%s);' % (
+        table, ', '.join(names), ', '.join('?' * len(names)))
+
+
+def make_row(token, data, event, columns):
+    return (token, data) + tuple(c.extract(event) for c in columns)
+
+
+def sync_schema(db, columns, table='events'):
+    '''
+    adds a column and an index for every extracted column the events table
+    (or one of its partitions) doesn't have yet. existing events are
+    backfilled from their stored json when sqlite has the json1 functions;
+    otherwise their new column stays null and only events received from now
+    on can be filtered on it
+    '''
+    existing = {row[1] for row in db.execute(
+        TABLE_INFO_PRAGMA_TPL.format(table=table))}
+    for column in columns:
+        if column.name in existing:
+            with db:
+                db.execute(CREATE_INDEX_TPL.format(
+                    table=table, name=column.name))
+            continue
+        logger.info('adding extracted column %s %s', column.name, column.type)
+        with db:
+            db.execute(ADD_COLUMN_TPL.format(
+                table=table, name=column.name, type=column.type))
+            db.execute(CREATE_INDEX_TPL.format(
+                table=table, name=column.name))
+        try:
+            with db:
+                db.execute(BACKFILL_TPL.format(
+                    table=table, name=column.name), (column.json_path, ))
+        except sqlite3.OperationalError as e:
+            logger.warning('could not backfill column %s: %s',
+                           column.name, e)
@@ -0,0 +1,142 @@
+'''
+An in-memory cache of the events most recently stored for each token,
+already formatted as GET /events/<token> returns them.
+
+app.py adds events as it inserts them, so most reads of a token's recent
+events - tests and dashboards polling for what just arrived - are answered
+without a query. For every cached token, the cache holds every event whose
+_id is greater than the token's floor: a read with ?after= at or above the
+floor is answered from the cache, any other read goes to the database.
+
+Memory is bounded by max_bytes. When over it, the least recently used
+tokens are evicted; when a single token is over it, its oldest events are
+dropped and its floor raised.
+'''
+import bisect
+import collections
+import threading
+
+
+MAX_BYTES = 64 * 1024 * 1024
+# roughly what a cached event costs on top of its json: the str object,
+# and its _id and the slots of the lists holding them
+EVENT_OVERHEAD = 120
+
+
+class _TokenEvents:
+
+    def __init__(self, floor):
+        self.floor = floor
+        self.ids = []
+        self.events = []
+        self.size = 0
+
+
+class HotCache:
+
+    def __init__(self, max_bytes=MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # token -> _TokenEvents, least recently used first
+        self.tokens = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.trimmed = 0
+        self.invalidated = 0
+
+    def __contains__(self, token):
+        with self.lock:
+            return token in self.tokens
+
+    def add(self, token, events, floor=None):
+        '''
+        adds a token's (_id, json) events, in _id order, stored right after
+        the ones already cached. floor is where a token not cached yet
+        starts: the _id of its last event before these, or 0
+        '''
+        with self.lock:
+            entry = self.tokens.get(token)
+            if entry is None:
+                if floor is None:
+                    return
+                entry = self.tokens[token] = _TokenEvents(floor)
+            elif entry.ids and events[0][0] <= entry.ids[-1]:
+                # not in _id order after all; the database knows better
+                self._drop(token)
+                self.invalidated += 1
+                return
+            self.tokens.move_to_end(token)
+            for _id, event in events:
+                entry.ids.append(_id)
+                entry.events.append(event)
+            added = sum(len(e) + EVENT_OVERHEAD for _, e in events)
+            entry.size += added
+            self.size += added
+            self._evict(entry)
+
+    def get(self, token, after=0, limit=-1):
+        '''
+        returns the json of the token's events whose _id is greater than
+        after, up to limit of them (-1: all), or None if they aren't all
+        cached
+        '''
+        with self.lock:
+            entry = self.tokens.get(token)
+            if entry is None or after < entry.floor:
+                self.misses += 1
+                return None
+            self.tokens.move_to_end(token)
+            self.hits += 1
+            start = bisect.bisect_right(entry.ids, after)
+            end = len(entry.ids) if limit < 0 else start + limit
+            return entry.events[start:end]
+
+    def invalidate(self, tokens=None):
+        '''forgets the events of the given tokens, or of every token'''
+        with self.lock:
+            if tokens is None:
+                self.invalidated += len(self.tokens)
+                self.tokens.clear()
+                self.size = 0
+                return
+            for token in tokens:
+                if token in self.tokens:
+                    self._drop(token)
+                    self.invalidated += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'tokens': len(self.tokens),
+                'events': sum(len(e.ids) for e in self.tokens.values()),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evicted_tokens': self.evicted,
+                'trimmed_events': self.trimmed,
+                'invalidated_tokens': self.invalidated,
+            }
+
+    def _drop(self, token):
+        self.size -= self.tokens.pop(token).size
+
+    def _evict(self, current):
+        tokens = self.tokens
+        while self.size > self.max_bytes and len(tokens) > 1:
+            self._drop(next(iter(tokens)))
+            self.evicted += 1
+        # the most recently used token alone is over the budget
+        trim = 0
+        while self.size > self.max_bytes and trim < len(current.ids):
+            size = len(current.events[trim]) + EVENT_OVERHEAD
+            current.size -= size
+            self.size -= size
+            trim += 1
+        if trim:
+            current.floor = current.ids[trim - 1]
+            del current.ids[:trim]
+            del current.events[:trim]
+            self.trimmed += trim
@@ -0,0 +1,346 @@
+'''
+A synthetic load generator for app.py, behaving like a fleet of devices
+running the sdk.
+
+Every simulated device has its own session, numbers its events with
+message_index and queues them until it flushes, the way Alooma.m does:
+the queue keeps at most MAX_QUEUE_SIZE events, dropping the oldest, and is
+flushed in batches of up to BATCH_SIZE, one request at a time, each batch
+stamped with sending_time and sent as a base64, percent-escaped
+ip=1&data=... form body. A batch is only kept for the next flush when the
+request fails at the network level; like the sdk, it is dropped on any
+http response.
+
+Patterns:
+- steady: devices track events at a fixed total rate, each flushing every
+  flush interval, at a random phase.
+- burst: as steady, but all devices flush at the same moments, like a
+  fleet of apps whose flush timers were started together.
+- backlog: every device starts with a queue of queued events, e.g. after
+  being offline, and all of them drain it at once.
+'''
+import argparse
+import base64
+import json
+import random
+import threading
+import time
+import urllib.parse
+import uuid
+
+
+BATCH_SIZE = 50
+MAX_QUEUE_SIZE = 500
+# the flush interval of Alooma sharedInstanceWithToken:
+FLUSH_INTERVAL = 60
+PATTERNS = ('steady', 'burst', 'backlog')
+FORM_HEADERS = {'Content-Type': 'application/x-www-form-urlencoded'}
+AUTOMATIC_PROPERTIES = {
+    '$app_release': '1',
+    '$app_version': '1.0',
+    '$lib_version': '0.1.4',
+    '$manufacturer': 'Apple',
+    '$model': 'x86_64',
+    '$os': 'iPhone OS',
+    '$os_version': '12.1',
+    '$radio': 'None',
+    '$screen_height': 667,
+    '$screen_width': 375,
+    'mp_device_model': 'x86_64',
+    'mp_lib': 'iphone',
+}
+# as registered by the SampleApp's register_super_props_button
+SUPER_PROPERTIES = {
+    'super_prop_str': 'super properties',
+    'super_prop_float': 1.5,
+    'super_prop_bool': True,
+    'super_prop_int': 100,
+    'super_prop_date': '2019-01-01T10:00:00.000Z',
+    'super_prop_array': ['sup_arr_val1', 'sup_arr_val2', 'sup_arr_val3'],
+}
+
+
+def make_event(token, session_id, message_index, event_type='EVENT_TYPE',
+               super_properties=None):
+    '''
+    builds an event the way Alooma.m track:properties:customEvent: does,
+    with sending_time left as a placeholder until the batch is flushed
+    '''
+    properties = dict(AUTOMATIC_PROPERTIES)
+    properties.update({
+        'token': token,
+        'time': int(time.time()),
+        'distinct_id': session_id,
+        'session_id': session_id,
+        'message_index': message_index,
+        'sending_time': 0,
+    })
+    if super_properties:
+        properties.update(super_properties)
+    return {'event': event_type, 'properties': properties}
+
+
+def encode_batch(batch):
+    '''
+    mirrors flushQueue:endpoint: - stamps sending_time, then json, base64
+    and percent-escapes the batch into an ip=1&data=... form body
+    '''
+    sending_time = int(time.time())
+    for e in batch:
+        e['properties']['sending_time'] = sending_time
+    data = base64.b64encode(json.dumps(batch).encode()).decode()
+    return 'ip=1&data=%s' % urllib.parse.quote(data, safe='')
+
+
+def percentile(sorted_values, p):
+    idx = min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))
+    return sorted_values[idx]
+
+
+def http_poster(url):
+    '''
+    returns a post(body) function sending to url's /track/ over a single
+    keep-alive session. it returns the response status, and raises OSError
+    when the request fails at the network level
+    '''
+    import requests
+    session = requests.Session()
+    track_url = url.rstrip('/') + '/track/'
+
+    def post(body):
+        return session.post(track_url, data=body,
+                            headers=FORM_HEADERS).status_code
+    return post
+
+
+class Report:
+    '''counters and flush latencies, shared by all the devices of a run'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tracked = 0
+        self.dropped = 0
+        self.sent = 0
+        self.batches = 0
+        self.rejected_batches = 0
+        self.failed_batches = 0
+        self.bytes = 0
+        self.latencies = []
+        self.elapsed = None
+
+    def add_tracked(self, dropped):
+        with self.lock:
+            self.tracked += 1
+            self.dropped += dropped
+
+    def add_batch(self, num_events, num_bytes, status, latency):
+        with self.lock:
+            self.batches += 1
+            self.sent += num_events
+            self.bytes += num_bytes
+            self.latencies.append(latency)
+            if status != 200:
+                self.rejected_batches += 1
+
+    def add_failure(self):
+        with self.lock:
+            self.failed_batches += 1
+
+    def summary(self):
+        latencies = sorted(self.latencies) or [0]
+        elapsed = self.elapsed or float('inf')
+        return {
+            'elapsed': self.elapsed,
+            'tracked_events': self.tracked,
+            'dropped_events': self.dropped,
+            'sent_events': self.sent,
+            'batches': self.batches,
+            'rejected_batches': self.rejected_batches,
+            'failed_batches': self.failed_batches,
+            'events_per_second': self.sent / elapsed,
+            'batches_per_second': self.batches / elapsed,
+            'bytes_per_event': self.bytes / max(self.sent, 1),
+            'latency_ms': {
+                'p50': percentile(latencies, 50) * 1000,
+                'p90': percentile(latencies, 90) * 1000,
+                'p99': percentile(latencies, 99) * 1000,
+                'max': latencies[-1] * 1000,
+            },
+        }
+
+
+class Device:
+    '''a single sdk instance: its session, message_index and event queue'''
+
+    def __init__(self, token, super_properties=None):
+        self.token = token
+        self.super_properties = super_properties
+        self.session_id = str(uuid.uuid4())
+        self.message_index = 0
+        self.queue = []
+        self.next_flush = 0
+
+    def track(self, report, event_type='EVENT_TYPE'):
+        self.message_index += 1
+        self.queue.append(make_event(
+            self.token, self.session_id, self.message_index, event_type,
+            self.super_properties))
+        dropped = len(self.queue) > MAX_QUEUE_SIZE
+        if dropped:
+            del self.queue[0]
+        report.add_tracked(dropped)
+
+    def flush(self, post, report):
+        '''
+        sends the queue batch by batch, stopping at the first network
+        failure, and returns whether the queue was emptied
+        '''
+        while self.queue:
+            batch = self.queue[:BATCH_SIZE]
+            body = encode_batch(batch)
+            start = time.perf_counter()
+            try:
+                status = post(body)
+            except OSError:
+                report.add_failure()
+                return False
+            report.add_batch(len(batch), len(body),
+                             status, time.perf_counter() - start)
+            del self.queue[:len(batch)]
+        return True
+
+
+def make_devices(num_devices, num_tokens=1, super_properties=None):
+    return [Device('LOAD_TOKEN_%d' % (i % num_tokens), super_properties)
+            for i in range(num_devices)]
+
+
+def _run_tracking(devices, post, report, rate, start, end,
+                  flush_interval):
+    '''
+    the run loop of a share of the devices: tracks rate events per second
+    round robin over them, and flushes every device when it's due. what is
+    left queued at the end is flushed too, as the sdk does when the app
+    goes to the background
+    '''
+    tracked = 0
+    while True:
+        now = time.monotonic()
+        if now >= end:
+            break
+        if rate:
+            due = int((now - start) * rate) - tracked
+            for _ in range(due):
+                devices[tracked % len(devices)].track(report)
+                tracked += 1
+        for device in devices:
+            if device.next_flush <= now:
+                device.flush(post, report)
+                device.next_flush += flush_interval
+        next_event = start + (tracked + 1) / rate if rate else end
+        next_flush = min(device.next_flush for device in devices)
+        time.sleep(max(0, min(next_event, next_flush, end) -
+                       time.monotonic()))
+    for device in devices:
+        device.flush(post, report)
+
+
+def _run_draining(devices, post, report):
+    for device in devices:
+        device.flush(post, report)
+
+
+def run(make_post, devices, pattern='steady', concurrency=1, rate=100,
+        duration=10, flush_interval=FLUSH_INTERVAL, backlog=MAX_QUEUE_SIZE):
+    '''
+    runs a pattern over devices, split among concurrency threads, and
+    returns its Report. every thread posts with its own make_post()
+    function, which returns the status of a response and raises OSError on
+    network failures
+    '''
+    if pattern not in PATTERNS:
+        raise ValueError('pattern must be one of %s' % ', '.join(PATTERNS))
+    concurrency = max(1, min(concurrency, len(devices)))
+    report = Report()
+    if pattern == 'backlog':
+        for device in devices:
+            for _ in range(backlog):
+                device.track(report)
+
+    start = time.monotonic()
+    threads = []
+    for i in range(concurrency):
+        share = devices[i::concurrency]
+        if pattern == 'backlog':
+            target, args = _run_draining, (share, make_post(), report)
+        else:
+            for device in share:
+                phase = flush_interval if pattern == 'burst' else \
+                    random.uniform(0, flush_interval)
+                device.next_flush = start + phase
+            target, args = _run_tracking, (
+                share, make_post(), report, rate / concurrency, start,
+                start + duration, flush_interval)
+        threads.append(threading.Thread(target=target, args=args))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    report.elapsed = time.monotonic() - start
+    return report
+
+
+def format_report(summary):
+    return '\n'.join([
+        '%d events tracked (%d dropped from full queues), %d sent in %d '
+        'batches in %.2fs' % (
+            summary['tracked_events'], summary['dropped_events'],
+            summary['sent_events'], summary['batches'], summary['elapsed']),
+        '%.0f events/s, %.1f batches/s, %.0f bytes/event' % (
+            summary['events_per_second'], summary['batches_per_second'],
+            summary['bytes_per_event']),
+        '%d batches rejected, %d network failures' % (
+            summary['rejected_batches'], summary['failed_batches']),
+        'latency per batch: p50=%(p50).2fms p90=%(p90).2fms '
+        'p99=%(p99).2fms max=%(max).2fms' % summary['latency_ms'],
+    ])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        'load generator, posting to /track/ like a fleet of sdk devices')
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--pattern', default='steady', choices=PATTERNS)
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--tokens', type=int, default=1,
+                        help='number of tokens the devices are spread over')
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help='threads driving the devices, each with its '
+                             'own keep-alive connection')
+    parser.add_argument('--rate', type=float, default=1000,
+                        help='events tracked per second by all devices, '
+                             'for steady and burst')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds of tracking, for steady and burst')
+    parser.add_argument('--flush-interval', type=float, default=5,
+                        help='seconds between flushes of every device; '
+                             'the sdk default is %d' % FLUSH_INTERVAL)
+    parser.add_argument('--backlog', type=int, default=MAX_QUEUE_SIZE,
+                        help='events queued on every device, for backlog')
+    parser.add_argument('--super-properties', action='store_true',
+                        help="add the SampleApp's super properties to "
+                             "every event")
+    parser.add_argument('--json', action='store_true',
+                        help='print the report as json')
+    args = parser.parse_args()
+
+    devices = make_devices(
+        args.devices, args.tokens,
+        SUPER_PROPERTIES if args.super_properties else None)
+    report = run(lambda: http_poster(args.url), devices, args.pattern,
+                 args.concurrency, args.rate, args.duration,
+                 args.flush_interval, args.backlog)
+    if args.json:
+        print(json.dumps(report.summary()))
+    else:
+        print(format_report(report.summary()))
@@ -0,0 +1,221 @@
+'''
+Counters, histograms and gauges for app.py, rendered in the prometheus
+text exposition format.
+
+Every metric may have labels; the values of its labels are given, in the
+order of its label names, to inc(), observe() and time(). Updates take a
+lock and a bisect, a few microseconds, so they are meant to be made per
+request or per batch rather than per event.
+'''
+import bisect
+import collections
+import contextlib
+import threading
+import time
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# in seconds, from a fraction of a millisecond to a few seconds
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+RATE_WINDOW = 10
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', r'\\')
+                     .replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in pairs)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.type)]
+        lines.extend(self.samples())
+        return lines
+
+    def samples(self):
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name, help, label_names=()):
+        super().__init__(name, help, label_names)
+        self.values = collections.defaultdict(int)
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] += amount
+
+    def value(self, *label_values):
+        with self.lock:
+            return self.values.get(label_values, 0)
+
+    def samples(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        return ['%s%s %s' % (self.name,
+                             _format_labels(self.label_names, labels),
+                             _format_value(value))
+                for labels, value in values]
+
+
+class Histogram(Metric):
+    '''cumulative buckets of observed durations, as prometheus expects'''
+    type = 'histogram'
+
+    def __init__(self, name, help, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, label_names)
+        self.buckets = tuple(sorted(float(b) for b in buckets))
+        # labels -> [count per bucket (the last one is +Inf), sum]
+        self.values = {}
+
+    def observe(self, value, *label_values):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(label_values)
+            if entry is None:
+                entry = self.values[label_values] = [
+                    [0] * (len(self.buckets) + 1), 0.0]
+            entry[0][idx] += 1
+            entry[1] += value
+
+    @contextlib.contextmanager
+    def time(self, *label_values):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def count(self, *label_values):
+        with self.lock:
+            entry = self.values.get(label_values)
+            return sum(entry[0]) if entry else 0
+
+    def samples(self):
+        with self.lock:
+            values = sorted((labels, list(counts), total)
+                            for labels, (counts, total) in
+                            self.values.items())
+        lines = []
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'), ),
+                                    counts):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (
+                    self.name,
+                    _format_labels(self.label_names, labels,
+                                   [('le', _format_value(bound))]),
+                    cumulative))
+            label_text = _format_labels(self.label_names, labels)
+            lines.append('%s_sum%s %r' % (self.name, label_text, total))
+            lines.append('%s_count%s %d' % (self.name, label_text,
+                                            cumulative))
+        return lines
+
+
+class Gauge(Metric):
+    '''
+    a value read when the metrics are rendered: fn returns either a number
+    or, for a labeled gauge, a list of (label values, number). with
+    max_age, a value costly to read is read again only once it's that many
+    seconds old, or after reset()
+    '''
+    type = 'gauge'
+
+    def __init__(self, name, help, fn, label_names=(), max_age=0):
+        super().__init__(name, help, label_names)
+        self.fn = fn
+        self.max_age = max_age
+        self.read_at = None
+        self.values = None
+
+    def reset(self):
+        with self.lock:
+            self.read_at = None
+
+    def read(self):
+        if not self.max_age:
+            return self.fn()
+        # concurrent scrapes wait for a single read
+        with self.lock:
+            now = time.monotonic()
+            if self.read_at is None or now - self.read_at >= self.max_age:
+                self.values = self.fn()
+                self.read_at = now
+            return self.values
+
+    def samples(self):
+        values = self.read()
+        if not self.label_names:
+            values = [((), values)]
+        return ['%s%s %s' % (self.name,
+                             _format_labels(self.label_names, labels),
+                             _format_value(value))
+                for labels, value in values]
+
+
+class RateMeter:
+    '''the number of marked events per second, over the last window'''
+
+    def __init__(self, window=RATE_WINDOW):
+        self.window = window
+        self.lock = threading.Lock()
+        # (second, count) of the last window seconds
+        self.buckets = collections.deque()
+
+    def mark(self, count=1):
+        now = int(time.monotonic())
+        with self.lock:
+            if self.buckets and self.buckets[-1][0] == now:
+                self.buckets[-1][1] += count
+            else:
+                self.buckets.append([now, count])
+            self._expire(now)
+
+    def rate(self):
+        now = int(time.monotonic())
+        with self.lock:
+            self._expire(now)
+            return sum(count for _, count in self.buckets) / self.window
+
+    def _expire(self, now):
+        while self.buckets and self.buckets[0][0] <= now - self.window:
+            self.buckets.popleft()
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,31 @@
+'''
+Wakes up the requests waiting for new events whenever events are committed.
+'''
+import threading
+
+
+class EventNotifier:
+    '''
+    counts the commits made by this process, and lets threads wait for the
+    next one. commits made by other processes to the same database - e.g.
+    other prefork workers - are not seen, so waiters should also check
+    again every now and then
+    '''
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.version = 0
+
+    def notify(self):
+        with self.condition:
+            self.version += 1
+            self.condition.notify_all()
+
+    def wait(self, version, timeout):
+        '''
+        blocks until a commit is made after version was read, or until the
+        timeout expires, and returns the current version
+        '''
+        with self.condition:
+            self.condition.wait_for(lambda: self.version != version, timeout)
+            return self.version
@@ -0,0 +1,168 @@
+'''
+Runs unittest tests in parallel worker processes.
+
+Every worker is a python process of its own, running the tests it is handed
+one at a time, so whatever a test module keeps at module level - e.g. the
+appium session of example_app_test - is reused by all the tests that run in
+the same worker. Tests are handed out as workers become free.
+
+Every worker gets its index (0 .. workers - 1) in the TEST_WORKER_INDEX
+environment variable, which example_app_driver uses to give each worker a
+simulator of its own.
+
+    python3 parallel_test_runner.py --workers 3 example_app_test
+'''
+import argparse
+import json
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+import traceback
+import unittest
+
+
+WORKER_INDEX_ENV = 'TEST_WORKER_INDEX'
+OUTCOMES = ('ok', 'fail', 'error', 'skipped', 'expected failure',
+            'unexpected success')
+
+
+def iter_test_ids(suite):
+    for test in suite:
+        if isinstance(test, unittest.TestSuite):
+            yield from iter_test_ids(test)
+        else:
+            yield test.id()
+
+
+def discover(names):
+    '''the ids of the tests of the given modules, classes or methods'''
+    loader = unittest.defaultTestLoader
+    return list(iter_test_ids(loader.loadTestsFromNames(names)))
+
+
+def run_test(test_id):
+    '''runs a single test in this process, and returns its result'''
+    try:
+        test = unittest.defaultTestLoader.loadTestsFromName(test_id)
+    except Exception:
+        return {'test': test_id, 'outcome': 'error',
+                'details': traceback.format_exc(), 'seconds': 0}
+    result = unittest.TestResult()
+    start = time.perf_counter()
+    test.run(result)
+    seconds = time.perf_counter() - start
+    outcome, details = 'ok', ''
+    if result.errors:
+        outcome, details = 'error', result.errors[0][1]
+    elif result.failures:
+        outcome, details = 'fail', result.failures[0][1]
+    elif result.skipped:
+        outcome, details = 'skipped', result.skipped[0][1]
+    elif result.expectedFailures:
+        outcome = 'expected failure'
+    elif result.unexpectedSuccesses:
+        outcome = 'unexpected success'
+    return {'test': test_id, 'outcome': outcome, 'details': details,
+            'seconds': seconds}
+
+
+def worker_main():
+    '''
+    reads test ids from stdin, one per line, and writes a json result line
+    for each to stdout. whatever the tests print goes to stderr instead
+    '''
+    results = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    for line in sys.stdin:
+        result = run_test(line.strip())
+        result['worker'] = int(os.environ.get(WORKER_INDEX_ENV, 0))
+        results.write(json.dumps(result) + '\n')
+        results.flush()
+
+
+def _feed_worker(index, tests, results, lock, on_result):
+    env = dict(os.environ)
+    env[WORKER_INDEX_ENV] = str(index)
+    worker = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), '--worker'],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env,
+        universal_newlines=True, cwd=os.getcwd())
+    try:
+        while True:
+            try:
+                test_id = tests.get_nowait()
+            except queue.Empty:
+                break
+            worker.stdin.write(test_id + '\n')
+            worker.stdin.flush()
+            line = worker.stdout.readline()
+            if not line:
+                result = {'test': test_id, 'outcome': 'error',
+                          'details': 'worker %d exited' % index,
+                          'seconds': 0, 'worker': index}
+            else:
+                result = json.loads(line)
+            with lock:
+                results.append(result)
+                on_result(result)
+            if not line:
+                break
+    finally:
+        # closing stdin lets the worker exit normally, running its atexit
+        # handlers (e.g. closing its appium session)
+        worker.stdin.close()
+        worker.wait()
+
+
+def run(test_ids, workers=2, on_result=lambda result: None):
+    '''runs the tests over workers processes, and returns their results'''
+    tests = queue.Queue()
+    for test_id in test_ids:
+        tests.put(test_id)
+    results = []
+    lock = threading.Lock()
+    threads = [
+        threading.Thread(target=_feed_worker,
+                         args=(i, tests, results, lock, on_result))
+        for i in range(max(1, min(workers, len(test_ids))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def print_result(result):
+    print('%s ... %s (%.1fs, worker %d)' % (
+        result['test'], result['outcome'], result['seconds'],
+        result['worker']), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['--worker']:
+        worker_main()
+        sys.exit(0)
+    parser = argparse.ArgumentParser('parallel unittest runner')
+    parser.add_argument('names', nargs='+',
+                        help='test modules, classes or methods')
+    parser.add_argument('--workers', type=int, default=2)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    results = run(discover(args.names), args.workers, print_result)
+    elapsed = time.perf_counter() - start
+    failed = [r for r in results if r['outcome'] in
+              ('fail', 'error', 'unexpected success')]
+    for r in failed:
+        print('=' * 70, file=sys.stderr)
+        print('%s: %s' % (r['outcome'].upper(), r['test']), file=sys.stderr)
+        print(r['details'], file=sys.stderr)
+    counts = [(sum(r['outcome'] == outcome for r in results), outcome)
+              for outcome in OUTCOMES]
+    print('ran %d tests in %.1fs over %d workers: %s' % (
+        len(results), elapsed, args.workers,
+        ', '.join('%d %s' % c for c in counts if c[0])), file=sys.stderr)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,326 @@
+'''
+Time partitioning of the events table, used by app.py with --partition.
+
+Events are inserted into a table per hour or day, events_p<start>, start
+being the unix time the partition starts at. Partitions are created, with
+the columns and indexes of the events table, by the first insert of their
+period. The events table itself keeps the events stored before partitioning
+was turned on, and is read before the partitions.
+
+A partition is seeded with the greatest _id handed out so far, and events
+are never inserted into a partition older than the newest one, so _ids keep
+increasing from one partition to the next: reading the tables in turn reads
+the events in _id order, and pagination with ?after= works unchanged.
+
+With a retention, expired partitions are dropped whole, rather than their
+events deleted one by one, and the pages they held are then given back to
+the filesystem a few at a time with sqlite's incremental vacuum, so that
+writers never wait long for the cleanup.
+'''
+import logging
+import re
+import threading
+import time
+
+import extraction
+import storage
+
+
+WIDTHS = {'hour': 3600, 'day': 86400}
+EVENTS_TABLE = 'events'
+_PARTITION_NAME = re.compile(r'^events_p(\d+)$')
+# date_created is set by sqlite as an event is inserted, a moment after its
+# partition was chosen, and clocks may step back a little; the time bounds
+# of partitions are widened by this many seconds either way
+SLACK = 60
+RETENTION_INTERVAL = 60
+VACUUM_STEP_PAGES = 256
+VACUUM_STEP_PAUSE = 0.01
+DELETE_CHUNK_SIZE = 10000
+
+SCHEMA_VERSION_PRAGMA = 'pragma schema_version;'
+AUTO_VACUUM_PRAGMA = 'pragma auto_vacuum;'
+ENABLE_INCREMENTAL_VACUUM_PRAGMA = 'pragma auto_vacuum=incremental;'
+AUTO_VACUUM_INCREMENTAL = 2
+FREELIST_COUNT_PRAGMA = 'pragma freelist_count;'
+INCREMENTAL_VACUUM_PRAGMA_TPL = 'pragma incremental_vacuum({pages});'
+LIST_PARTITIONS_QUERY = "select name from sqlite_master where type='table' " \
+                        "and name like 'events\\_p%' escape '\\';"
+CREATE_PARTITION_TPL = '''\
+create table if not exists {table} (
+  _id integer primary key autoincrement,
+  date_created datetime default current_timestamp,
+  token varchar,
+  data blob{columns}
+);'''
+PARTITION_INDEX_TPLS = [
+    'create index if not exists {table}_token_idx on {table} (token);',
+    'create index if not exists {table}_date_created_idx '
+    'on {table} (date_created);',
+]
+# sqlite_sequence holds the greatest _id handed out by every autoincrement
+# table, until the table is dropped
+SEED_SEQUENCE_QUERY = \
+    'insert into sqlite_sequence (name, seq) ' \
+    'select ?, (select max(seq) from sqlite_sequence) ' \
+    'where exists (select 1 from sqlite_sequence) ' \
+    'and not exists (select 1 from sqlite_sequence where name=?);'
+KEEP_SEQUENCE_QUERY = \
+    'update sqlite_sequence set seq=(select max(seq) from sqlite_sequence) ' \
+    'where name=?;'
+DROP_TABLE_TPL = 'drop table if exists {table};'
+SECURE_DELETE_PRAGMA = 'pragma secure_delete;'
+SECURE_DELETE_PRAGMA_TPL = 'pragma secure_delete={value};'
+DELETE_EXPIRED_QUERY = 'delete from events where _id in (' \
+                       'select _id from events where date_created<? ' \
+                       'order by _id limit ?);'
+
+logger = logging.getLogger(__name__)
+
+
+def partition_name(start):
+    return 'events_p%d' % start
+
+
+def format_time(t):
+    return time.strftime(storage.TIMESTAMP_FORMAT, time.gmtime(t))
+
+
+def enable_incremental_vacuum(db):
+    '''
+    makes the pages freed by dropped partitions reclaimable. a database that
+    has tables already is rebuilt for it, once
+    '''
+    if db.execute(AUTO_VACUUM_PRAGMA).fetchone()[0] == \
+            AUTO_VACUUM_INCREMENTAL:
+        return
+    db.execute(ENABLE_INCREMENTAL_VACUUM_PRAGMA)
+    logger.info('vacuuming to enable incremental vacuum')
+    db.execute('vacuum;')
+
+
+class Partitions:
+    '''
+    the partitions of a database file, width seconds each, created with the
+    extracted columns given. the list of partitions is cached until the
+    database's schema changes
+    '''
+
+    def __init__(self, width, columns=()):
+        self.width = width
+        self.columns = list(columns)
+        self.lock = threading.Lock()
+        self.schema_version = None
+        self.starts = []
+        self.created = 0
+        self.dropped = 0
+
+    def starts_of(self, db):
+        '''the starts of the partitions, oldest first'''
+        version = db.execute(SCHEMA_VERSION_PRAGMA).fetchone()[0]
+        with self.lock:
+            if version == self.schema_version:
+                return self.starts
+        starts = []
+        for (name, ) in db.execute(LIST_PARTITIONS_QUERY):
+            match = _PARTITION_NAME.match(name)
+            if match:
+                starts.append(int(match.group(1)))
+        starts.sort()
+        with self.lock:
+            self.schema_version = version
+            self.starts = starts
+        return starts
+
+    def tables(self, db, since=None, until=None):
+        '''
+        the events table and the partitions, in _id order, leaving out the
+        partitions which can't hold events stored between since and until,
+        given as TIMESTAMP_FORMAT strings
+        '''
+        starts = self.starts_of(db)
+        tables = [EVENTS_TABLE]
+        for idx, start in enumerate(starts):
+            if until and format_time(start - SLACK) > until:
+                break
+            if since and idx + 1 < len(starts) and \
+                    format_time(starts[idx + 1] + SLACK) <= since:
+                continue
+            tables.append(partition_name(start))
+        return tables
+
+    def insert_table(self, db, now):
+        '''
+        the partition to insert into at unix time now, created if need be.
+        db must be in a transaction holding the write lock, so that the
+        partition it returns stays the newest one until it commits
+        '''
+        starts = self.starts_of(db)
+        start = int(now // self.width * self.width)
+        if starts and starts[-1] >= start:
+            return partition_name(starts[-1])
+        table = partition_name(start)
+        columns = ''.join(',\n  %s %s' % (c.name, c.type)
+                          for c in self.columns)
+        db.execute(CREATE_PARTITION_TPL.format(table=table, columns=columns))
+        for tpl in PARTITION_INDEX_TPLS:
+            db.execute(tpl.format(table=table))
+        for c in self.columns:
+            db.execute(extraction.CREATE_INDEX_TPL.format(
+                table=table, name=c.name))
+        db.execute(SEED_SEQUENCE_QUERY, (table, table))
+        with self.lock:
+            self.created += 1
+        logger.info('created partition %s', table)
+        return table
+
+    def expired(self, db, cutoff):
+        '''
+        the partitions holding only events stored before unix time cutoff.
+        the newest one is never expired, as events are inserted into it
+        '''
+        starts = self.starts_of(db)
+        return [partition_name(start)
+                for start, next_start in zip(starts, starts[1:])
+                if next_start + SLACK <= cutoff]
+
+    def drop(self, db, tables):
+        '''
+        drops partitions in a single transaction - db's current one, if it
+        is in one - and commits it. the events table takes over the greatest
+        _id handed out, so that _ids are never reused
+        '''
+        # with secure_delete, which some builds of sqlite turn on by default,
+        # every freed page is overwritten: dropping takes ten times longer
+        secure_delete = db.execute(SECURE_DELETE_PRAGMA).fetchone()[0]
+        db.execute(SECURE_DELETE_PRAGMA_TPL.format(value=0))
+        try:
+            with db:
+                db.execute(KEEP_SEQUENCE_QUERY, (EVENTS_TABLE, ))
+                db.execute(SEED_SEQUENCE_QUERY, (EVENTS_TABLE, EVENTS_TABLE))
+                for table in tables:
+                    db.execute(DROP_TABLE_TPL.format(table=table))
+        finally:
+            db.execute(SECURE_DELETE_PRAGMA_TPL.format(value=secure_delete))
+        with self.lock:
+            self.dropped += len(tables)
+        logger.info('dropped partitions %s', ', '.join(tables))
+
+    def stats(self):
+        with self.lock:
+            return {
+                'partitions': len(self.starts),
+                'created': self.created,
+                'dropped': self.dropped,
+            }
+
+
+def delete_expired(db, cutoff, chunk_size=DELETE_CHUNK_SIZE):
+    '''
+    deletes the events of the events table stored before unix time cutoff,
+    chunk_size at a time, and returns how many there were
+    '''
+    cutoff = format_time(cutoff)
+    deleted = 0
+    while True:
+        with db:
+            cursor = db.execute(DELETE_EXPIRED_QUERY, (cutoff, chunk_size))
+        deleted += cursor.rowcount
+        if cursor.rowcount < chunk_size:
+            return deleted
+
+
+def vacuum(db, step_pages=VACUUM_STEP_PAGES, pause=VACUUM_STEP_PAUSE,
+           stopping=None):
+    '''
+    gives the free pages of the database back to the filesystem, step_pages
+    per transaction, and returns how many there were
+    '''
+    vacuumed = 0
+    while not (stopping and stopping.is_set()):
+        free_pages = db.execute(FREELIST_COUNT_PRAGMA).fetchone()[0]
+        if not free_pages:
+            break
+        # execute() would only step the pragma once, freeing a single page
+        db.executescript(INCREMENTAL_VACUUM_PRAGMA_TPL.format(
+            pages=step_pages))
+        vacuumed += min(free_pages, step_pages)
+        time.sleep(pause)
+    return vacuumed
+
+
+class Retention:
+    '''
+    Drops the expired partitions of every shard from a background thread,
+    every interval seconds: those whose events were all stored more than
+    max_age seconds ago. pools and partitions are the shards' connection
+    pools and Partitions. on_drop, if given, is called after partitions were
+    dropped or events deleted.
+    '''
+
+    def __init__(self, pools, partitions, max_age,
+                 interval=RETENTION_INTERVAL, on_drop=None):
+        self.pools = pools
+        self.partitions = partitions
+        self.max_age = max_age
+        self.interval = interval
+        self.on_drop = on_drop
+        self.stopping = threading.Event()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.runs = 0
+        self.dropped = 0
+        self.deleted = 0
+        self.vacuumed = 0
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self._run, name='retention', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+
+    def run_once(self, now=None):
+        cutoff = (time.time() if now is None else now) - self.max_age
+        dropped = deleted = vacuumed = 0
+        for pool, partitions in zip(self.pools, self.partitions):
+            db = pool.acquire()
+            try:
+                expired = partitions.expired(db, cutoff)
+                if expired:
+                    partitions.drop(db, expired)
+                    dropped += len(expired)
+                num_deleted = delete_expired(db, cutoff)
+                deleted += num_deleted
+                if (expired or num_deleted) and self.on_drop is not None:
+                    self.on_drop()
+                vacuumed += vacuum(db, stopping=self.stopping)
+            finally:
+                pool.release(db)
+        with self.lock:
+            self.runs += 1
+            self.dropped += dropped
+            self.deleted += deleted
+            self.vacuumed += vacuumed
+
+    def stats(self):
+        with self.lock:
+            return {
+                'max_age': self.max_age,
+                'runs': self.runs,
+                'dropped_partitions': self.dropped,
+                'deleted_events': self.deleted,
+                'vacuumed_pages': self.vacuumed,
+            }
+
+    def _run(self):
+        while not self.stopping.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception('retention failed')
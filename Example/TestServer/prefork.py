@@ -0,0 +1,81 @@
+'''
+A minimal prefork server: the listening socket is bound once, and every
+forked worker runs its own threaded werkzeug server accepting on it, so
+requests are spread across processes (and cores) by the kernel.
+'''
+import logging
+import os
+import signal
+import socket
+import sys
+
+import werkzeug.serving
+
+
+LISTEN_BACKLOG = 128
+
+logger = logging.getLogger(__name__)
+
+
+def _raise_system_exit(signum, frame):
+    sys.exit(0)
+
+
+def serve(app, host, port, workers, on_worker_start=None,
+          on_worker_exit=None):
+    '''
+    forks workers and blocks until all of them exited. SIGTERM or SIGINT to
+    this (master) process is forwarded to the workers, which then run
+    on_worker_exit and exit.
+    '''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, int(port)))
+    sock.listen(LISTEN_BACKLOG)
+    sock.set_inheritable(True)
+
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            _run_worker(app, host, port, sock, on_worker_start, on_worker_exit)
+        children.append(pid)
+    sock.close()
+    logger.info('serving on %s:%s with %d workers', host, port, workers)
+
+    def forward_signal(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    signal.signal(signal.SIGTERM, forward_signal)
+    signal.signal(signal.SIGINT, forward_signal)
+    while children:
+        try:
+            pid, _ = os.wait()
+        except ChildProcessError:
+            break
+        if pid in children:
+            children.remove(pid)
+
+
+def _run_worker(app, host, port, sock, on_worker_start, on_worker_exit):
+    exit_code = 0
+    try:
+        signal.signal(signal.SIGTERM, _raise_system_exit)
+        signal.signal(signal.SIGINT, _raise_system_exit)
+        if on_worker_start is not None:
+            on_worker_start()
+        server = werkzeug.serving.make_server(
+            host, int(port), app, threaded=True, fd=sock.fileno())
+        server.serve_forever()
+    except SystemExit:
+        pass
+    except Exception:
+        logger.exception('worker %d failed', os.getpid())
+        exit_code = 1
+    finally:
+        if on_worker_exit is not None:
+            on_worker_exit()
+        os._exit(exit_code)
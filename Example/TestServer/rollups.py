@@ -0,0 +1,288 @@
+'''
+Rollups of the events received by app.py: per token, event type and time
+bucket, the number of events, and the count, sum and percentiles of the
+$duration of timed events (see timeEvent: in Alooma.m).
+
+app.py adds every stored batch to the rollups, so /rollups/<token> reads
+one entry per bucket rather than scanning the events. An event's bucket is
+taken from its time property - when it was tracked - or, when it has none,
+from when it was received. Rollups are kept in memory, and may be rebuilt
+from the stored events at any time.
+
+Percentiles come from a log-scale histogram of durations, as in DDSketch:
+a duration is counted in the bin of its logarithm in base GAMMA, which
+estimates it within RELATIVE_ACCURACY. Histograms merge by adding up their
+bins, so that buckets are combined into coarser ones exactly.
+'''
+import calendar
+import collections
+import math
+import threading
+import time
+
+import codec
+import storage
+
+
+BUCKET = 60
+# a week of buckets
+MAX_AGE = 7 * 24 * 3600
+# an event tracked later than this after it was received - by a device with
+# a wrong clock - is counted when it was received
+MAX_CLOCK_SKEW = 3600
+REBUILD_CHUNK_SIZE = 1000
+PERCENTILES = (50, 90, 99)
+RELATIVE_ACCURACY = 0.01
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+_LOG_GAMMA = math.log(GAMMA)
+# the bin of durations of 0 or less, which timed events may have with a
+# clock that stepped back
+ZERO_BIN = float('-inf')
+
+
+def duration_bin(duration):
+    if duration <= 0:
+        return ZERO_BIN
+    return math.ceil(math.log(duration) / _LOG_GAMMA)
+
+
+def bin_value(index):
+    '''the duration a bin stands for, within RELATIVE_ACCURACY of any in it'''
+    if index == ZERO_BIN:
+        return 0.0
+    return 2 * GAMMA ** index / (GAMMA + 1)
+
+
+def _number_property(event, name):
+    properties = event.get('properties')
+    if not isinstance(properties, dict):
+        return None
+    value = properties.get(name)
+    if type(value) not in (int, float) or not math.isfinite(value):
+        return None
+    return value
+
+
+def event_time(event, received):
+    '''the unix time an event is counted at'''
+    t = _number_property(event, 'time')
+    if t is None or t > received + MAX_CLOCK_SKEW:
+        return received
+    return t
+
+
+class Rollup:
+    '''the events of a token and event type in a bucket'''
+    __slots__ = ('count', 'duration_count', 'duration_sum', 'bins')
+
+    def __init__(self):
+        self.count = 0
+        self.duration_count = 0
+        self.duration_sum = 0.0
+        # duration bin -> number of durations in it
+        self.bins = collections.Counter()
+
+    def merge(self, other):
+        self.count += other.count
+        self.duration_count += other.duration_count
+        self.duration_sum += other.duration_sum
+        self.bins.update(other.bins)
+
+    def percentile(self, p):
+        '''the p-th percentile of the durations, or None without any'''
+        if not self.duration_count:
+            return None
+        rank = p / 100 * (self.duration_count - 1)
+        seen = 0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if rank < seen:
+                return bin_value(index)
+        return bin_value(max(self.bins))
+
+    def to_json(self, percentiles=PERCENTILES):
+        result = {'count': self.count}
+        if self.duration_count:
+            duration = {'count': self.duration_count,
+                        'sum': round(self.duration_sum, 6)}
+            for p in percentiles:
+                duration['p%g' % p] = round(self.percentile(p), 6)
+            result['duration'] = duration
+        return result
+
+
+class Rollups:
+    '''
+    the rollups of every token, in buckets of bucket seconds. buckets that
+    started more than max_age seconds before the newest one are dropped
+    '''
+
+    def __init__(self, bucket=BUCKET, max_age=MAX_AGE):
+        self.bucket = bucket
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        # token -> event type -> bucket start -> Rollup
+        self.tokens = {}
+        self.newest = 0
+        self.oldest = 0
+        # the number of events in the rollups
+        self.events = 0
+        self.rebuilds = 0
+
+    def add(self, batch, received=None):
+        '''
+        adds a batch of (token, data, event) tuples. received is the unix
+        time events without a time property are counted at, now by default
+        '''
+        received = time.time() if received is None else received
+        self._merge(self._roll(
+            (token, event, received) for token, _, event in batch))
+
+    def _roll(self, events):
+        '''
+        rolls up (token, event, received time) items on their own, so that
+        the shared rollups are then updated once per token, type and bucket
+        rather than once per event
+        '''
+        rolled = {}
+        for token, event, received in events:
+            start = int(event_time(event, received) // self.bucket *
+                        self.bucket)
+            key = (token, event.get('event'), start)
+            rollup = rolled.get(key)
+            if rollup is None:
+                rollup = rolled[key] = Rollup()
+            rollup.count += 1
+            duration = _number_property(event, '$duration')
+            if duration is not None:
+                rollup.duration_count += 1
+                rollup.duration_sum += duration
+                rollup.bins[duration_bin(duration)] += 1
+        return rolled
+
+    def _merge(self, rolled):
+        with self.lock:
+            for (token, event_type, start), rollup in rolled.items():
+                if start < self.oldest:
+                    continue
+                buckets = self.tokens.setdefault(token, {}).setdefault(
+                    event_type, {})
+                existing = buckets.get(start)
+                if existing is None:
+                    buckets[start] = rollup
+                else:
+                    existing.merge(rollup)
+                if start > self.newest:
+                    self.newest = start
+                self.events += rollup.count
+            if self.newest - self.max_age > self.oldest:
+                self._expire(self.newest - self.max_age)
+
+    def query(self, token, event_type=None, since=None, until=None,
+              bucket=None):
+        '''
+        returns the token's rollups as a list of (start, event type,
+        Rollup), in order, for the buckets starting between since and until
+        (unix times, inclusive). bucket, a multiple of the rollups' bucket,
+        merges them into coarser buckets
+        '''
+        bucket = bucket or self.bucket
+        result = {}
+        with self.lock:
+            types = self.tokens.get(token, {})
+            if event_type is not None:
+                types = {event_type: types[event_type]} \
+                    if event_type in types else {}
+            for name, buckets in types.items():
+                for start, rollup in buckets.items():
+                    if since is not None and start < since:
+                        continue
+                    if until is not None and start > until:
+                        continue
+                    key = (start // bucket * bucket, name)
+                    merged = result.get(key)
+                    if merged is None:
+                        merged = result[key] = Rollup()
+                    merged.merge(rollup)
+        return sorted(((start, name, rollup)
+                       for (start, name), rollup in result.items()),
+                      key=lambda r: (r[0], r[1] or ''))
+
+    def forget(self, token=None):
+        '''drops the rollups of a token, or of every token'''
+        with self.lock:
+            if token is None:
+                self.tokens = {}
+                self.events = 0
+            else:
+                self.events -= _count(self.tokens.pop(token, {}))
+
+    def rebuild(self, event_store, token=None):
+        '''
+        replaces the rollups of a token, or of every token, with rollups of
+        the events event_store holds, and returns how many there were.
+        events received while rebuilding are only counted if the rebuild
+        reads them
+        '''
+        rebuilt = Rollups(self.bucket, self.max_age)
+        num_events = 0
+        parsed_times = {}
+        chunk = []
+        with event_store.connections() as connect:
+            for _, date_created, event_token, data in event_store.select(
+                    storage.EventFilter(token), connect=connect):
+                received = parsed_times.get(date_created)
+                if received is None:
+                    received = parsed_times[date_created] = calendar.timegm(
+                        time.strptime(date_created, storage.TIMESTAMP_FORMAT))
+                chunk.append((event_token, codec.loads(data), received))
+                if len(chunk) == REBUILD_CHUNK_SIZE:
+                    rebuilt._merge(rebuilt._roll(chunk))
+                    num_events += len(chunk)
+                    chunk = []
+        rebuilt._merge(rebuilt._roll(chunk))
+        num_events += len(chunk)
+        with self.lock:
+            if token is None:
+                self.tokens = rebuilt.tokens
+            else:
+                self.tokens.pop(token, None)
+                if token in rebuilt.tokens:
+                    self.tokens[token] = rebuilt.tokens[token]
+            self.newest = max(self.newest, rebuilt.newest)
+            # the rebuilt buckets may be older than those kept
+            self.events = sum(_count(types) for types in self.tokens.values())
+            self._expire(max(self.oldest, self.newest - self.max_age))
+            self.rebuilds += 1
+        return num_events
+
+    def stats(self):
+        with self.lock:
+            series = sum(len(types) for types in self.tokens.values())
+            buckets = sum(len(buckets) for types in self.tokens.values()
+                          for buckets in types.values())
+            return {
+                'bucket': self.bucket,
+                'tokens': len(self.tokens),
+                'series': series,
+                'buckets': buckets,
+                'events': self.events,
+                'rebuilds': self.rebuilds,
+            }
+
+    def _expire(self, oldest):
+        for token, types in list(self.tokens.items()):
+            for event_type, buckets in list(types.items()):
+                for start in [s for s in buckets if s < oldest]:
+                    self.events -= buckets.pop(start).count
+                if not buckets:
+                    del types[event_type]
+            if not types:
+                del self.tokens[token]
+        self.oldest = oldest
+
+
+def _count(types):
+    '''the number of events in the rollups of a token'''
+    return sum(rollup.count for buckets in types.values()
+               for rollup in buckets.values())
@@ -1,72 +1,313 @@
-import sys
-import subprocess
-import select
+'''
+Test setup for running the tests against a Sauce Labs simulator: the Sauce
+Connect tunnel, which lets the simulator reach the test webserver, and the
+upload of SampleApp.app to Sauce storage.
+
+Both are slow, and independent of each other, so they are started together:
+start_tunnel() and upload_app_file_async() return at once, with futures that
+wait_until_ready() waits for when the first session is created.
+
+The app is zipped into a cache directory, under the hash of its content, so
+an unchanged build is neither zipped nor uploaded again: a manifest in the
+cache directory records the hash of every file uploaded. Sauce storage only
+keeps files for a week, so uploads older than UPLOAD_MAX_AGE are redone.
+
+SETUP_TIMES records where setup time went, for format_setup_times().
+'''
 import atexit
+import base64
+import concurrent.futures
+import hashlib
+import json
+import os
+import stat
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+import zipfile
 
 # download sauce connect from https://saucelabs.com/downloads/sc-4.5.2-osx.zip
-SAUCE_CONNECT_PATH = '/Users/ramamar/Downloads/sc-4.5.2-osx/bin/sc'
+SAUCE_CONNECT_PATH = os.environ.get(
+    'SAUCE_CONNECT_PATH', '/Users/ramamar/Downloads/sc-4.5.2-osx/bin/sc')
 CONNECTED_MESSAGE = "Sauce Connect is up, you may start your tests."
 FINISHED_MESSAGE = "Finished! Deleting tunnel."
+TUNNEL_TIMEOUT = 120
+STORAGE_URL = os.environ.get(
+    'SAUCE_STORAGE_URL', 'https://saucelabs.com/rest/v1/storage')
+CACHE_DIR = os.environ.get(
+    'SAUCE_APP_CACHE_DIR', os.path.expanduser('~/.cache/iossdk_sauce_apps'))
+MANIFEST_FILENAME = 'manifest.json'
+# zips of older builds kept in the cache directory
+MAX_CACHED_ZIPS = 3
+# sauce storage deletes files after 7 days
+UPLOAD_MAX_AGE = 6 * 24 * 3600
+HASH_CHUNK_SIZE = 1024 * 1024
+# every entry gets the same timestamp, so that a zip only depends on what
+# the app holds
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
 
-# Code copied from https://github.com/appium-boneyard/sample-code/blob/master/sample-code/examples/python/sauce_connect.py
-def set_up_tunnel():
-    # Setting up Sauce Connect 4.x tunnel
-    # May need to change ./sc/bin/sc depending on OS and directory structure
-    p = subprocess.Popen(
-        ['%s -u $SAUCE_USERNAME -k $SAUCE_ACCESS_KEY' % SAUCE_CONNECT_PATH],
-        shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    print("[Sauce Connect]: Waiting for tunnel setup, this make take up to 30s")
-    print("For detailed documentation on Sauce Connect please refer to " \
-          "http://https://docs.saucelabs.com/reference/sauce-connect/")
-    is_ready = False
-    while not is_ready:
-        reads = [p.stdout.fileno(), p.stderr.fileno()]
-        ret = select.select(reads, [], [])
-
-        for fd in ret[0]:
-            if fd == p.stdout.fileno():
-                read = p.stdout.readline()
-                sys.stdout.write("[Sauce Connect]: %s\n" % read)
-
-                if CONNECTED_MESSAGE.encode() in read:
-                    print("[Sauce Connect]: Tunnel ready, running the test")
-                    is_ready = True
-
-            if fd == p.stderr.fileno():
-                read = p.stderr.readline()
-                sys.stderr.write("[Sauce Connect]: %s\n" % read)
-                if FINISHED_MESSAGE.encode() in read:
-                    p.terminate()
-                    raise Exception("Sauce Connect could not start!")
-            if p.poll():
-                raise Exception("Sauce Connect could not start!")
-    atexit.register(tear_down_tunnel, p)
-
-
-def tear_down_tunnel(tunnel_process):
-    print('Terminating sauce connect process')
-    tunnel_process.terminate()
-
-
-UPLOAD_FILE_CMD = '''\
-zip -r ./{remote_filename} {local_app_path} \\
-&& curl -u $SAUCE_USERNAME:$SAUCE_ACCESS_KEY \\
--X POST \\
--H 'Content-Type: application/octet-stream' \\
-https://saucelabs.com/rest/v1\
-/storage/$SAUCE_USERNAME/{remote_filename}?overwrite=true \\
---data-binary '@./{remote_filename}' \\
-&& rm ./{remote_filename}
-'''
+# (step, seconds, note) of every setup step of this process, in the order
+# they ended
+SETUP_TIMES = []
+_setup_times_lock = threading.Lock()
+
+
+def _record(step, start, note=''):
+    with _setup_times_lock:
+        SETUP_TIMES.append((step, time.perf_counter() - start, note))
+
+
+def format_setup_times():
+    return '\n'.join('%-10s %7.2fs %s' % (step, seconds, note)
+                     for step, seconds, note in SETUP_TIMES)
+
+
+def _run_in_thread(fn, *args, **kwargs):
+    '''calls fn in a thread of its own, and returns a future of its result'''
+    future = concurrent.futures.Future()
+
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+
+class Tunnel:
+    '''
+    a Sauce Connect process. ready is a future set once the tunnel is up,
+    or failed if the process exits before
+    '''
+
+    def __init__(self, args):
+        self.args = args
+        self.process = None
+        self.started = None
+        self.ready = concurrent.futures.Future()
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.process = subprocess.Popen(
+            self.args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        atexit.register(self.close)
+        print("[Sauce Connect]: Waiting for tunnel setup, this make take up "
+              "to 30s")
+        print("For detailed documentation on Sauce Connect please refer to "
+              "https://docs.saucelabs.com/reference/sauce-connect/")
+        threading.Thread(target=self._watch, name='sauce-connect',
+                         daemon=True).start()
+        return self
+
+    def _watch(self):
+        # stdout and stderr are read together, so that neither pipe fills
+        # up and blocks the process
+        for line in self.process.stdout:
+            line = line.decode(errors='replace').rstrip()
+            sys.stdout.write("[Sauce Connect]: %s\n" % line)
+            if CONNECTED_MESSAGE in line and not self.ready.done():
+                print("[Sauce Connect]: Tunnel ready, running the test")
+                _record('tunnel', self.started)
+                self.ready.set_result(self)
+            elif FINISHED_MESSAGE in line:
+                break
+        if not self.ready.done():
+            self.close()
+            self.ready.set_exception(
+                Exception("Sauce Connect could not start!"))
+
+    def close(self):
+        if self.process is not None and self.process.poll() is None:
+            print('Terminating sauce connect process')
+            self.process.terminate()
+            self.process.wait()
+
+
+def start_tunnel(args=None):
+    '''
+    starts Sauce Connect - SAUCE_CONNECT_PATH, with the account of the
+    SAUCE_USERNAME and SAUCE_ACCESS_KEY environment variables, by default -
+    and returns its Tunnel without waiting for it
+    '''
+    if args is None:
+        args = [SAUCE_CONNECT_PATH, '-u', os.environ['SAUCE_USERNAME'],
+                '-k', os.environ['SAUCE_ACCESS_KEY']]
+    return Tunnel(args).start()
+
+
+def set_up_tunnel(timeout=TUNNEL_TIMEOUT):
+    '''starts Sauce Connect and waits for the tunnel to be up'''
+    tunnel = start_tunnel()
+    try:
+        return tunnel.ready.result(timeout)
+    except concurrent.futures.TimeoutError:
+        tunnel.close()
+        raise Exception("Sauce Connect could not start!")
+
+
+def wait_until_ready(futures, timeout=TUNNEL_TIMEOUT):
+    '''
+    waits for the tunnel and the upload futures given, raising their errors
+    '''
+    start = time.perf_counter()
+    waited = not all(f.done() for f in futures)
+    for future in futures:
+        future.result(timeout=max(0, timeout - (time.perf_counter() - start)))
+    if waited:
+        _record('wait', start, 'for the tunnel and the upload')
+
+
+def _app_files(local_app_path):
+    '''the (relative path, full path) of every file and link, in order'''
+    files = []
+    base = os.path.dirname(os.path.abspath(local_app_path))
+    for root, dirs, filenames in os.walk(local_app_path):
+        dirs.sort()
+        # os.walk lists links to directories with the directories
+        names = filenames + [d for d in dirs
+                             if os.path.islink(os.path.join(root, d))]
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            files.append((os.path.relpath(path, base), path))
+    return files
+
+
+def content_hash(local_app_path):
+    '''
+    the sha256 of the app's relative paths, modes, link targets and file
+    contents - not of their times, which every build changes
+    '''
+    digest = hashlib.sha256()
+    for relative_path, path in _app_files(local_app_path):
+        mode = os.lstat(path).st_mode
+        digest.update(b'%s\0%o\0' % (relative_path.encode(), mode))
+        if stat.S_ISLNK(mode):
+            digest.update(os.readlink(path).encode())
+        else:
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def zip_app(local_app_path, cache_dir=CACHE_DIR, app_hash=None):
+    '''
+    returns the path of a zip of the app, named after its content hash,
+    zipping it only if that zip isn't cached already
+    '''
+    if app_hash is None:
+        start = time.perf_counter()
+        app_hash = content_hash(local_app_path)
+        _record('hash', start)
+    zip_path = os.path.join(cache_dir, '%s.zip' % app_hash)
+    if os.path.exists(zip_path):
+        os.utime(zip_path)
+        _record('zip', time.perf_counter(), 'cached')
+        return zip_path
+    start = time.perf_counter()
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = '%s.%d.tmp' % (zip_path, os.getpid())
+    with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED) as z:
+        for relative_path, path in _app_files(local_app_path):
+            mode = os.lstat(path).st_mode
+            info = zipfile.ZipInfo(relative_path, ZIP_DATE_TIME)
+            info.external_attr = mode << 16
+            if stat.S_ISLNK(mode):
+                z.writestr(info, os.readlink(path))
+                continue
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with open(path, 'rb') as src, z.open(info, 'w') as dst:
+                for chunk in iter(lambda: src.read(HASH_CHUNK_SIZE), b''):
+                    dst.write(chunk)
+    os.replace(tmp_path, zip_path)
+    _remove_old_zips(cache_dir)
+    _record('zip', start, '%d bytes' % os.path.getsize(zip_path))
+    return zip_path
+
+
+def _remove_old_zips(cache_dir, keep=MAX_CACHED_ZIPS):
+    zips = sorted((os.path.join(cache_dir, name)
+                   for name in os.listdir(cache_dir) if name.endswith('.zip')),
+                  key=os.path.getmtime, reverse=True)
+    for path in zips[keep:]:
+        os.remove(path)
+
+
+def read_manifest(cache_dir=CACHE_DIR):
+    '''remote file -> {sha256, uploaded_at} of the files uploaded'''
+    try:
+        with open(os.path.join(cache_dir, MANIFEST_FILENAME)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _write_manifest(cache_dir, manifest):
+    path = os.path.join(cache_dir, MANIFEST_FILENAME)
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def _upload(zip_path, url, username, access_key):
+    with open(zip_path, 'rb') as f:
+        request = urllib.request.Request(url, data=f, method='POST', headers={
+            'Content-Type': 'application/octet-stream',
+            'Content-Length': str(os.path.getsize(zip_path)),
+            'Authorization': 'Basic %s' % base64.b64encode(
+                ('%s:%s' % (username, access_key)).encode()).decode(),
+        })
+        with urllib.request.urlopen(request) as response:
+            return json.loads(response.read() or b'{}')
+
+
+def upload_app_file(local_app_path, remote_filename, cache_dir=CACHE_DIR,
+                    storage_url=STORAGE_URL, username=None, access_key=None,
+                    force=False):
+    '''
+    uploads a zip of the app to sauce storage as remote_filename, unless
+    the same content was uploaded there already. returns whether it was
+    uploaded
+    '''
+    username = username or os.environ['SAUCE_USERNAME']
+    access_key = access_key or os.environ['SAUCE_ACCESS_KEY']
+    start = time.perf_counter()
+    app_hash = content_hash(local_app_path)
+    _record('hash', start)
+    key = '%s/%s' % (username, remote_filename)
+    uploaded = read_manifest(cache_dir).get(key)
+    if not force and uploaded and uploaded['sha256'] == app_hash and \
+            time.time() - uploaded['uploaded_at'] < UPLOAD_MAX_AGE:
+        _record('upload', time.perf_counter(), 'skipped, unchanged')
+        return False
+    zip_path = zip_app(local_app_path, cache_dir, app_hash)
+    start = time.perf_counter()
+    url = '%s/%s/%s?overwrite=true' % (storage_url, username, remote_filename)
+    print('Uploading %s to %s' % (zip_path, url))
+    try:
+        response = _upload(zip_path, url, username, access_key)
+    except OSError as e:
+        raise Exception('Failed uploading file to saucelabs: %s' % e)
+    with open(zip_path, 'rb') as f:
+        md5 = hashlib.md5(f.read()).hexdigest()
+    if response.get('md5', md5) != md5:
+        raise Exception('Failed uploading file to saucelabs: md5 %s, '
+                        'expected %s' % (response['md5'], md5))
+    # read again, as another process may have uploaded meanwhile
+    manifest = read_manifest(cache_dir)
+    manifest[key] = {'sha256': app_hash, 'uploaded_at': time.time()}
+    _write_manifest(cache_dir, manifest)
+    _record('upload', start, '%d bytes' % os.path.getsize(zip_path))
+    return True
 
 
-def upload_app_file(local_app_path, remote_filename):
-    cmd = UPLOAD_FILE_CMD.format(
-        local_app_path=local_app_path,
-        remote_filename=remote_filename
-    )
-    print('Running: %s' % cmd)
-    p = subprocess.Popen([cmd], shell=True)
-    p.wait()
-    if p.returncode != 0:
-        raise Exception('Failed uploading file to saucelabs')
+def upload_app_file_async(*args, **kwargs):
+    '''upload_app_file() in a thread, returning a future of its result'''
+    return _run_in_thread(upload_app_file, *args, **kwargs)
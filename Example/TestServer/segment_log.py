@@ -0,0 +1,628 @@
+'''
+An append-only, segmented log of events: the storage of app.py with
+--storage log, instead of SQLite.
+
+Events are appended to the current segment file, and once it grows past
+segment_size it is sealed and a new one started. A segment is named after
+the first _id it may hold, and is a sequence of records of
+
+    length (4 bytes) | crc32 of the payload (4 bytes) | payload
+
+little endian, so that a record torn by a crash - only ever the last one -
+is detected, and cut off, on open. A payload starts with its kind:
+
+    EVENT      _id (8) | unix time (8, double) | len(token) (2) | token | data
+    TOMBSTONE  count (4) | the _ids of count deleted events (8 each)
+    PURGE      _id (8): every event with a smaller _id is deleted
+
+The index - the location of every event, and the _ids of every token - is
+kept in memory only, and rebuilt by reading the segments on open. Deletes
+append a tombstone rather than rewriting anything; compaction, in a
+background thread, rewrites the sealed segments that are mostly deleted
+events, and removes those left empty.
+
+Appends are written with a single write() per batch and fsynced by a
+background thread, according to sync:
+- group: an append returns once an fsync covers it; appends made while an
+  fsync is running share the next one.
+- interval: the log is fsynced every sync_interval seconds, and appends
+  return as soon as they are written - like SQLite's synchronous=normal,
+  the last interval may be lost on power loss, but not on a crash.
+- off: left to the OS, until the log is closed.
+'''
+import bisect
+import contextlib
+import fcntl
+import itertools
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+
+import codec
+import storage
+
+
+SYNC_MODES = ('group', 'interval', 'off')
+SEGMENT_SIZE = 64 * 1024 * 1024
+SYNC_INTERVAL = 0.05
+# sealed segments are compacted once this much of them is deleted events
+COMPACTION_RATIO = 0.5
+COMPACTION_INTERVAL = 30
+# the number of events read from the log per lock acquisition
+READ_CHUNK_SIZE = 500
+MAX_TOMBSTONE_IDS = 64 * 1024
+SEGMENT_NAME_TPL = '%020d.log'
+LOCK_FILE = 'LOCK'
+
+EVENT, TOMBSTONE, PURGE = 1, 2, 3
+RECORD_HEADER = struct.Struct('<II')
+EVENT_HEADER = struct.Struct('<BQdH')
+TOMBSTONE_HEADER = struct.Struct('<BI')
+PURGE_RECORD = struct.Struct('<BQ')
+
+logger = logging.getLogger(__name__)
+
+
+class CorruptLogError(Exception):
+    pass
+
+
+def encode_record(payload):
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def iter_records(buf):
+    '''
+    yields (offset, size, payload) for the records of a segment's contents,
+    and stops at the first incomplete or corrupt one. the offset after the
+    last valid record is returned
+    '''
+    offset = 0
+    while offset + RECORD_HEADER.size <= len(buf):
+        length, crc = RECORD_HEADER.unpack_from(buf, offset)
+        end = offset + RECORD_HEADER.size + length
+        payload = bytes(buf[offset + RECORD_HEADER.size:end])
+        if end > len(buf) or zlib.crc32(payload) != crc:
+            break
+        yield offset, end - offset, payload
+        offset = end
+    return offset
+
+
+def format_time(t):
+    return time.strftime(storage.TIMESTAMP_FORMAT, time.gmtime(t))
+
+
+class Segment:
+    def __init__(self, directory, base_id):
+        self.base_id = base_id
+        self.path = os.path.join(directory, SEGMENT_NAME_TPL % base_id)
+        self.fd = None
+        self.size = 0
+        self.dead_bytes = 0
+
+
+class SegmentLogStore(storage.EventStore):
+    name = 'log'
+
+    def __init__(self, directory, segment_size=SEGMENT_SIZE, sync='interval',
+                 sync_interval=SYNC_INTERVAL,
+                 compaction_interval=COMPACTION_INTERVAL,
+                 compaction_ratio=COMPACTION_RATIO, on_commit=None):
+        super().__init__(on_commit)
+        if sync not in SYNC_MODES:
+            raise ValueError('sync must be one of %s' % ', '.join(SYNC_MODES))
+        self.directory = directory
+        self.segment_size = segment_size
+        self.sync = sync
+        self.sync_interval = sync_interval
+        self.compaction_interval = compaction_interval
+        self.compaction_ratio = compaction_ratio
+        # guards the segments and the index. reads hold it while reading a
+        # chunk of events, so that compaction can't swap a segment under them
+        self.lock = threading.Lock()
+        # held while fsyncing, and while closing a replaced segment's file
+        self.sync_lock = threading.Lock()
+        self.sync_condition = threading.Condition()
+        self.compaction_lock = threading.Lock()
+        self.compaction_wakeup = threading.Event()
+        self.lock_fd = None
+        self.segments = []
+        self.threads = []
+        self.closing = False
+        self._reset()
+
+    def _reset(self):
+        self.segments = []
+        # _id -> (segment, offset, size, token, date_created)
+        self.events = {}
+        self.token_ids = {}
+        self.all_ids = []
+        # the _ids of deleted events still in all_ids, which readers skip
+        self.stale_ids = 0
+        # _id -> the segment still holding a deleted event
+        self.dead = {}
+        self.next_id = 1
+        # positions in the log, counted in bytes ever written
+        self.written = 0
+        self.synced = 0
+        self.fsyncs = 0
+        self.compactions = 0
+        self.truncated_bytes = 0
+
+    # opening and closing
+
+    def open(self):
+        if self.lock_fd is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        lock_fd = os.open(os.path.join(self.directory, LOCK_FILE),
+                          os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(lock_fd)
+            raise RuntimeError('%s is used by another process' %
+                               self.directory)
+        self.lock_fd = lock_fd
+        self._reset()
+        self._recover()
+        self.closing = False
+        self.threads = [threading.Thread(
+            target=self._compaction_loop, name='log-compaction', daemon=True)]
+        if self.sync != 'off':
+            self.threads.append(threading.Thread(
+                target=self._sync_loop, name='log-sync', daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    def close(self):
+        if self.lock_fd is None:
+            return
+        with self.sync_condition:
+            self.closing = True
+            self.sync_condition.notify_all()
+        self.compaction_wakeup.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self.compaction_wakeup.clear()
+        with self.lock:
+            self._fsync(self.segments[-1])
+            for segment in self.segments:
+                os.close(segment.fd)
+            self.segments = []
+        os.close(self.lock_fd)
+        self.lock_fd = None
+
+    def _segment_paths(self):
+        names = sorted(name for name in os.listdir(self.directory)
+                       if name.endswith('.log') and name[:-4].isdigit())
+        return [(int(name[:-4]), name) for name in names]
+
+    def _recover(self):
+        '''rebuilds the index from the segments, and opens the last one'''
+        for name in os.listdir(self.directory):
+            if name.endswith('.compact'):
+                # a compaction interrupted before replacing its segment
+                os.unlink(os.path.join(self.directory, name))
+        paths = self._segment_paths()
+        formatted_times = {}
+        for idx, (base_id, _) in enumerate(paths):
+            segment = Segment(self.directory, base_id)
+            segment.fd = os.open(segment.path, os.O_RDWR | os.O_APPEND)
+            with open(segment.path, 'rb') as f:
+                buf = f.read()
+            records = iter_records(buf)
+            while True:
+                try:
+                    offset, size, payload = next(records)
+                except StopIteration as stop:
+                    end = stop.value
+                    break
+                self._apply(segment, offset, size, payload, formatted_times)
+            if end < len(buf):
+                if idx != len(paths) - 1:
+                    raise CorruptLogError(
+                        'corrupt record in %s at offset %d' % (
+                            segment.path, end))
+                logger.warning('truncating a torn record from %s at %d',
+                               segment.path, end)
+                os.ftruncate(segment.fd, end)
+                self.truncated_bytes += len(buf) - end
+            segment.size = end
+            self.segments.append(segment)
+            self.next_id = max(self.next_id, base_id)
+        if not self.segments or \
+                self.segments[-1].size >= self.segment_size:
+            self._start_segment()
+        self.written = self.synced = sum(s.size for s in self.segments)
+
+    def _apply(self, segment, offset, size, payload, formatted_times):
+        kind = payload[0]
+        if kind == EVENT:
+            _, _id, created, token_length = EVENT_HEADER.unpack_from(payload)
+            token = payload[EVENT_HEADER.size:
+                            EVENT_HEADER.size + token_length].decode()
+            date_created = formatted_times.get(created)
+            if date_created is None:
+                date_created = formatted_times[created] = \
+                    format_time(created)
+            self.events[_id] = (segment, offset, size, token, date_created)
+            self.token_ids.setdefault(token, []).append(_id)
+            self.all_ids.append(_id)
+            self.next_id = max(self.next_id, _id + 1)
+        elif kind == TOMBSTONE:
+            _, count = TOMBSTONE_HEADER.unpack_from(payload)
+            ids = struct.unpack_from('<%dQ' % count, payload,
+                                     TOMBSTONE_HEADER.size)
+            self._mark_dead([_id for _id in ids if _id in self.events])
+        elif kind == PURGE:
+            _, purged_id = PURGE_RECORD.unpack_from(payload)
+            self._mark_dead([_id for _id in self.all_ids
+                             if _id < purged_id and _id in self.events])
+            self.next_id = max(self.next_id, purged_id)
+        else:
+            raise CorruptLogError('unknown record kind %d in %s at %d' % (
+                kind, segment.path, offset))
+        segment.size = offset + size
+
+    def _start_segment(self):
+        '''
+        seals the current segment, if any, and starts a new one - unless the
+        current one is still empty
+        '''
+        if self.segments:
+            if not self.segments[-1].size:
+                return
+            self._fsync(self.segments[-1])
+        segment = Segment(self.directory, self.next_id)
+        segment.fd = os.open(segment.path,
+                             os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        self.segments.append(segment)
+        self._fsync_directory()
+
+    def _fsync(self, segment):
+        os.fsync(segment.fd)
+        self.fsyncs += 1
+
+    def _fsync_directory(self):
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    # writing
+
+    def _write(self, records):
+        '''writes the records to the current segment. called with the lock'''
+        segment = self.segments[-1]
+        data = b''.join(records)
+        view = memoryview(data)
+        while view:
+            view = view[os.write(segment.fd, view):]
+        offset = segment.size
+        segment.size += len(data)
+        self.written += len(data)
+        return segment, offset
+
+    def append(self, events):
+        '''always takes the batch: the log has no queue to fill up'''
+        if not events:
+            return True
+        created = time.time()
+        date_created = format_time(created)
+        with self.lock:
+            records = []
+            for token, data, _ in events:
+                token = token.encode()
+                if isinstance(data, str):
+                    data = data.encode()
+                records.append(encode_record(EVENT_HEADER.pack(
+                    EVENT, self.next_id + len(records), created,
+                    len(token)) + token + data))
+            segment, offset = self._write(records)
+            for (token, _, _), record in zip(events, records):
+                _id = self.next_id
+                self.next_id += 1
+                self.events[_id] = (segment, offset, len(record), token,
+                                    date_created)
+                self.token_ids.setdefault(token, []).append(_id)
+                self.all_ids.append(_id)
+                offset += len(record)
+            position = self.written
+            if segment.size >= self.segment_size:
+                self._start_segment()
+        if self.sync == 'group':
+            self._wait_synced(position)
+        if self.on_commit is not None:
+            self.on_commit()
+        return True
+
+    def _wait_synced(self, position):
+        with self.sync_condition:
+            self.sync_condition.notify_all()
+            while self.synced < position and not self.closing:
+                self.sync_condition.wait()
+
+    def _sync_loop(self):
+        while True:
+            with self.sync_condition:
+                if self.sync == 'group':
+                    while self.synced == self.written and not self.closing:
+                        self.sync_condition.wait()
+                else:
+                    self.sync_condition.wait(self.sync_interval)
+                if self.closing:
+                    return
+            with self.sync_lock:
+                with self.lock:
+                    segment, position = self.segments[-1], self.written
+                if position > self.synced:
+                    self._fsync(segment)
+            with self.sync_condition:
+                self.synced = max(self.synced, position)
+                self.sync_condition.notify_all()
+
+    def flush(self):
+        '''makes everything appended so far durable'''
+        with self.sync_lock:
+            with self.lock:
+                self._fsync(self.segments[-1])
+                position = self.written
+        with self.sync_condition:
+            self.synced = max(self.synced, position)
+            self.sync_condition.notify_all()
+
+    # reading
+
+    def connections(self):
+        return contextlib.nullcontext()
+
+    def _ids(self, event_filter):
+        if event_filter.token:
+            return self.token_ids.get(event_filter.token, [])
+        return self.all_ids
+
+    def _read(self, segment, offset, size):
+        payload = os.pread(segment.fd, size, offset)[RECORD_HEADER.size:]
+        token_length = EVENT_HEADER.unpack_from(payload)[3]
+        return payload[EVENT_HEADER.size + token_length:].decode()
+
+    def _iter_matching(self, event_filter, after, read=True):
+        '''
+        yields the matching (_id, date_created, token, data) rows, data being
+        None unless read. only the index is used, unless data is read or
+        the filter has conditions on extracted columns
+        '''
+        last = after
+        while True:
+            chunk = []
+            with self.lock:
+                # the id lists are appended to, and replaced on deletes, so
+                # every chunk starts from the last _id seen rather than an
+                # index
+                ids = self._ids(event_filter)
+                idx = bisect.bisect_right(ids, last)
+                window = ids[idx:idx + READ_CHUNK_SIZE]
+                for _id in window:
+                    entry = self.events.get(_id)
+                    if entry is None or not event_filter.matches_row(
+                            entry[3], entry[4]):
+                        continue
+                    data = None
+                    if read or event_filter.conditions:
+                        data = self._read(*entry[:3])
+                    chunk.append((_id, entry[4], entry[3], data))
+            for row in chunk:
+                if event_filter.conditions and not \
+                        event_filter.matches_event(codec.loads(row[3])):
+                    continue
+                yield row
+            if len(window) < READ_CHUNK_SIZE:
+                return
+            last = window[-1]
+
+    def select(self, event_filter, after=0, limit=-1, connect=None):
+        rows = self._iter_matching(event_filter, after)
+        if limit > 0:
+            return (row for _, row in zip(range(limit), rows))
+        return rows
+
+    def count(self, event_filter, after=0, connect=None):
+        if not (event_filter.since or event_filter.until or
+                event_filter.conditions):
+            with self.lock:
+                ids = self._ids(event_filter)
+                idx = bisect.bisect_right(ids, after)
+                if event_filter.token or not self.stale_ids:
+                    return len(ids) - idx
+                if not idx:
+                    return len(self.events)
+                return sum(1 for _id in itertools.islice(ids, idx, None)
+                           if _id in self.events)
+        return sum(1 for _ in self._iter_matching(
+            event_filter, after, read=False))
+
+    # deleting and compaction
+
+    def delete(self, event_filter):
+        if event_filter.token or event_filter.since or \
+                event_filter.until or event_filter.conditions:
+            ids = [row[0] for row in self._iter_matching(
+                event_filter, 0, read=False)]
+            with self.lock:
+                ids = [_id for _id in ids if _id in self.events]
+                records = [encode_record(
+                    TOMBSTONE_HEADER.pack(TOMBSTONE, len(chunk)) +
+                    struct.pack('<%dQ' % len(chunk), *chunk))
+                    for chunk in (ids[i:i + MAX_TOMBSTONE_IDS] for i in
+                                  range(0, len(ids), MAX_TOMBSTONE_IDS))]
+                if records:
+                    self._write(records)
+                    self._fsync(self.segments[-1])
+                self._mark_dead(ids)
+        else:
+            ids = self._purge()
+        if ids:
+            self.compaction_wakeup.set()
+        return len(ids)
+
+    def _purge(self):
+        '''
+        deletes every event: a PURGE record starts a new segment, and all
+        the segments before it are removed right away
+        '''
+        with self.compaction_lock, self.lock:
+            ids = list(self.events)
+            self._start_segment()
+            self._write([encode_record(
+                PURGE_RECORD.pack(PURGE, self.next_id))])
+            self._fsync(self.segments[-1])
+            removed, self.segments = self.segments[:-1], self.segments[-1:]
+            self._mark_dead(ids)
+            self.dead.clear()
+            for segment in removed:
+                os.unlink(segment.path)
+        with self.sync_lock:
+            for segment in removed:
+                os.close(segment.fd)
+        return ids
+
+    def _mark_dead(self, ids):
+        '''
+        removes deleted events from the index. only the id lists of their
+        tokens are rebuilt: all_ids keeps their _ids, skipped by readers,
+        until they are half of it
+        '''
+        tokens = set()
+        for _id in ids:
+            segment, _, size, token, _ = self.events.pop(_id)
+            segment.dead_bytes += size
+            self.dead[_id] = segment
+            tokens.add(token)
+        live = self.events
+        for token in tokens:
+            # rebuilt rather than edited in place, for readers iterating them
+            token_list = [_id for _id in self.token_ids[token] if _id in live]
+            if token_list:
+                self.token_ids[token] = token_list
+            else:
+                del self.token_ids[token]
+        self.stale_ids += len(ids)
+        if self.stale_ids * 2 >= len(self.all_ids):
+            self.all_ids = [_id for _id in self.all_ids if _id in live]
+            self.stale_ids = 0
+
+    def compact(self):
+        '''
+        rewrites the sealed segments of which at least compaction_ratio is
+        deleted events, and returns the number of segments rewritten
+        '''
+        with self.compaction_lock:
+            with self.lock:
+                candidates = [
+                    s for s in self.segments[:-1]
+                    if s.size and s.dead_bytes / s.size >=
+                    self.compaction_ratio]
+            for segment in candidates:
+                self._compact_segment(segment)
+            return len(candidates)
+
+    def _compact_segment(self, segment):
+        buf = os.pread(segment.fd, segment.size, 0)
+        with self.lock:
+            kept, dropped = [], []
+            for offset, size, payload in iter_records(buf):
+                kind = payload[0]
+                if kind == EVENT:
+                    _id = EVENT_HEADER.unpack_from(payload)[1]
+                    if _id in self.events:
+                        kept.append((_id, payload))
+                    else:
+                        dropped.append(_id)
+                elif kind == TOMBSTONE:
+                    # a tombstone is only needed while the events it deletes
+                    # are still in some other segment
+                    _, count = TOMBSTONE_HEADER.unpack_from(payload)
+                    ids = [_id for _id in struct.unpack_from(
+                        '<%dQ' % count, payload, TOMBSTONE_HEADER.size)
+                        if self.dead.get(_id) not in (None, segment)]
+                    if ids:
+                        kept.append((None, TOMBSTONE_HEADER.pack(
+                            TOMBSTONE, len(ids)) + struct.pack(
+                                '<%dQ' % len(ids), *ids)))
+                else:
+                    kept.append((None, payload))
+
+        temp_path = segment.path + '.compact'
+        records = [encode_record(payload) for _, payload in kept]
+        if records:
+            with open(temp_path, 'wb') as f:
+                f.write(b''.join(records))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, segment.path)
+            fd = os.open(segment.path, os.O_RDWR | os.O_APPEND)
+        else:
+            os.unlink(segment.path)
+            fd = None
+        self._fsync_directory()
+
+        with self.lock:
+            old_fd = segment.fd
+            segment.fd = fd
+            segment.size = segment.dead_bytes = 0
+            for (_id, _), record in zip(kept, records):
+                if _id is not None:
+                    entry = self.events.get(_id)
+                    if entry is None:
+                        # deleted while being compacted
+                        segment.dead_bytes += len(record)
+                    else:
+                        self.events[_id] = (segment, segment.size,
+                                            len(record)) + entry[3:]
+                segment.size += len(record)
+            for _id in dropped:
+                self.dead.pop(_id, None)
+            if fd is None:
+                self.segments.remove(segment)
+            self.compactions += 1
+        with self.sync_lock:
+            os.close(old_fd)
+
+    def _compaction_loop(self):
+        while True:
+            self.compaction_wakeup.wait(self.compaction_interval)
+            self.compaction_wakeup.clear()
+            if self.closing:
+                return
+            try:
+                self.compact()
+            except Exception:
+                logger.exception('compaction failed')
+
+    # stats
+
+    def sizes(self):
+        return [(0, len(self.events))]
+
+    def stats(self):
+        with self.lock:
+            return {
+                'directory': self.directory,
+                'sync': self.sync,
+                'segments': len(self.segments),
+                'bytes': sum(s.size for s in self.segments),
+                'dead_bytes': sum(s.dead_bytes for s in self.segments),
+                'events': len(self.events),
+                'dead_events': len(self.dead),
+                'tokens': len(self.token_ids),
+                'fsyncs': self.fsyncs,
+                'compactions': self.compactions,
+                'truncated_bytes': self.truncated_bytes,
+            }
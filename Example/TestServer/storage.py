@@ -0,0 +1,129 @@
+'''
+The interface between app.py's endpoints and the storage of events.
+
+app.py stores events in SQLite (app.SQLiteStore) by default, or in an
+append-only segment log (segment_log.SegmentLogStore) with --storage log.
+Both store rows of (_id, date_created, token, data): _id is unique and
+increases in the order events were stored, date_created is the utc time
+the event was stored at, as a TIMESTAMP_FORMAT string, and data is the
+event's json.
+'''
+import operator
+
+
+# the format of sqlite's current_timestamp, which date_created defaults to
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+OPERATORS = {'=': operator.eq, '>=': operator.ge, '<=': operator.le}
+
+
+class EventFilter:
+    '''
+    selects the events of a token (or of every token when it's None),
+    stored between since and until (inclusive, as TIMESTAMP_FORMAT
+    strings), whose extracted columns match every (column, operator, value)
+    condition, operator being one of OPERATORS
+    '''
+
+    def __init__(self, token=None, since=None, until=None, conditions=()):
+        self.token = token
+        self.since = since
+        self.until = until
+        self.conditions = list(conditions)
+
+    def sql(self):
+        '''returns the sql conditions and their parameters'''
+        conditions, params = [], []
+        if self.token:
+            conditions.append('token=?')
+            params.append(self.token)
+        if self.since:
+            conditions.append('date_created>=?')
+            params.append(self.since)
+        if self.until:
+            conditions.append('date_created<=?')
+            params.append(self.until)
+        for column, op, value in self.conditions:
+            conditions.append('%s%s?' % (column.name, op))
+            params.append(value)
+        return conditions, params
+
+    def matches_row(self, token, date_created):
+        '''whether the token and time match; the conditions aren't checked'''
+        if self.token and token != self.token:
+            return False
+        if self.since and date_created < self.since:
+            return False
+        if self.until and date_created > self.until:
+            return False
+        return True
+
+    def matches_event(self, event):
+        '''whether the parsed event matches every condition'''
+        for column, op, value in self.conditions:
+            extracted = column.extract(event)
+            if extracted is None or not OPERATORS[op](extracted, value):
+                return False
+        return True
+
+
+class EventStore:
+    '''
+    where app.py's endpoints store and read events. on_commit is called
+    whenever stored events become visible to reads, to wake up the requests
+    waiting for them
+    '''
+    name = None
+
+    def __init__(self, on_commit=None):
+        self.on_commit = on_commit
+
+    def open(self):
+        '''opens, or creates, the storage. called again after a fork'''
+        raise NotImplementedError
+
+    def close(self):
+        '''makes every event appended so far durable, and closes'''
+        raise NotImplementedError
+
+    def append(self, events):
+        '''
+        stores a batch of (token, data, event) tuples. returns False when
+        the batch can't be taken right now, and should be retried later
+        '''
+        raise NotImplementedError
+
+    def flush(self):
+        '''blocks until every batch appended so far is visible to reads'''
+
+    def connections(self):
+        '''
+        a context manager scoping reads made outside of a request; what it
+        yields is given to select() and count() as connect
+        '''
+        raise NotImplementedError
+
+    def select(self, event_filter, after=0, limit=-1, connect=None):
+        '''
+        returns an iterator over the rows matching event_filter whose _id is
+        greater than after, in _id order, up to limit rows (-1: all)
+        '''
+        raise NotImplementedError
+
+    def count(self, event_filter, after=0, connect=None):
+        raise NotImplementedError
+
+    def delete(self, event_filter):
+        '''deletes the matching events, and returns how many there were'''
+        raise NotImplementedError
+
+    def sizes(self):
+        '''a list of (shard, number of events stored)'''
+        raise NotImplementedError
+
+    def queue_depths(self):
+        '''a list of (shard, batches appended but not yet visible)'''
+        return []
+
+    def stats(self):
+        '''the counters reported by /stats/'''
+        return {}
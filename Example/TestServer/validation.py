@@ -0,0 +1,86 @@
+'''
+Validation of received events against the properties the sdk sends with
+every event - the DEFAULT_PROPERTIES of example_app_test.
+
+A batch is checked one property at a time over all of its events, rather
+than one event at a time, so that every check is a tight loop over a
+column. Only the token is required by default, as the server can't store
+an event without it; strict schemas require every property the sdk sends.
+A property that is present must always have its declared type.
+'''
+
+
+STRING = (str, )
+INTEGER = (int, )
+# bool is a subclass of int, but type(True) is bool, so it isn't a number
+NUMBER = (int, float)
+TYPE_NAMES = {STRING: 'string', INTEGER: 'integer', NUMBER: 'number'}
+
+PROPERTY_TYPES = {
+    'token': STRING,
+    'distinct_id': STRING,
+    'session_id': STRING,
+    'message_index': INTEGER,
+    'time': NUMBER,
+    'sending_time': NUMBER,
+    '$app_release': STRING,
+    '$app_version': STRING,
+    '$lib_version': STRING,
+    '$manufacturer': STRING,
+    '$model': STRING,
+    '$os': STRING,
+    '$os_version': STRING,
+    '$radio': STRING,
+    '$screen_height': NUMBER,
+    '$screen_width': NUMBER,
+    'mp_device_model': STRING,
+    'mp_lib': STRING,
+}
+REQUIRED = ('token', )
+# not sent by the legacy sdk, so not required even by strict schemas
+LEGACY_OPTIONAL = ('session_id', 'message_index')
+
+_MISSING = object()
+
+
+class Schema:
+
+    def __init__(self, strict=False, types=PROPERTY_TYPES):
+        self.types = types
+        if strict:
+            self.required = set(types) - set(LEGACY_OPTIONAL)
+        else:
+            self.required = set(REQUIRED)
+
+    def validate(self, events):
+        '''
+        returns a list with an item per event: None if it is valid,
+        otherwise the (property, error) of its first error
+        '''
+        errors = [None] * len(events)
+        columns = []
+        for idx, e in enumerate(events):
+            properties = e.get('properties') if isinstance(e, dict) else None
+            if not isinstance(properties, dict):
+                errors[idx] = ('properties', 'must be an object')
+                properties = {}
+            elif not isinstance(e.get('event', ''), str):
+                errors[idx] = ('event', 'must be a string')
+            columns.append(properties)
+
+        for name, types in self.types.items():
+            required = name in self.required
+            values = [properties.get(name, _MISSING)
+                      for properties in columns]
+            for idx, value in enumerate(values):
+                if errors[idx] is not None:
+                    continue
+                if value is _MISSING or value is None:
+                    if required:
+                        errors[idx] = (name, 'is required')
+                elif type(value) not in types:
+                    errors[idx] = (name, 'must be a%s %s' % (
+                        'n' if types is INTEGER else '', TYPE_NAMES[types]))
+                elif required and value == '':
+                    errors[idx] = (name, 'must not be empty')
+        return errors
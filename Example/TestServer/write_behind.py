@@ -0,0 +1,140 @@
+import logging
+import queue
+import threading
+
+
+QUEUE_MAX_BATCHES = 1000
+MAX_ROWS_PER_TRANSACTION = 5000
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindQueue:
+    '''
+    Decouples /track/ responses from the sqlite commit.
+
+    Request handlers put() whole batches of (token, data) rows on a bounded
+    queue and return immediately; a single writer thread drains the queue,
+    grouping as many queued batches as fit in max_rows_per_transaction into
+    one transaction, in which insert(db, rows) is called for every batch.
+    put() never blocks - when the queue is full it returns False and the
+    caller is expected to answer with a backpressure response.
+
+    The batches were acknowledged already, so when a transaction fails, it
+    is rolled back and its batches are written again one transaction each:
+    a bad batch only loses itself.
+    on_commit, if given, is called after every transaction the writer thread
+    commits, on_rollback with the batches of every transaction rolled back,
+    and on_failure with a batch that failed on its own, and is dropped.
+    '''
+
+    def __init__(self, pool, insert, max_batches=QUEUE_MAX_BATCHES,
+                 max_rows_per_transaction=MAX_ROWS_PER_TRANSACTION,
+                 on_commit=None, on_rollback=None, on_failure=None):
+        self.pool = pool
+        self.insert = insert
+        self.on_commit = on_commit
+        self.on_rollback = on_rollback
+        self.on_failure = on_failure
+        self.max_rows_per_transaction = max_rows_per_transaction
+        self.queue = queue.Queue(max_batches)
+        self.thread = None
+        self.lock = threading.Lock()
+        self.enqueued = 0
+        self.rejected = 0
+        self.written = 0
+        self.transactions = 0
+        self.failed = 0
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self._run, name='write-behind', daemon=True)
+        self.thread.start()
+
+    def put(self, rows):
+        try:
+            self.queue.put_nowait(rows)
+        except queue.Full:
+            with self.lock:
+                self.rejected += 1
+            return False
+        with self.lock:
+            self.enqueued += 1
+        return True
+
+    def flush(self):
+        '''blocks until every batch queued so far is committed'''
+        self.queue.join()
+
+    def stop(self):
+        '''commits everything still queued, then stops the writer thread'''
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+
+    def stats(self):
+        with self.lock:
+            return {
+                'depth': self.queue.qsize(),
+                'max_depth': self.queue.maxsize,
+                'enqueued': self.enqueued,
+                'rejected': self.rejected,
+                'written': self.written,
+                'transactions': self.transactions,
+                'failed': self.failed,
+            }
+
+    def _run(self):
+        db = self.pool.acquire()
+        try:
+            stopping = False
+            while not stopping:
+                batches = [self.queue.get()]
+                num_rows = len(batches[0] or ())
+                while num_rows < self.max_rows_per_transaction:
+                    try:
+                        batch = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    batches.append(batch)
+                    num_rows += len(batch or ())
+                stopping = None in batches
+                try:
+                    self._write(db, [b for b in batches if b is not None])
+                finally:
+                    for _ in batches:
+                        self.queue.task_done()
+        finally:
+            self.pool.release(db)
+
+    def _write(self, db, batches):
+        if not batches:
+            return
+        try:
+            with db:
+                for rows in batches:
+                    self.insert(db, rows)
+        except Exception:
+            if self.on_rollback is not None:
+                self.on_rollback(batches)
+            if len(batches) > 1:
+                logger.warning('write-behind failed writing %d batches, '
+                               'writing them one by one', len(batches),
+                               exc_info=True)
+                for rows in batches:
+                    self._write(db, [rows])
+                return
+            logger.exception('write-behind failed writing a batch of %d '
+                             'rows, dropping it', len(batches[0]))
+            with self.lock:
+                self.failed += len(batches[0])
+            if self.on_failure is not None:
+                self.on_failure(batches[0])
+            return
+        with self.lock:
+            self.written += sum(len(rows) for rows in batches)
+            self.transactions += 1
+        if self.on_commit is not None:
+            self.on_commit()